@@ -0,0 +1,185 @@
+"""
+Microbenchmark for the coordinate types in src.shared.geometry, against the
+classes they replaced (which had a __dict__ per instance, recomputed chunk and
+build on every access, and weren't usable as dict keys).
+
+Run from the top of the repository:
+    python -m benchmarks.coords [--number N]
+
+For each operation this reports the time per call with the old and current
+classes, and the ratio between them. It also reports the memory each instance
+takes.
+
+"dict lookup" compares looking a position up by its .unit tuple (the only
+option with the old classes) with looking it up by the Coord itself. The
+latter is slower, since comparing Coords happens in Python; .unit tuples are
+still the better key for the very hottest tables.
+"""
+
+import argparse
+import logging
+import sys
+import timeit
+
+from src.shared.config import CHUNK_SIZE, BUILD_SIZE
+
+# logconfig relies on there being a root log handler, which the venv
+# installs; make sure there is one even outside it.
+logging.basicConfig()
+
+from src.shared.geometry import Coord, Distance
+
+
+# The old classes, cut down to what's measured here. They're kept verbatim
+# otherwise, so that the comparison stays fair as the real ones change.
+
+class OldAbstractCoord(object):
+    def __init__(self, uPos):
+        super(OldAbstractCoord, self).__init__()
+        self.x, self.y = uPos
+
+    @property
+    def chunk(self):
+        return (self.x // CHUNK_SIZE, self.y // CHUNK_SIZE)
+
+    @property
+    def build(self):
+        return (self.x // BUILD_SIZE, self.y // BUILD_SIZE)
+
+    @property
+    def unit(self):
+        return (self.x, self.y)
+
+    def __eq__(self, rhs):
+        if not isinstance(self, type(rhs)) and not isinstance(rhs, type(self)):
+            raise TypeError("Cannot compare {} with {}.".format(
+                type(self), type(rhs)
+            ))
+        return self.x == rhs.x and self.y == rhs.y
+
+    def __ne__(self, rhs):
+        if not isinstance(self, type(rhs)) and not isinstance(rhs, type(self)):
+            raise TypeError("Cannot compare {} with {}.".format(
+                type(self), type(rhs)
+            ))
+        return self.x != rhs.x or self.y != rhs.y
+
+    def __add__(self, rhs):
+        if isinstance(self, OldCoord) and isinstance(rhs, OldCoord):
+            raise TypeError("Cannot add two Coords.")
+        elif isinstance(self, OldDistance) and isinstance(rhs, OldDistance):
+            retType = OldDistance
+        else:
+            # Coord + Distance or Distance + Coord
+            retType = OldCoord
+
+        x = self.x + rhs.x
+        y = self.y + rhs.y
+        return retType((x, y))
+
+    def __sub__(self, rhs):
+        if isinstance(self, OldCoord) == isinstance(rhs, OldCoord):
+            # Coord - Coord or Distance - Distance
+            retType = OldDistance
+        elif isinstance(self, OldCoord):
+            # Coord - Distance
+            retType = OldCoord
+        else:
+            # Distance - Coord
+            raise TypeError("Cannot subtract Distance - Coord.")
+
+        x = self.x - rhs.x
+        y = self.y - rhs.y
+        return retType((x, y))
+
+class OldDistance(OldAbstractCoord):
+    pass
+
+class OldCoord(OldAbstractCoord):
+    pass
+
+
+def operations(coordType, distanceType, useKeys):
+    """
+    Return a list of (name, function) for the operations to time, using the
+    given classes. If useKeys, the coordinates themselves are used as dict
+    keys; otherwise (as the old classes required) their .unit tuples are.
+    """
+
+    pos   = coordType((1234, 5678))
+    other = coordType((1234, 5679))
+    step  = distanceType((3, -4))
+    table = dict(((coordType((x, y)) if useKeys else (x, y)), x + y)
+                 for x in range(20) for y in range(20))
+    key   = coordType((7, 11))
+
+    def construct():
+        return coordType((1234, 5678))
+    def add():
+        return pos + step
+    def subtract():
+        return pos - other
+    def equal():
+        return pos == other
+    def chunk():
+        return pos.chunk
+    def build():
+        return pos.build
+    if useKeys:
+        def lookup():
+            return table[key]
+    else:
+        def lookup():
+            return table[key.unit]
+
+    return [
+        ("construct", construct),
+        ("Coord + Distance", add),
+        ("Coord - Coord", subtract),
+        ("==", equal),
+        ("chunk", chunk),
+        ("build", build),
+        ("dict lookup", lookup),
+    ]
+
+
+def instanceSize(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the coordinate types with the ones they replaced."
+    )
+    parser.add_argument("--number", type=int, default=200000,
+                        help="calls per measurement [Default: %(default)s]")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="measurements per operation; the best is "
+                             "reported [Default: %(default)s]")
+    args = parser.parse_args()
+
+    old = operations(OldCoord, OldDistance, useKeys=False)
+    new = operations(Coord, Distance, useKeys=True)
+
+    print("{:<20} {:>9} {:>9} {:>7}".format("operation", "old (ns)",
+                                            "new (ns)", "speedup"))
+    for (name, oldFunc), (_, newFunc) in zip(old, new):
+        oldTime, newTime = [
+            min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+            / args.number
+            for func in (oldFunc, newFunc)
+        ]
+        print("{:<20} {:>9.0f} {:>9.0f} {:>6.2f}x".format(
+            name, oldTime * 1e9, newTime * 1e9, oldTime / newTime
+        ))
+
+    print("Bytes per instance: old {}, new {}.".format(
+        instanceSize(OldCoord((1, 2))), instanceSize(Coord((1, 2)))
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Startup-time benchmark: how long each subcommand takes to load everything
+it needs, measured in fresh interpreters.
+
+Run from the top of the repository:
+    python -m benchmarks.startup [--runs N]
+
+For each mode this reports the best and median time to import src.main and
+load the subcommand (see src.main.loadCommand), how many modules that
+loaded, and whether Panda3D was among them. "client (graphics)" also loads
+the graphics modules that a client with a window imports once it starts;
+it's skipped if Panda3D isn't installed.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# Code run in each fresh interpreter. Prints a JSON object describing what
+# happened.
+CHILD_CODE = """
+import json
+import logging
+import sys
+import time
+
+# The venv installs a root log handler, which logconfig relies on; make sure
+# there is one even outside it. This takes no noticeable time.
+logging.basicConfig()
+
+startTime = time.time()
+from src.main import loadCommand
+loadCommand({command!r})
+for module in {extraModules!r}:
+    __import__(module)
+elapsed = time.time() - startTime
+
+print(json.dumps({{
+    "elapsed": elapsed,
+    "modules": len(sys.modules),
+    "panda3d": any(name.split(".")[0] in ("panda3d", "direct")
+                   for name in sys.modules),
+}}))
+"""
+
+# (name, subcommand, extra modules to import) for each mode measured.
+MODES = [
+    ("server",            "server",   []),
+    ("simulate",          "simulate", []),
+    ("replay",            "replay",   []),
+    ("loadtest",          "loadtest", []),
+    ("client (bot)",      "client",   []),
+    ("client (graphics)", "client",   ["src.client.graphics",
+                                       "src.client.newgraphics"]),
+]
+
+
+def measure(command, extraModules):
+    """
+    Return the child's report, or None if it failed (for example because
+    Panda3D isn't installed).
+    """
+
+    code = CHILD_CODE.format(command=command, extraModules=extraModules)
+    process = subprocess.Popen([sys.executable, "-c", code],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return json.loads(output.splitlines()[-1])
+
+
+def measureInterpreter():
+    # Baseline: starting Python and doing nothing.
+    code = "import time; print(time.time())"
+    times = []
+    for _ in range(3):
+        # Time it from outside, since the child can't see its own startup.
+        startTime = time.time()
+        subprocess.check_output([sys.executable, "-c", code])
+        times.append(time.time() - startTime)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how long each subcommand takes to start."
+    )
+    parser.add_argument("--runs", type=int, default=5,
+                        help="runs per mode [Default: %(default)s]")
+    args = parser.parse_args()
+
+    print("Python startup (baseline): {:.1f} ms".format(
+        measureInterpreter() * 1000
+    ))
+    print("{:<20} {:>9} {:>11} {:>8} {:>8}".format(
+        "mode", "best (ms)", "median (ms)", "modules", "panda3d"
+    ))
+    for name, command, extraModules in MODES:
+        reports = [measure(command, extraModules) for _ in range(args.runs)]
+        if any(report is None for report in reports):
+            print("{:<20} (failed; is everything it needs installed?)"
+                  .format(name))
+            continue
+        times = sorted(report["elapsed"] for report in reports)
+        print("{:<20} {:>9.1f} {:>11.1f} {:>8d} {:>8}".format(
+            name, times[0] * 1000, times[len(times) // 2] * 1000,
+            reports[0]["modules"], "yes" if reports[0]["panda3d"] else "no"
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
+import time
+
 from src.shared import messages
 from src.shared.game_state import GameState
-from src.shared.geometry import Coord, Distance
+from src.shared.geometry import Coord, Distance, Rect
 from src.shared.ident import unitToPlayer, getUnitSubId
 from src.shared.logconfig import newLogger
+from src.shared.message_dispatch import MessageHandlers
+from src.shared.sampling_profiler import SamplingProfiler, profileCommand
+from src.shared.simulation import Simulation
+from src.shared.snapshot import MapContents, UnitTable, SimulationState
 from src.shared.message_infrastructure import deserializeMessage, \
     badIMessageCommand, illFormedEMessage, InvalidMessageError, \
     badEMessageCommand, badEMessageArgument
@@ -14,10 +20,17 @@ GRAPHICS_SCALE = 3
 # Max squared distance between mouse click and unit for it to register as
 # clicking that unit.
 MAX_CLICK_DISTANCE = 30**2
+# How often (in percent) to report progress while the map (or, in lockstep
+# mode, the simulation state) is loading.
+SNAPSHOT_PROGRESS_STEP = 10
 
 # Logging
 log = newLogger(__name__)
 
+# Handlers for messages from the server and from the graphics.
+networkHandlers  = MessageHandlers()  # pylint: disable=invalid-name
+graphicsHandlers = MessageHandlers()  # pylint: disable=invalid-name
+
 
 class Backend(object):
     def __init__(self, done):
@@ -36,6 +49,45 @@ class Backend(object):
         self.gameState     = GameState()
         self.unitSelection = UnitSet()
 
+        # Pieces of the map received so far, from MapSnapshotParts, and of
+        # the simulation state, from SimSnapshotParts.
+        self.mapParts = SnapshotParts("map")
+        self.simParts = SnapshotParts("simulation state")
+
+        # In lockstep mode (which the server indicates by sending
+        # SimSnapshotParts), we run the simulation ourselves, driven by the
+        # orders and ticks the server relays. The simulation is None until
+        # the whole simulation state has arrived, and always None otherwise.
+        self.lockstep        = False
+        self.simulation      = None
+        # The player whose relayed orders we're currently receiving.
+        self.orderPlayer     = None
+        # (playerId, message) pairs for the orders relayed since the last
+        # tick, to be applied at the start of the next one.
+        self.lockstepOrders  = []
+        # Relayed orders and ticks that arrived before the simulation state
+        # and the map finished loading; the simulation can't run without
+        # them.
+        self.lockstepBacklog = []
+        # Whether we've noticed that our simulation disagrees with the
+        # server's, so that we only complain about it once.
+        self.desynced        = False
+
+        # Started and stopped from the console, with "profile ...".
+        self.samplingProfiler = SamplingProfiler()
+
+        # If set, a Tracer (see src.shared.tracing) that times the orders we
+        # send, and the trace id to give the next one.
+        self.tracer      = None
+        self.nextTraceId = 1
+
+        self.networkDispatcher  = networkHandlers.bind(
+            self, self.unhandledNetworkMessage
+        )
+        self.graphicsDispatcher = graphicsHandlers.bind(
+            self, self.unhandledGraphicsMessage
+        )
+
     @property
     def allComponents(self):
         return (self.stdio, self.network, self.graphicsInterface)
@@ -46,6 +98,14 @@ class Backend(object):
 
     # All wings, report in.
 
+    def setTracer(self, tracer):
+        self.tracer = tracer
+
+    def stopTracing(self):
+        if self.tracer is not None:
+            self.tracer.close()
+            self.tracer = None
+
     # Red 2, standing by.
     def stdioReady(self, stdioComponent):
         assert self.stdio is None
@@ -116,6 +176,27 @@ class Backend(object):
                          "*" if isSelected else "", unitToPlayer(uid),
                          getUnitSubId(uid), ux, uy)
             log.info("End unit dump.")
+        elif message == "trace":
+            if self.tracer is None:
+                log.info("Not tracing; start the client with --trace.")
+            else:
+                self.tracer.logReport()
+        elif message == "stats":
+            dispatchers = [("Server", self.networkDispatcher),
+                           ("Graphics", self.graphicsDispatcher)]
+            # A bot takes the place of the graphics interface, and doesn't
+            # have one.
+            interfaceDispatcher = getattr(self.graphicsInterface,
+                                          "dispatcher", None)
+            if interfaceDispatcher is not None:
+                dispatchers.append(("Graphics interface",
+                                    interfaceDispatcher))
+            for name, dispatcher in dispatchers:
+                log.info("%s message handlers:", name)
+                for line in dispatcher.reportLines():
+                    log.info("%s", line)
+        elif message.split()[:1] == ["profile"]:
+            profileCommand(self.samplingProfiler, message.split()[1:])
         else:
             self.network.backendMessage(message)
 
@@ -126,7 +207,7 @@ class Backend(object):
                 if self.tryToHandleNetworkMessage(message):
                     # Many backend messages are currently also forwarded to the
                     # graphics interface.
-                    self.graphicsInterface.backendMessage(messageStr)
+                    self.graphicsInterface.backendMessage(message)
                 else:
                     # In fact, so many of them are that we used to just forward
                     # all of them. We don't anymore, but it's still uncommon
@@ -151,78 +232,284 @@ class Backend(object):
         farther than the backend.
         """
 
-        forwardToGraphicsInterface = False
-        if isinstance(message, messages.Tick):
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.YourIdIs):
-            if self.myId >= 0:
-                raise RuntimeError("ID already set; can't change it now.")
-            self.myId = message.playerId
-            log.info("Your id is %s.", self.myId)
-
-            self.unitSelection = UnitSet([])
-            # TODO: Does the graphics interface really need to know our id?
-            # Seems like probably not.
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.NewObelisk):
-            uid = message.unitId
-            pos = message.pos
-            if uid in self.gameState.positions:
-                badEMessageArgument(message, log,
-                                    reason="uid {} already in use".format(uid))
-                return False
-            self.gameState.positions[uid] = pos
-            # TODO: So the backend needs to keep track of where all the units
-            # are because it manages the main logic. And the graphics does also
-            # need to know that information because it has to actually draw
-            # them. But is this really the best solution? It seems to me that
-            # if we're forwarding to the graphics interface all server messages
-            # related to unit positions, that probably indicates a
-            # poorly-understood division of responsibility between client
-            # backend and graphics interface.
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.DeleteObelisk):
-            uid = message.unitId
-            if uid not in self.gameState.positions:
-                badEMessageArgument(message, log,
-                                    reason="No such uid: {}".format(uid))
-                return False
-            if uid in self.unitSelection:
-                self.removeFromSelection(uid)
-            del self.gameState.positions[uid]
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.SetPos):
-            uid = message.unitId
-            pos = message.pos
+        return self.networkDispatcher.dispatch(message)
+
+    def unhandledNetworkMessage(self, message):
+        badEMessageCommand(message, log)
+        return False
+
+    # Each of the handlers below returns what tryToHandleNetworkMessage does.
+
+    @networkHandlers.handles(messages.Tick)
+    def handleTick(self, message):
+        if self.lockstep:
+            # The tick is passed on once the simulation has run it.
+            self.handleLockstepMessage(message)
+            return False
+        return True
+
+    @networkHandlers.handles(messages.OrderFrom, messages.OrderNew,
+                             messages.OrderMove, messages.OrderDel)
+    def handleRelayedOrder(self, message):
+        if not self.lockstep:
+            badEMessageCommand(message, log)
+            return False
+        self.handleLockstepMessage(message)
+        return False
+
+    @networkHandlers.handles(messages.SimSnapshotPart)
+    def handleSimSnapshotPart(self, message):
+        """
+        Collect one piece of the simulation state. Once all of them have
+        arrived, start running the simulation from it.
+        """
+
+        if self.simulation is not None or self.gameState.positions:
+            badEMessageArgument(message, log,
+                                reason="Already have a game state")
+            return False
+        # Everything relayed from here on is for the simulation, even though
+        # we can't run it yet.
+        self.lockstep = True
+
+        data = self.collectSnapshotPart(self.simParts, message)
+        if data is not None:
+            self.startLockstep(SimulationState.deserialize(data))
+            # Catch up on anything that happened while it was loading.
+            self.replayLockstepBacklog()
+        return False
+
+    @networkHandlers.handles(messages.YourIdIs)
+    def handleYourIdIs(self, message):
+        if self.myId >= 0:
+            raise RuntimeError("ID already set; can't change it now.")
+        self.myId = message.playerId
+        log.info("Your id is %s.", self.myId)
+
+        self.unitSelection = UnitSet([])
+        # TODO: Does the graphics interface really need to know our id?
+        # Seems like probably not.
+        return True
+
+    @networkHandlers.handles(messages.NewObelisk)
+    def handleNewObelisk(self, message):
+        uid = message.unitId
+        pos = message.pos
+        if uid in self.gameState.positions:
+            badEMessageArgument(message, log,
+                                reason="uid {} already in use".format(uid))
+            return False
+        self.gameState.positions[uid] = pos
+        self.traceReached(message.traceId, "receive", uid)
+        # TODO: So the backend needs to keep track of where all the units
+        # are because it manages the main logic. And the graphics does also
+        # need to know that information because it has to actually draw
+        # them. But is this really the best solution? It seems to me that
+        # if we're forwarding to the graphics interface all server messages
+        # related to unit positions, that probably indicates a
+        # poorly-understood division of responsibility between client
+        # backend and graphics interface.
+        return True
+
+    @networkHandlers.handles(messages.DeleteObelisk)
+    def handleDeleteObelisk(self, message):
+        uid = message.unitId
+        if uid not in self.gameState.positions:
+            badEMessageArgument(message, log,
+                                reason="No such uid: {}".format(uid))
+            return False
+        if uid in self.unitSelection:
+            self.removeFromSelection(uid)
+        del self.gameState.positions[uid]
+        return True
+
+    @networkHandlers.handles(messages.SetPos)
+    def handleSetPos(self, message):
+        uid = message.unitId
+        pos = message.pos
+        if uid not in self.gameState.positions:
+            badEMessageArgument(message, log,
+                                reason="No such uid: {}".format(uid))
+            return False
+        self.gameState.positions[uid] = pos
+        self.traceReached(message.traceId, "receive", uid)
+        return True
+
+    @networkHandlers.handles(messages.PosDeltas)
+    def handlePosDeltas(self, message):
+        for uid, delta in message.deltas:
             if uid not in self.gameState.positions:
                 badEMessageArgument(message, log,
                                     reason="No such uid: {}".format(uid))
+                continue
+            pos = self.gameState.positions[uid] + delta
+            self.gameState.positions[uid] = pos
+            # The graphics interface only deals in absolute positions, so
+            # pass each one on as a SetPos.
+            setPos = messages.SetPos(uid, pos)
+            self.graphicsInterface.backendMessage(setPos)
+        return False
+
+    @networkHandlers.handles(messages.ResourceAmt)
+    def handleResourceAmt(self, message):
+        self.gameState.resources[self.myId] = message.amount
+        return True
+
+    @networkHandlers.handles(messages.ResourceLoc)
+    def handleResourceLoc(self, message):
+        self.gameState.addResourcePool(message.pos)
+        return True
+
+    @networkHandlers.handles(messages.GroundInfo)
+    def handleGroundInfo(self, message):
+        # Note: this isn't used in any way right now. I think it's right,
+        # but it's definitely possible we transposed something, or worse.
+        cx, cy      = message.pos.chunk
+        terrainType = message.terrainType
+        self.gameState.groundTypes[cx][cy] = terrainType
+        return True
+
+    @networkHandlers.handles(messages.MapSize)
+    def handleMapSize(self, message):
+        if self.gameState.hasSize:
+            log.error("A size, you have, GameState. "
+                      "Impossible, to take on a second.")
+        else:
+            self.gameState.setSize(message.size)
+        return False
+
+    @networkHandlers.handles(messages.MapSnapshot)
+    def handleMapSnapshot(self, message):
+        if self.gameState.hasSize:
+            badEMessageArgument(message, log,
+                                reason="Map has already been loaded")
+            return False
+        message.contents.applyTo(self.gameState)
+        return True
+
+    @networkHandlers.handles(messages.UnitSnapshot)
+    def handleUnitSnapshot(self, message):
+        for uid, _ in message.units:
+            if uid in self.gameState.positions:
+                badEMessageArgument(
+                    message, log,
+                    reason="uid {} already in use".format(uid)
+                )
                 return False
+        for uid, pos in message.units:
             self.gameState.positions[uid] = pos
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.ResourceAmt):
-            self.gameState.resources[self.myId] = message.amount
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.ResourceLoc):
-            self.gameState.resourcePools.append(message.pos)
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.GroundInfo):
-            # Note: this isn't used in any way right now. I think it's right,
-            # but it's definitely possible we transposed something, or worse.
-            cx, cy      = message.pos.chunk
-            terrainType = message.terrainType
-            self.gameState.groundTypes[cx][cy] = terrainType
-            forwardToGraphicsInterface = True
-        elif isinstance(message, messages.MapSize):
-            if self.gameState.hasSize:
-                log.error("A size, you have, GameState. "
-                          "Impossible, to take on a second.")
-            else:
-                self.gameState.setSize(message.size)
+        return True
+
+    @networkHandlers.handles(messages.MapSnapshotPart)
+    def handleMapSnapshotPart(self, message):
+        """
+        Collect one piece of the map. Once all of them have arrived, load the
+        map and pass it on to the graphics interface as a single MapSnapshot.
+        """
+
+        if self.gameState.hasSize:
+            badEMessageArgument(message, log,
+                                reason="Map has already been loaded")
+            return
+
+        data = self.collectSnapshotPart(self.mapParts, message)
+        if data is not None:
+            contents = MapContents.deserialize(data)
+            contents.applyTo(self.gameState)
+            snapshot = messages.MapSnapshot(contents)
+            self.graphicsInterface.backendMessage(snapshot)
+
+            # Catch up on anything that happened while the map was loading.
+            self.replayLockstepBacklog()
+
+    def collectSnapshotPart(self, parts, message):
+        """
+        Add a MapSnapshotPart or SimSnapshotPart to the pieces of that
+        snapshot received so far. Return the whole serialized snapshot once
+        the last piece has arrived, or None until then.
+        """
+
+        if message.offset != parts.received:
+            badEMessageArgument(message, log,
+                                reason="Expected offset {}".format(
+                                    parts.received))
+            return None
+
+        parts.pieces.append(message.data)
+        parts.received += len(message.data)
+
+        # Report progress every so often, so that a slow join doesn't look
+        # like a hang.
+        total = max(message.total, 1)
+        oldPercent = 100 * (parts.received - len(message.data)) / total
+        newPercent = 100 * parts.received / total
+        if oldPercent // SNAPSHOT_PROGRESS_STEP != \
+                newPercent // SNAPSHOT_PROGRESS_STEP:
+            log.info("Loading %s: %d%% (%d of %d bytes).", parts.description,
+                     min(newPercent, 100), parts.received, message.total)
+
+        if parts.received < message.total:
+            return None
+        data = "".join(parts.pieces)
+        parts.pieces = []
+        return data
+
+    def startLockstep(self, state):
+        log.info("Server is in lockstep mode; running the simulation "
+                 "locally.")
+        self.simulation = Simulation(LocalSimulationListener(self),
+                                     self.gameState)
+        state.applyTo(self.gameState, self.simulation.unitOrders)
+        self.simulation.elapsedTicks = state.elapsedTicks
+
+        units = UnitTable.fromGameState(self.gameState)
+        self.graphicsInterface.backendMessage(messages.UnitSnapshot(units))
+
+    def handleLockstepMessage(self, message):
+        if self.simulation is None or not self.gameState.hasSize:
+            self.lockstepBacklog.append(message)
         else:
-            badEMessageCommand(message, log)
+            self.applyLockstepMessage(message)
 
-        return forwardToGraphicsInterface
+    def replayLockstepBacklog(self):
+        if self.simulation is None or not self.gameState.hasSize:
+            return
+        backlog = self.lockstepBacklog
+        self.lockstepBacklog = []
+        for message in backlog:
+            self.applyLockstepMessage(message)
+
+    def applyLockstepMessage(self, message):
+        if isinstance(message, messages.OrderFrom):
+            self.orderPlayer = message.playerId
+        elif isinstance(message, messages.Tick):
+            orders = self.lockstepOrders
+            self.lockstepOrders = []
+            self.simulation.step(orders)
+            self.graphicsInterface.backendMessage(message)
+            self.checkStateHash(message.stateHash)
+        else:
+            # The server has already checked the order, so just queue it up
+            # for the next tick, same as the server did.
+            if self.orderPlayer == self.myId:
+                # Our own order, coming back from the server, is the result
+                # a traced order is waiting for.
+                self.traceReached(getattr(message, "traceId", None),
+                                  "receive")
+            self.lockstepOrders.append((self.orderPlayer, message))
+
+    def checkStateHash(self, stateHash):
+        # If our simulation doesn't match the server's after the same tick,
+        # something has gone nondeterministic, and from here on everything
+        # we show is suspect.
+        if stateHash is None:
+            return
+        ourHash = self.gameState.stateHash
+        if ourHash != stateHash and not self.desynced:
+            log.error("Simulation out of sync with server after tick %d "
+                      "(state hash %x, server has %x).",
+                      self.simulation.elapsedTicks, ourHash, stateHash)
+            self.desynced = True
 
     # New API to replace graphicsMessage:
     def worldClick(self, uPos, button, modifiers):
@@ -232,15 +519,16 @@ class Backend(object):
         # _back_ to graphics coordinates so that it can call off to its old
         # (message-based) API which will convert to world coordinates once
         # again. Obviously TODO: get rid of this silliness.
+        clickTime = time.time()
         gPos = worldToGraphicsPos(uPos)
         if modifiers == []:
-            message = cmessages.Click(button, gPos)
+            message = cmessages.Click(button, gPos, clickTime)
         elif button == 1 and modifiers == ["shift"]:
             message = cmessages.ShiftLClick(gPos)
         elif button == 1 and modifiers == ["control"]:
             message = cmessages.ControlLClick(gPos)
         elif button == 3 and modifiers == ["shift"]:
-            message = cmessages.ShiftRClick(gPos)
+            message = cmessages.ShiftRClick(gPos, clickTime)
         elif button == 3 and modifiers == ["control"]:
             message = cmessages.ControlRClick(gPos)
         else:
@@ -248,96 +536,164 @@ class Backend(object):
             log.debug("Ignoring worldClick with button=%d, modifiers=%s.",
                       button, modifiers)
             return
-        self.graphicsMessage(message.serialize())
+        self.graphicsMessage(message)
 
     def worldDrag(self, startUPos, endUPos, button, modifiers):
         if button == 1 and modifiers == []:
             startGPos = worldToGraphicsPos(startUPos)
             endGPos   = worldToGraphicsPos(endUPos)
             message = cmessages.DragBox(startGPos, endGPos)
-            self.graphicsMessage(message.serialize())
+            self.graphicsMessage(message)
         else:
             # Other cases not handled for now...
             log.debug("Ignoring worldDrag with button=%d, modifiers=%s.",
                       button, modifiers)
 
-    def graphicsMessage(self, messageStr):
-        message = deserializeMessage(messageStr)
-        if isinstance(message, cmessages.Click):
-            # TODO: Have Click indicate "left" or "right", rather than just a
-            # numerical button.
-            # TODO: GraphicsInterface should probably translate Click.pos to a
-            # uPos before passing it to the backend.
-            if message.button == 1:
-                # Left mouse button
-                gPos = message.pos
-                wPos = graphicsToWorldPos(gPos)
-                chosenUnit = self.getUnitAt(wPos)
-                self.clearSelection()
-                if chosenUnit is not None:
-                    self.addToSelection(chosenUnit)
-            elif message.button == 3:
-                # Right mouse button
-                newMsg = messages.OrderMove(self.unitSelection,
-                                            graphicsToWorldPos(message.pos))
-                self.network.backendMessage(newMsg.serialize())
-        elif isinstance(message, cmessages.ShiftLClick):
+    def graphicsMessage(self, message):
+        """
+        Handle a message (a Message object; see src.client.messages) from
+        the graphics interface. Messages between components of the client
+        are passed as objects; they're only serialized to go over the
+        network.
+        """
+
+        self.graphicsDispatcher.dispatch(message)
+
+    def unhandledGraphicsMessage(self, message):
+        badIMessageCommand(message, log)
+
+    @graphicsHandlers.handles(cmessages.Click)
+    def handleClick(self, message):
+        # TODO: Have Click indicate "left" or "right", rather than just a
+        # numerical button.
+        # TODO: GraphicsInterface should probably translate Click.pos to a
+        # uPos before passing it to the backend.
+        if message.button == 1:
+            # Left mouse button
             gPos = message.pos
             wPos = graphicsToWorldPos(gPos)
             chosenUnit = self.getUnitAt(wPos)
+            self.clearSelection()
             if chosenUnit is not None:
                 self.addToSelection(chosenUnit)
-        elif isinstance(message, cmessages.ControlLClick):
-            gPos = message.pos
-            wPos = graphicsToWorldPos(gPos)
-            chosenUnit = self.getUnitAt(wPos)
-            if chosenUnit is not None and chosenUnit in self.unitSelection:
+        elif message.button == 3:
+            # Right mouse button
+            traceId = self.startTrace(message.clickTime)
+            newMsg = messages.OrderMove(self.unitSelection,
+                                        graphicsToWorldPos(message.pos),
+                                        traceId)
+            self.network.backendMessage(newMsg.serialize(), traceId=traceId)
+
+    @graphicsHandlers.handles(cmessages.ShiftLClick)
+    def handleShiftLClick(self, message):
+        gPos = message.pos
+        wPos = graphicsToWorldPos(gPos)
+        chosenUnit = self.getUnitAt(wPos)
+        if chosenUnit is not None:
+            self.addToSelection(chosenUnit)
+
+    @graphicsHandlers.handles(cmessages.ControlLClick)
+    def handleControlLClick(self, message):
+        gPos = message.pos
+        wPos = graphicsToWorldPos(gPos)
+        chosenUnit = self.getUnitAt(wPos)
+        if chosenUnit is not None and chosenUnit in self.unitSelection:
+            self.removeFromSelection(chosenUnit)
+
+    @graphicsHandlers.handles(cmessages.ShiftRClick)
+    def handleShiftRClick(self, message):
+        traceId = self.startTrace(message.clickTime)
+        newMsg = messages.OrderNew(1, graphicsToWorldPos(message.pos),
+                                   traceId)
+        self.network.backendMessage(newMsg.serialize(), traceId=traceId)
+
+    @graphicsHandlers.handles(cmessages.ControlRClick)
+    def handleControlRClick(self, message):
+        gPos = message.pos
+        wPos = graphicsToWorldPos(gPos)
+        chosenUnit = self.getUnitAt(wPos)
+        if chosenUnit is not None:
+            if chosenUnit in self.unitSelection:
                 self.removeFromSelection(chosenUnit)
-        elif isinstance(message, cmessages.ShiftRClick):
-            newMsg = messages.OrderNew(1, graphicsToWorldPos(message.pos))
+            newMsg = messages.OrderDel(UnitSet([chosenUnit]))
             self.network.backendMessage(newMsg.serialize())
-        elif isinstance(message, cmessages.ControlRClick):
-            gPos = message.pos
-            wPos = graphicsToWorldPos(gPos)
-            chosenUnit = self.getUnitAt(wPos)
-            if chosenUnit is not None:
-                if chosenUnit in self.unitSelection:
-                    self.removeFromSelection(chosenUnit)
-                newMsg = messages.OrderDel(UnitSet([chosenUnit]))
-                self.network.backendMessage(newMsg.serialize())
-        elif isinstance(message, cmessages.DragBox):
-            ux1, uy1 = graphicsToWorldPos(message.corner1).unit
-            ux2, uy2 = graphicsToWorldPos(message.corner2).unit
-            xMin = min(ux1, ux2)
-            xMax = max(ux1, ux2)
-            yMin = min(uy1, uy2)
-            yMax = max(uy1, uy2)
-            self.clearSelection()
-            for (uid, wPos) in self.gameState.positions.iteritems():
-                ux, uy = wPos.unit
-                # TODO: Add a tolerance based on the size of the unit.
-                if unitToPlayer(uid) == self.myId:
-                    if xMin <= ux <= xMax and yMin <= uy <= yMax:
-                        self.addToSelection(uid)
-        elif isinstance(message, cmessages.RequestCenter):
-            if not self.unitSelection:
-                # FIXME: Move to center of world.
-                return
-            totalX, totalY = 0, 0
-            for unitId in self.unitSelection:
-                unitX, unitY = self.gameState.positions[unitId]
-                totalX += unitX
-                totalY += unitY
-            centroid = (totalX // len(self.unitSelection),
-                        totalY // len(self.unitSelection))
-            log.debug("Center requested; it's %s", centroid)
-            # FIXME: Write this.
-        elif isinstance(message, cmessages.RequestQuit):
-            for component in self.allComponents:
-                component.cleanup()
-            self.done.callback(None)
-        else:
-            badIMessageCommand(message, log)
+
+    @graphicsHandlers.handles(cmessages.DragBox)
+    def handleDragBox(self, message):
+        ux1, uy1 = graphicsToWorldPos(message.corner1).unit
+        ux2, uy2 = graphicsToWorldPos(message.corner2).unit
+        xMin = min(ux1, ux2)
+        xMax = max(ux1, ux2)
+        yMin = min(uy1, uy2)
+        yMax = max(uy1, uy2)
+        self.clearSelection()
+        for (uid, wPos) in self.gameState.positions.iteritems():
+            ux, uy = wPos.unit
+            # TODO: Add a tolerance based on the size of the unit.
+            if unitToPlayer(uid) == self.myId:
+                if xMin <= ux <= xMax and yMin <= uy <= yMax:
+                    self.addToSelection(uid)
+
+    @graphicsHandlers.handles(cmessages.ReportViewport)
+    def handleReportViewport(self, message):
+        ux1, uy1 = graphicsToWorldPos(message.corner1).unit
+        ux2, uy2 = graphicsToWorldPos(message.corner2).unit
+        corner = Coord.fromUnit((min(ux1, ux2), min(uy1, uy2)))
+        size   = Distance.fromUnit((abs(ux2 - ux1), abs(uy2 - uy1)))
+        newMsg = messages.SetViewport(Rect(corner, size))
+        self.network.backendMessage(newMsg.serialize())
+
+    @graphicsHandlers.handles(cmessages.RequestCenter)
+    def handleRequestCenter(self, message):
+        if not self.unitSelection:
+            # FIXME: Move to center of world.
+            return
+        totalX, totalY = 0, 0
+        for unitId in self.unitSelection:
+            unitX, unitY = self.gameState.positions[unitId]
+            totalX += unitX
+            totalY += unitY
+        centroid = (totalX // len(self.unitSelection),
+                    totalY // len(self.unitSelection))
+        log.debug("Center requested; it's %s", centroid)
+        # FIXME: Write this.
+
+    @graphicsHandlers.handles(cmessages.RequestQuit)
+    def handleRequestQuit(self, message):
+        for component in self.allComponents:
+            component.cleanup()
+        self.done.callback(None)
+
+    def startTrace(self, clickTime=None):
+        """
+        If we're tracing, start a trace for an order the user just gave, and
+        return its trace id. Otherwise return None. clickTime is when the
+        graphics saw the click, if it said; otherwise the trace starts now.
+
+        The network component marks the "send" stage, once it has written
+        the order.
+        """
+
+        if self.tracer is None:
+            return None
+        traceId = self.nextTraceId
+        self.nextTraceId += 1
+        self.tracer.mark(traceId, "click", clickTime)
+        return traceId
+
+    def traceReached(self, traceId, stage, unitId=None):
+        """
+        Note that the order with the given trace id (if any) has reached the
+        given stage. If unitId is given, it's the unit whose update carried
+        the trace id; other players' units can carry their own trace ids,
+        which mean nothing to us.
+        """
+
+        if self.tracer is None or traceId is None:
+            return
+        if unitId is not None and unitToPlayer(unitId) != self.myId:
+            return
+        self.tracer.mark(traceId, stage)
 
     def getUnitAt(self, targetWPos):
         targetX, targetY = targetWPos.unit
@@ -363,19 +719,65 @@ class Backend(object):
     def addToSelection(self, unitId):
         self.unitSelection.add(unitId)
         msg = cmessages.MarkUnitSelected(unitId, True)
-        self.graphicsInterface.backendMessage(msg.serialize())
+        self.graphicsInterface.backendMessage(msg)
 
     def removeFromSelection(self, unitId):
         self.unitSelection.remove(unitId)
         msg = cmessages.MarkUnitSelected(unitId, False)
-        self.graphicsInterface.backendMessage(msg.serialize())
+        self.graphicsInterface.backendMessage(msg)
 
     def clearSelection(self):
         for unitId in self.unitSelection:
             msg = cmessages.MarkUnitSelected(unitId, False)
-            self.graphicsInterface.backendMessage(msg.serialize())
+            self.graphicsInterface.backendMessage(msg)
         self.unitSelection = UnitSet()
 
+
+class SnapshotParts(object):
+    """
+    The pieces of a serialized snapshot (the map, or the simulation state)
+    that have arrived so far; see Backend.collectSnapshotPart.
+    """
+
+    def __init__(self, description):
+        super(SnapshotParts, self).__init__()
+        # What this is a snapshot of, for logging.
+        self.description = description
+        self.pieces      = []
+        self.received    = 0
+
+
+class LocalSimulationListener(object):
+    """
+    Listens to the Simulation when the client runs it itself (in lockstep
+    mode), passing the changes on to the graphics interface, the way the
+    server's ConnectionManager would send them over the network.
+    """
+
+    def __init__(self, backend):
+        super(LocalSimulationListener, self).__init__()
+        self.backend = backend
+
+    def unitCreated(self, unitId, traceId=None):
+        pos = self.backend.gameState.getPos(unitId)
+        self.forward(messages.NewObelisk(unitId, pos, traceId))
+
+    def unitDeleted(self, unitId):
+        if unitId in self.backend.unitSelection:
+            self.backend.removeFromSelection(unitId)
+        self.forward(messages.DeleteObelisk(unitId))
+
+    def unitMoved(self, unitId, traceId=None):
+        pos = self.backend.gameState.getPos(unitId)
+        self.forward(messages.SetPos(unitId, pos, traceId))
+
+    def resourcesChanged(self, playerId, amount):
+        if playerId == self.backend.myId:
+            self.forward(messages.ResourceAmt(amount))
+
+    def forward(self, message):
+        self.backend.graphicsInterface.backendMessage(message)
+
 # TODO: Shouldn't these be in the GraphicsInterface if they're going to be
 # with a single component?
 def worldToGraphicsPos(wPos):
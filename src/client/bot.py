@@ -0,0 +1,184 @@
+"""
+A scripted player, for running clients without Panda3D.
+
+A Bot takes the place of the graphics interface: it's sent everything the
+backend would have had drawn, and instead of the user clicking on things, it
+sends the backend the same messages the graphics would, on a timer. Every so
+often it spawns a unit, box-selects some of its units, orders them to move,
+or deletes one, so the server sees the same kind of traffic a real player
+generates.
+
+Each bot traces its orders (see src.shared.tracing), so that the load tester
+can report how long the server takes to respond.
+"""
+
+import random
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from src.client.backend import worldToGraphicsPos
+from src.client import messages as cmessages
+from src.shared import config
+from src.shared.geometry import Coord
+from src.shared.ident import unitToPlayer
+from src.shared.logconfig import newLogger
+from src.shared import messages
+from src.shared.tracing import Tracer, CLIENT_STAGES
+
+log = newLogger(__name__)
+
+# Default number of seconds between a bot's actions.
+DEFAULT_ACTION_INTERVAL = 0.5
+
+# A bot keeps spawning units until it has this many.
+TARGET_UNITS = 8
+
+# Relative likelihood of each action, once a bot has enough units.
+ACTION_WEIGHTS = (
+    ("select", 3),
+    ("move",   5),
+    ("delete", 1),
+    ("spawn",  1),
+)
+
+# Half the side length of the box used to select units, in unit coordinates.
+SELECT_BOX_RADIUS = 2 * config.BUILD_SIZE
+
+# Types of the messages a bot looks inside of. Everything else it's sent is
+# just counted.
+TRACED_TYPES = (messages.SetPos, messages.NewObelisk)
+
+
+class Bot(object):
+    def __init__(self, backend, actionInterval=DEFAULT_ACTION_INTERVAL,
+                 seed=None, clock=None):
+        super(Bot, self).__init__()
+
+        self.backend        = backend
+        self.actionInterval = actionInterval
+        self.random         = random.Random(seed)
+        self.clock          = reactor if clock is None else clock
+        self.loop           = None
+
+        # Counts of what we've done and been sent.
+        self.actionCounts     = dict((action, 0)
+                                     for action, _ in ACTION_WEIGHTS)
+        self.messagesReceived = 0
+        self.ticksSeen        = 0
+
+        # Trace our orders, even if the client wasn't asked to write the
+        # traces anywhere.
+        if self.backend.tracer is None:
+            self.backend.setTracer(Tracer(CLIENT_STAGES))
+        self.backend.graphicsInterfaceReady(self)
+
+    @property
+    def tracer(self):
+        return self.backend.tracer
+
+    def start(self):
+        self.loop = LoopingCall(self.act)
+        self.loop.clock = self.clock
+        # Start at a random point in the interval, so that a crowd of bots
+        # doesn't act in lockstep.
+        self.clock.callLater(self.random.uniform(0, self.actionInterval),
+                             self.loop.start, self.actionInterval)
+
+    def cleanup(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    ########################################################################
+    # Stands in for the GraphicsInterface
+
+    def backendMessage(self, message):
+        self.messagesReceived += 1
+        if isinstance(message, messages.Tick):
+            self.ticksSeen += 1
+        elif isinstance(message, TRACED_TYPES):
+            self.backend.traceReached(message.traceId, "render",
+                                      message.unitId)
+
+    ########################################################################
+    # Acting
+
+    @property
+    def ready(self):
+        backend = self.backend
+        return backend.allReady and backend.myId >= 0 and \
+            backend.gameState.hasSize
+
+    def myUnits(self):
+        backend = self.backend
+        return [unitId for unitId in backend.gameState.positions
+                if unitToPlayer(unitId) == backend.myId]
+
+    def act(self):
+        if not self.ready:
+            return
+
+        units = self.myUnits()
+        if len(units) < TARGET_UNITS:
+            action = "spawn"
+        else:
+            action = self.chooseAction()
+        self.actionCounts[action] += 1
+
+        if action == "spawn":
+            self.click(cmessages.ShiftRClick(self.randomGraphicsPos()))
+        elif action == "select":
+            self.selectAround(self.random.choice(units))
+        elif action == "move":
+            if not self.backend.unitSelection:
+                self.selectAround(self.random.choice(units))
+            self.click(cmessages.Click(3, self.randomGraphicsPos()))
+        elif action == "delete":
+            pos = self.backend.gameState.positions[self.random.choice(units)]
+            self.click(cmessages.ControlRClick(worldToGraphicsPos(pos)))
+
+    def chooseAction(self):
+        choice = self.random.uniform(0, sum(weight
+                                            for _, weight in ACTION_WEIGHTS))
+        for action, weight in ACTION_WEIGHTS:
+            choice -= weight
+            if choice <= 0:
+                return action
+        return ACTION_WEIGHTS[-1][0]
+
+    def selectAround(self, unitId):
+        ux, uy = self.backend.gameState.positions[unitId].unit
+        corner1 = Coord.fromUnit((ux - SELECT_BOX_RADIUS,
+                                  uy - SELECT_BOX_RADIUS))
+        corner2 = Coord.fromUnit((ux + SELECT_BOX_RADIUS,
+                                  uy + SELECT_BOX_RADIUS))
+        self.click(cmessages.DragBox(worldToGraphicsPos(corner1),
+                                     worldToGraphicsPos(corner2)))
+
+    def click(self, message):
+        self.backend.graphicsMessage(message)
+
+    def randomGraphicsPos(self):
+        gameState = self.backend.gameState
+        width, height = gameState.sizeInChunks
+        while True:
+            pos = Coord.fromUnit((
+                self.random.randrange(width  * config.CHUNK_SIZE),
+                self.random.randrange(height * config.CHUNK_SIZE),
+            ))
+            if gameState.isPassable(pos):
+                return worldToGraphicsPos(pos)
+
+
+class NoStdio(object):
+    """
+    Fills the backend's stdio slot for clients that don't have a console,
+    such as the many bots run by the load tester.
+    """
+
+    def __init__(self, backend):
+        super(NoStdio, self).__init__()
+        backend.stdioReady(self)
+
+    def cleanup(self):
+        pass
@@ -1,6 +1,7 @@
 import math
 import os
 import sys
+import time
 
 from direct.task import Task  # This must be imported first.
 from direct.actor.Actor import Actor
@@ -13,8 +14,7 @@ from panda3d.core import Point2, Point3, Mat4, Filename, LineSegs, \
 from src.shared import config
 from src.shared import messages
 from src.shared.logconfig import newLogger
-from src.shared.message_infrastructure import deserializeMessage, \
-    badIMessageCommand
+from src.shared.message_infrastructure import badIMessageCommand
 from src.shared.utils import minmax, thisShouldNeverHappen, thisIsNotHandled
 from src.client import messages as cmessages
 
@@ -28,6 +28,10 @@ DESIRED_FPS = 60
 # region. Note that half of the region is on each side.
 EDGE_SCROLL_WIDTH = 0.2
 
+# Minimum time (in seconds) between reports of the visible area to the
+# server, so that scrolling doesn't flood it with viewport updates.
+VIEWPORT_REPORT_INTERVAL = 0.5
+
 
 class WartsApp(ShowBase):
     """
@@ -63,6 +67,10 @@ class WartsApp(ShowBase):
         self.usingCustomCamera = True
         self.setCameraCustom()
 
+        # The last viewport we told the backend about, and when.
+        self.prevViewport = None
+        self.prevViewportTime = None
+
         self.prevMousePos = None
         self.selectionBox = None
         self.selectionBoxNode = None
@@ -80,10 +88,9 @@ class WartsApp(ShowBase):
     def cleanup(self):
         pass
 
-    def interfaceMessage(self, data):
-        # Messages from GraphicsInterface to Graphics are always internal
-        # client messages, so no need to catch InvalidMessageError.
-        message = deserializeMessage(data)
+    def interfaceMessage(self, message):
+        # Messages from GraphicsInterface to Graphics are Message objects
+        # (mostly src.client.messages), passed as they are.
         if isinstance(message, messages.Tick):
             pass
         elif isinstance(message, cmessages.AddEntity):
@@ -436,8 +443,41 @@ class WartsApp(ShowBase):
         rotate = rotateSpeed * (self.keys["a"] - self.keys["d"])
         self.cameraHolder.setHpr(self.cameraHolder, rotate, 0, 0)
 
+        self.reportViewport()
+
         return Task.cont
 
+    def reportViewport(self):
+        """
+        Tell the backend which part of the ground is visible, if it has
+        changed and we haven't done so too recently.
+        """
+
+        now = self.globalClock.getFrameTime()
+        if self.prevViewportTime is not None and \
+                now - self.prevViewportTime < VIEWPORT_REPORT_INTERVAL:
+            return
+
+        groundPoints = []
+        for screenCoord in [(-1, -1), (-1, 1), (1, -1), (1, 1)]:
+            point = self.groundPointAt(screenCoord)
+            if point is None:
+                # Part of the screen is looking at the sky, so we can't bound
+                # the visible area. Leave the old viewport in place.
+                return
+            groundPoints.append(point)
+
+        xs = [gPos[0] for gPos in groundPoints]
+        ys = [gPos[1] for gPos in groundPoints]
+        viewport = ((min(xs), min(ys)), (max(xs), max(ys)))
+        if viewport == self.prevViewport:
+            return
+
+        self.prevViewport = viewport
+        self.prevViewportTime = now
+        message = cmessages.ReportViewport(*viewport)
+        self.graphicsInterface.graphicsMessage(message)
+
     def zoomCamera(self, inward):
         """
         Zoom in or out.
@@ -455,7 +495,7 @@ class WartsApp(ShowBase):
         """
 
         message = cmessages.RequestCenter()
-        self.graphicsInterface.graphicsMessage(message.serialize())
+        self.graphicsInterface.graphicsMessage(message)
 
     # We don't use task, but we can't remove it because the function signature
     # is from Panda3D.
@@ -525,26 +565,27 @@ class WartsApp(ShowBase):
         # Make sure the mouse is inside the screen
         # TODO: Move this check to pandaEventMouseUp?
         if self.mouseWatcherNode.hasMouse() and self.usingCustomCamera:
+            clickTime = time.time()
             x, y, _z = self.coordScreenTo3d(pos)
 
             if modifiers == []:
                 # TODO: This component should take care of decoding the
                 # click as far as "left" or "right"; we shouldn't send a
                 # numerical button id to the graphicsInterface.
-                message = cmessages.Click(button, (x, y))
+                message = cmessages.Click(button, (x, y), clickTime)
             elif button == 1 and modifiers == ["shift"]:
                 message = cmessages.ShiftLClick((x, y))
             elif button == 1 and modifiers == ["control"]:
                 message = cmessages.ControlLClick((x, y))
             elif button == 3 and modifiers == ["shift"]:
-                message = cmessages.ShiftRClick((x, y))
+                message = cmessages.ShiftRClick((x, y), clickTime)
             elif button == 3 and modifiers == ["control"]:
                 message = cmessages.ControlRClick((x, y))
             else:
                 thisShouldNeverHappen(
                     "Unhandled modifiers for click: {}".format(modifiers))
 
-            self.graphicsInterface.graphicsMessage(message.serialize())
+            self.graphicsInterface.graphicsMessage(message)
 
     def handleMouseDragStart(self, buttonId, modifiers, startPos, endPos):
         log.debug("Start dragging from %s to %s", startPos, endPos)
@@ -573,7 +614,7 @@ class WartsApp(ShowBase):
             # remove the z coordinates everywhere.
             message = cmessages.DragBox(self.selectionBoxOrigin[:2],
                                         endPos[:2])
-            self.graphicsInterface.graphicsMessage(message.serialize())
+            self.graphicsInterface.graphicsMessage(message)
             # Clear the selection box; we're done dragging.
             self.selectionBoxOrigin = None
             self.removeSelectionBox()
@@ -600,7 +641,7 @@ class WartsApp(ShowBase):
     def handleWindowClose(self):
         log.info("Window close requested -- shutting down client.")
         message = cmessages.RequestQuit()
-        self.graphicsInterface.graphicsMessage(message.serialize())
+        self.graphicsInterface.graphicsMessage(message)
 
     def setupEventHandlers(self):
         def pushKey(key, value):
@@ -664,6 +705,23 @@ class WartsApp(ShowBase):
         return (x, y)
 
     def coordScreenTo3d(self, screenCoord):
+        point = self.groundPointAt(screenCoord)
+        if point is not None:
+            return point
+
+        # The ray didn't intersect the ground. This is almost certainly going
+        # to happen at some point; all you have to do is find a way to aim the
+        # camera (or manipulate the screen coordinate) so that the ray points
+        # horizontally. But we don't have code to handle it, so for now just
+        # abort.
+        thisIsNotHandled()
+
+    def groundPointAt(self, screenCoord):
+        """
+        Return the point on the ground under the given screen coordinate, or
+        None if the ray from the camera through that point misses the ground.
+        """
+
         x, y = screenCoord
         screenPoint = Point2(x, y)
 
@@ -692,12 +750,7 @@ class WartsApp(ShowBase):
             x, y, z = intersection
             return (x, y, z)
 
-        # The ray didn't intersect the ground. This is almost certainly going
-        # to happen at some point; all you have to do is find a way to aim the
-        # camera (or manipulate the screen coordinate) so that the ray points
-        # horizontally. But we don't have code to handle it, so for now just
-        # abort.
-        thisIsNotHandled()
+        return None
 
 
 class Entity(object):
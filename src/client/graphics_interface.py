@@ -1,14 +1,18 @@
 from src.shared import messages
-from src.shared.geometry import Distance
+from src.shared.geometry import Coord, Distance
 from src.shared.ident import unitToPlayer
 from src.shared.logconfig import newLogger
-from src.shared.message_infrastructure import deserializeMessage, \
-    badEMessageArgument, InvalidMessageError, badIMessageCommand
+from src.shared.message_dispatch import MessageHandlers
+from src.shared.message_infrastructure import badEMessageArgument, \
+    badIMessageCommand
 from src.client.backend import worldToGraphicsPos, worldToGraphicsDist
 from src.client import messages as cmessages
 
 log = newLogger(__name__)
 
+# Handlers for messages from the backend.
+backendHandlers = MessageHandlers()  # pylint: disable=invalid-name
+
 
 class GraphicsInterface(object):
     def __init__(self, backend):
@@ -24,6 +28,8 @@ class GraphicsInterface(object):
         # Mapping from unit ids to graphics ids.
         self.uidToGid = {}
 
+        self.dispatcher = backendHandlers.bind(self, self.unhandledMessage)
+
     # Red A5, standing by.
     def graphicsReady(self, graphicsComponent):
         assert self.graphics is None
@@ -32,166 +38,216 @@ class GraphicsInterface(object):
         self.ready = True
         self.backend.graphicsInterfaceReady(self)
 
-    # TODO: Split this function up; it's gotten too big.
-    def backendMessage(self, data):
-        try:
-            message = deserializeMessage(data)
-            if isinstance(message, messages.Tick):
-                self.graphics.interfaceMessage(data)
-            elif isinstance(message, messages.YourIdIs):
-                # TODO: This should never happen, because the backend already
-                # did the same check.
-                if self.myId >= 0:
-                    raise RuntimeError("ID already set; can't change it now.")
-                self.myId          = message.playerId
-            elif isinstance(message, messages.NewObelisk):
-                uid  = message.unitId
-                wPos = message.pos
-
-                gid  = self.getNextGid()
-                gPos = worldToGraphicsPos(wPos)
-
-                if uid in self.uidToGid:
-                    # TODO: The backend no longer forwards unvalidated server
-                    # messages to the graphics interface, so if there's a
-                    # problem in one of its messages then we should really
-                    # handle it like a bad message from an internal source.
-                    # The same goes for other messages below.
-                    badEMessageArgument(
-                        message, log,
-                        reason="uid {} already corresponds to gid {}".format(
-                            uid, gid
-                        )
-                    )
-                    # This is probably a bug on our end, so maybe we shouldn't
-                    # drop the message. Instead, it would make sense to just
-                    # assign that uid a new gid and add it to the graphics.
-                    # But that would probably leave the old gid orphaned, with
-                    # no way to ever remove it. So for now, drop the message.
-                    return
-                self.uidToGid[uid] = gid
-
-                # TODO: Long-term, we need to just get rid of this logic
-                # entirely. Need a real way of distinguishing my units from
-                # other players' units.
-                if unitToPlayer(uid) == self.myId:
-                    isExample = True
-                    modelPath = "models/panda-model"
-                else:
-                    isExample = False
-                    modelPath = "other-obelisk.egg"
-
-                # TODO[#3]: Magic numbers bad
-                goalUSize = Distance.fromCBU(build=(1,1))
-
-                # TODO[#70]: Organize all the coordinate conversion functions.
-                # Make sure we have functions to convert both positions and
-                # sizes. Actually use one of those functions here.
-                goalGSize = worldToGraphicsDist(goalUSize)
-
-                gMessage = cmessages.AddEntity(gid, gPos, isExample, True,
-                                               goalGSize, modelPath)
-                self.graphics.interfaceMessage(gMessage.serialize())
-            elif isinstance(message, messages.GroundInfo):
-                wPos        = message.pos.truncToChunk
-                terrainType = message.terrainType
-
-                if terrainType == 0:
-                    modelName = "green-ground.egg"
-                elif terrainType == 1:
-                    modelName = "red-ground.egg"
-                else:
-                    badEMessageArgument(message, log,
-                                        reason="Invalid terrain type")
-                    return
-
-                gid  = self.getNextGid()
-
-                gPos1 = worldToGraphicsPos(wPos)
-                gPos2 = worldToGraphicsPos(wPos +
-                                           Distance.fromCBU(chunk=(1,1)))
-
-                # Figure out where we want the tile.
-                goalCenterX = 0.5 * (gPos2[0] + gPos1[0])
-                goalCenterY = 0.5 * (gPos2[1] + gPos1[1])
-                goalWidthX  =    abs(gPos2[0] - gPos1[0])
-                goalWidthY  =    abs(gPos2[1] - gPos1[1])
-
-                gPos      = (goalCenterX, goalCenterY)
-                goalGSize = (goalWidthX,  goalWidthY)
-
-                gMessage = cmessages.AddEntity(gid, gPos, False, False,
-                                               goalGSize, modelName)
-                self.graphics.interfaceMessage(gMessage.serialize())
-            elif isinstance(message, messages.DeleteObelisk):
-                uid = message.unitId
-
-                if uid not in self.uidToGid:
-                    badEMessageArgument(
-                        message, log,
-                        reason="No graphical entity for uid {}".format(uid)
-                    )
-                    return
-                gid = self.uidToGid.pop(uid)
-
-                gMessage = cmessages.RemoveEntity(gid)
-                self.graphics.interfaceMessage(gMessage.serialize())
-            elif isinstance(message, messages.SetPos):
-                uid  = message.unitId
-                wPos = message.pos
-
-                if uid not in self.uidToGid:
-                    badEMessageArgument(
-                        message, log,
-                        reason="No graphical entity for uid {}".format(uid)
-                    )
-                    return
-                gid = self.uidToGid[uid]
-
-                gPos = worldToGraphicsPos(wPos)
-
-                gMessage = cmessages.MoveEntity(gid, gPos)
-                self.graphics.interfaceMessage(gMessage.serialize())
-            elif isinstance(message, messages.ResourceAmt):
-                gMessage = cmessages.DisplayResources(message.amount)
-                self.graphics.interfaceMessage(gMessage.serialize())
-            elif isinstance(message, messages.ResourceLoc):
-                wPos = message.pos.truncToBuild
-                modelName = "resource-pool.egg"
-                gid  = self.getNextGid()
-
-                gPos1 = worldToGraphicsPos(wPos)
-                gPos2 = worldToGraphicsPos(wPos +
-                                           Distance.fromCBU(build=(1,1)))
-
-                # Figure out where we want the tile.
-                goalCenterX = 0.5 * (gPos2[0] + gPos1[0])
-                goalCenterY = 0.5 * (gPos2[1] + gPos1[1])
-                goalWidthX  =    abs(gPos2[0] - gPos1[0])
-                goalWidthY  =    abs(gPos2[1] - gPos1[1])
-
-                gPos      = (goalCenterX, goalCenterY)
-                goalGSize = (goalWidthX,  goalWidthY)
-
-                gMessage = cmessages.AddEntity(gid, gPos, False, False,
-                                               goalGSize, modelName)
-                self.graphics.interfaceMessage(gMessage.serialize())
-            elif isinstance(message, cmessages.MarkUnitSelected):
-                uid = message.unitId
-                gid = self.uidToGid[uid]
-                msg = cmessages.MarkEntitySelected(gid, message.isSelected)
-                self.graphics.interfaceMessage(msg.serialize())
-            else:
-                badIMessageCommand(message, log)
-        except InvalidMessageError:
-            # TODO: Either use illFormedIMessage (if we add it) or just remove
-            # the try/except.
-            raise
-
-    def graphicsMessage(self, messageStr):
+    def backendMessage(self, message):
+        """
+        Handle a message (a Message object) from the backend. These are never
+        serialized, since they don't leave the process.
+        """
+
+        self.dispatcher.dispatch(message)
+
+    def unhandledMessage(self, message):
+        badIMessageCommand(message, log)
+
+    @backendHandlers.handles(messages.Tick)
+    def handleTick(self, message):
+        self.graphics.interfaceMessage(message)
+
+    @backendHandlers.handles(messages.YourIdIs)
+    def handleYourIdIs(self, message):
+        # TODO: This should never happen, because the backend already did the
+        # same check.
+        if self.myId >= 0:
+            raise RuntimeError("ID already set; can't change it now.")
+        self.myId = message.playerId
+
+    @backendHandlers.handles(messages.NewObelisk)
+    def handleNewObelisk(self, message):
+        self.addUnit(message.unitId, message.pos, message)
+        self.backend.traceReached(message.traceId, "render", message.unitId)
+
+    @backendHandlers.handles(messages.UnitSnapshot)
+    def handleUnitSnapshot(self, message):
+        for uid, wPos in message.units:
+            self.addUnit(uid, wPos, message)
+
+    @backendHandlers.handles(messages.GroundInfo)
+    def handleGroundInfo(self, message):
+        self.addGround(message.pos.truncToChunk, message.terrainType, message)
+
+    @backendHandlers.handles(messages.MapSnapshot)
+    def handleMapSnapshot(self, message):
+        contents = message.contents
+        for cx, column in enumerate(contents.groundTypes):
+            for cy, terrainType in enumerate(column):
+                wPos = Coord.fromCBU(chunk=(cx, cy))
+                self.addGround(wPos, terrainType, message)
+        for wPos in contents.resourcePools:
+            self.addResourcePool(wPos.truncToBuild)
+
+    @backendHandlers.handles(messages.DeleteObelisk)
+    def handleDeleteObelisk(self, message):
+        uid = message.unitId
+
+        if uid not in self.uidToGid:
+            badEMessageArgument(
+                message, log,
+                reason="No graphical entity for uid {}".format(uid)
+            )
+            return
+        gid = self.uidToGid.pop(uid)
+
+        gMessage = cmessages.RemoveEntity(gid)
+        self.graphics.interfaceMessage(gMessage)
+
+    @backendHandlers.handles(messages.SetPos)
+    def handleSetPos(self, message):
+        uid  = message.unitId
+        wPos = message.pos
+
+        if uid not in self.uidToGid:
+            badEMessageArgument(
+                message, log,
+                reason="No graphical entity for uid {}".format(uid)
+            )
+            return
+        gid = self.uidToGid[uid]
+
+        gPos = worldToGraphicsPos(wPos)
+
+        gMessage = cmessages.MoveEntity(gid, gPos)
+        self.graphics.interfaceMessage(gMessage)
+        self.backend.traceReached(message.traceId, "render", uid)
+
+    @backendHandlers.handles(messages.ResourceAmt)
+    def handleResourceAmt(self, message):
+        gMessage = cmessages.DisplayResources(message.amount)
+        self.graphics.interfaceMessage(gMessage)
+
+    @backendHandlers.handles(messages.ResourceLoc)
+    def handleResourceLoc(self, message):
+        self.addResourcePool(message.pos.truncToBuild)
+
+    @backendHandlers.handles(cmessages.MarkUnitSelected)
+    def handleMarkUnitSelected(self, message):
+        uid = message.unitId
+        gid = self.uidToGid[uid]
+        msg = cmessages.MarkEntitySelected(gid, message.isSelected)
+        self.graphics.interfaceMessage(msg)
+
+    def addUnit(self, uid, wPos, message):
+        """
+        Add a graphical entity for a unit. message is the message that told us
+        about the unit, used for error reporting.
+        """
+
+        gid  = self.getNextGid()
+        gPos = worldToGraphicsPos(wPos)
+
+        if uid in self.uidToGid:
+            # TODO: The backend no longer forwards unvalidated server
+            # messages to the graphics interface, so if there's a problem in
+            # one of its messages then we should really handle it like a bad
+            # message from an internal source. The same goes for other
+            # messages in backendMessage.
+            badEMessageArgument(
+                message, log,
+                reason="uid {} already corresponds to gid {}".format(
+                    uid, gid
+                )
+            )
+            # This is probably a bug on our end, so maybe we shouldn't drop
+            # the message. Instead, it would make sense to just assign that
+            # uid a new gid and add it to the graphics. But that would
+            # probably leave the old gid orphaned, with no way to ever remove
+            # it. So for now, drop the message.
+            return
+        self.uidToGid[uid] = gid
+
+        # TODO: Long-term, we need to just get rid of this logic entirely.
+        # Need a real way of distinguishing my units from other players'
+        # units.
+        if unitToPlayer(uid) == self.myId:
+            isExample = True
+            modelPath = "models/panda-model"
+        else:
+            isExample = False
+            modelPath = "other-obelisk.egg"
+
+        # TODO[#3]: Magic numbers bad
+        goalUSize = Distance.fromCBU(build=(1,1))
+
+        # TODO[#70]: Organize all the coordinate conversion functions. Make
+        # sure we have functions to convert both positions and sizes.
+        # Actually use one of those functions here.
+        goalGSize = worldToGraphicsDist(goalUSize)
+
+        gMessage = cmessages.AddEntity(gid, gPos, isExample, True,
+                                       goalGSize, modelPath)
+        self.graphics.interfaceMessage(gMessage)
+
+    def addGround(self, wPos, terrainType, message):
+        """
+        Add a graphical entity for the chunk whose southwest corner is at
+        wPos. message is the message that told us about the chunk, used for
+        error reporting.
+        """
+
+        if terrainType == 0:
+            modelName = "green-ground.egg"
+        elif terrainType == 1:
+            modelName = "red-ground.egg"
+        else:
+            badEMessageArgument(message, log, reason="Invalid terrain type")
+            return
+
+        gid  = self.getNextGid()
+
+        gPos1 = worldToGraphicsPos(wPos)
+        gPos2 = worldToGraphicsPos(wPos + Distance.fromCBU(chunk=(1,1)))
+
+        # Figure out where we want the tile.
+        goalCenterX = 0.5 * (gPos2[0] + gPos1[0])
+        goalCenterY = 0.5 * (gPos2[1] + gPos1[1])
+        goalWidthX  =    abs(gPos2[0] - gPos1[0])
+        goalWidthY  =    abs(gPos2[1] - gPos1[1])
+
+        gPos      = (goalCenterX, goalCenterY)
+        goalGSize = (goalWidthX,  goalWidthY)
+
+        gMessage = cmessages.AddEntity(gid, gPos, False, False,
+                                       goalGSize, modelName)
+        self.graphics.interfaceMessage(gMessage)
+
+    def addResourcePool(self, wPos):
+        """
+        Add a graphical entity for the resource pool whose southwest corner is
+        at wPos.
+        """
+
+        modelName = "resource-pool.egg"
+        gid  = self.getNextGid()
+
+        gPos1 = worldToGraphicsPos(wPos)
+        gPos2 = worldToGraphicsPos(wPos + Distance.fromCBU(build=(1,1)))
+
+        # Figure out where we want the tile.
+        goalCenterX = 0.5 * (gPos2[0] + gPos1[0])
+        goalCenterY = 0.5 * (gPos2[1] + gPos1[1])
+        goalWidthX  =    abs(gPos2[0] - gPos1[0])
+        goalWidthY  =    abs(gPos2[1] - gPos1[1])
+
+        gPos      = (goalCenterX, goalCenterY)
+        goalGSize = (goalWidthX,  goalWidthY)
+
+        gMessage = cmessages.AddEntity(gid, gPos, False, False,
+                                       goalGSize, modelName)
+        self.graphics.interfaceMessage(gMessage)
+
+    def graphicsMessage(self, message):
         # TODO: Actually handle things here, and abstract them a little better
         # before sending them to the backend.
-        self.backend.graphicsMessage(messageStr)
+        self.backend.graphicsMessage(message)
 
     def cleanup(self):
         self.graphics.cleanup()
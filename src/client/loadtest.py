@@ -0,0 +1,202 @@
+"""
+Load generator: connects many bots (see src.client.bot) to a server and
+reports how quickly it responds to their orders and whether it keeps up.
+
+All the bots in a process share one reactor. With --processes, the bots are
+split between that many worker processes, each a separate `warts loadtest
+--worker` that prints its results as JSON for the parent to combine. (The
+workers are started fresh rather than forked, since a forked child would
+share the parent's reactor.)
+
+The main figures reported are:
+  - the send -> receive latency of the bots' traced orders, which is the
+    server's response time (including waiting for the next tick), plus the
+    network round trip
+  - orders sent and answered per second
+  - the rate at which each bot sees ticks, which drops below 1 /
+    TICK_LENGTH if the server falls behind
+"""
+
+from collections import OrderedDict
+import json
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+from src.client.backend import Backend
+from src.client.bot import Bot, NoStdio
+from src.client.networking import setupNetworking
+from src.shared import config
+from src.shared.logconfig import newLogger
+from src.shared.tracing import LatencyHistogram, histogramReportLines
+
+log = newLogger(__name__)
+
+# Seconds between starting successive bots, so that hundreds of them don't
+# all try to connect at once.
+CONNECT_INTERVAL = 0.01
+
+
+class LoadTestResults(object):
+    def __init__(self):
+        super(LoadTestResults, self).__init__()
+
+        self.bots             = 0
+        # Bots that connected and got the map.
+        self.readyBots        = 0
+        self.elapsed          = 0.0
+        self.ordersSent       = 0
+        self.ordersAnswered   = 0
+        self.ticksSeen        = 0
+        self.messagesReceived = 0
+        # Mapping from "<stage>-><stage>" to LatencyHistogram, combined over
+        # all the bots.
+        self.histograms       = OrderedDict()
+
+    @classmethod
+    def fromBots(cls, bots, elapsed):
+        results = cls()
+        results.bots    = len(bots)
+        results.elapsed = elapsed
+        for bot in bots:
+            tracer = bot.tracer
+            results.readyBots        += 1 if bot.ready else 0
+            results.ordersSent       += tracer.finished + tracer.expired + \
+                len(tracer.active)
+            results.ordersAnswered   += tracer.finished
+            results.ticksSeen        += bot.ticksSeen
+            results.messagesReceived += bot.messagesReceived
+            for name, histogram in tracer.histograms.iteritems():
+                results.histogram(name).merge(histogram)
+        return results
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = LatencyHistogram()
+        return self.histograms[name]
+
+    def merge(self, other):
+        self.bots             += other.bots
+        self.readyBots        += other.readyBots
+        self.elapsed           = max(self.elapsed, other.elapsed)
+        self.ordersSent       += other.ordersSent
+        self.ordersAnswered   += other.ordersAnswered
+        self.ticksSeen        += other.ticksSeen
+        self.messagesReceived += other.messagesReceived
+        for name, histogram in other.histograms.iteritems():
+            self.histogram(name).merge(histogram)
+
+    def toJson(self):
+        desc = dict((name, getattr(self, name))
+                    for name in ("bots", "readyBots", "elapsed", "ordersSent",
+                                 "ordersAnswered", "ticksSeen",
+                                 "messagesReceived"))
+        desc["histograms"] = [(name, histogram.toDict())
+                              for name, histogram
+                              in self.histograms.iteritems()]
+        return json.dumps(desc)
+
+    @classmethod
+    def fromJson(cls, data):
+        desc = json.loads(data)
+        results = cls()
+        for name, value in desc.iteritems():
+            if name != "histograms":
+                setattr(results, name, value)
+        for name, histogramDesc in desc["histograms"]:
+            results.histograms[name] = \
+                LatencyHistogram.fromDict(histogramDesc)
+        return results
+
+    def reportLines(self):
+        elapsed = max(self.elapsed, 1e-9)
+        lines = [
+            "{} of {} bots got into the game; ran for {:.1f} seconds."
+            .format(self.readyBots, self.bots, self.elapsed),
+            "Orders: {} sent ({:.1f}/s), {} answered ({:.1f}/s).".format(
+                self.ordersSent, self.ordersSent / elapsed,
+                self.ordersAnswered, self.ordersAnswered / elapsed
+            ),
+            "Each bot saw {:.1f} ticks/s on average (the server runs {:.1f})."
+            .format(self.ticksSeen / elapsed / max(1, self.readyBots),
+                    1 / config.TICK_LENGTH),
+            "Received {:.1f} updates/s per bot.".format(
+                self.messagesReceived / elapsed / max(1, self.readyBots)
+            ),
+            "Order latency (send->receive is the server's response time):",
+        ]
+        return lines + histogramReportLines(self.histograms)
+
+
+def runBots(host, port, numBots, duration, actionInterval, udp=False,
+            seed=None):
+    """
+    Run numBots bots against the server for duration seconds (after they've
+    all been started), and return a LoadTestResults.
+    """
+
+    bots = []
+
+    def startBot(index):
+        backend = Backend(Deferred())
+        NoStdio(backend)
+        bot = Bot(backend, actionInterval,
+                  seed=None if seed is None else seed + index)
+        setupNetworking(reactor, backend, host, port, udp=udp)
+        bot.start()
+        bots.append(bot)
+
+    for index in range(numBots):
+        reactor.callLater(index * CONNECT_INTERVAL, startBot, index)
+    reactor.callLater(numBots * CONNECT_INTERVAL + duration, reactor.stop)
+
+    startTime = time.time()
+    reactor.run()
+    return LoadTestResults.fromBots(bots, time.time() - startTime)
+
+
+def startWorker(args, numBots, seed):
+    command = [sys.executable, "-m", "src.main", "loadtest", "--worker",
+               "--host", args.host, "--port", str(args.port),
+               "--bots", str(numBots), "--duration", str(args.duration),
+               "--interval", str(args.interval)]
+    if args.udp:
+        command.append("--udp")
+    if seed is not None:
+        command.extend(["--seed", str(seed)])
+    return subprocess.Popen(command, stdout=subprocess.PIPE)
+
+
+def main(args):
+    if args.worker or args.processes <= 1:
+        results = runBots(args.host, int(args.port), args.bots,
+                          args.duration, args.interval, udp=args.udp,
+                          seed=args.seed)
+        if args.worker:
+            print results.toJson()
+            return
+    else:
+        log.info("Starting %d bots in %d processes...", args.bots,
+                 args.processes)
+        workers = []
+        for index in range(args.processes):
+            numBots = args.bots // args.processes + \
+                (1 if index < args.bots % args.processes else 0)
+            seed = None if args.seed is None else \
+                args.seed + index * args.bots
+            workers.append(startWorker(args, numBots, seed))
+
+        results = LoadTestResults()
+        for worker in workers:
+            output, _ = worker.communicate()
+            if worker.returncode != 0:
+                log.error("A worker process failed (exit status %d).",
+                          worker.returncode)
+                continue
+            results.merge(LoadTestResults.fromJson(output.splitlines()[-1]))
+
+    for line in results.reportLines():
+        log.info("%s", line)
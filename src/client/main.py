@@ -4,15 +4,13 @@ from twisted.internet.task import LoopingCall
 from twisted.python import log as twistedLog
 
 from src.shared.logconfig import newLogger
+from src.shared.tracing import Tracer, CLIENT_STAGES
 
 from src.client.graphics_interface import GraphicsInterface
 from src.client.backend     import Backend
+from src.client.bot         import Bot
 from src.client.networking  import setupNetworking
 from src.client.stdio       import setupStdio
-from src.client.graphics    import WartsApp    as OldWartsApp, \
-                                   DESIRED_FPS as OLD_DESIRED_FPS
-from src.client.newgraphics import WartsApp    as NewWartsApp, \
-                                   DESIRED_FPS as NEW_DESIRED_FPS
 
 log = newLogger(__name__)
 
@@ -33,16 +31,33 @@ def twistedMain(reactor, args):
     done = Deferred()
 
     backend = Backend(done)
-    graphicsInterface = GraphicsInterface(backend)
+    if args.trace is not None:
+        backend.setTracer(Tracer(CLIENT_STAGES, open(args.trace, "w")))
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      backend.stopTracing)
     setupStdio(backend)
-    setupNetworking(reactor, backend, args.host, args.port)
-    # TODO: Create gamestate here, pass it to both backend and (new) graphics.
-    setupGraphics(reactor, graphicsInterface, backend, backend.gameState,
-                  args.new_graphics)
+    setupNetworking(reactor, backend, args.host, args.port, udp=args.udp)
+    if args.bot:
+        # No graphics; a scripted bot plays instead.
+        log.info("Running headless, with a bot playing.")
+        bot = Bot(backend)
+        bot.start()
+    else:
+        graphicsInterface = GraphicsInterface(backend)
+        # TODO: Create gamestate here, pass it to both backend and (new)
+        # graphics.
+        setupGraphics(reactor, graphicsInterface, backend, backend.gameState,
+                      args.new_graphics)
 
     return done
 
 def setupGraphics(reactor, graphicsInterface, backend, gameState, isNew):
+    # These need Panda3D, which bots can do without.
+    from src.client.graphics    import WartsApp    as OldWartsApp, \
+                                       DESIRED_FPS as OLD_DESIRED_FPS
+    from src.client.newgraphics import WartsApp    as NewWartsApp, \
+                                       DESIRED_FPS as NEW_DESIRED_FPS
+
     # Pylint doesn't like this, but I don't see a better way.
     # pylint:disable=redefined-variable-type
     if isNew:
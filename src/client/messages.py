@@ -1,6 +1,7 @@
 from src.shared.message_infrastructure import defineMessageType, \
     ArgumentSpecification
-from src.shared.messages import BOOL_ARG, INT_ARG, FLOAT_PAIR_ARG, UNIT_ID_ARG
+from src.shared.messages import BOOL_ARG, INT_ARG, FLOAT_PAIR_ARG, \
+    UNIT_ID_ARG, parseFloat
 
 
 ###############################################################################
@@ -11,6 +12,11 @@ G_POS_ARG       = FLOAT_PAIR_ARG  # Graphics position
 
 MODEL_PATH_ARG  = ArgumentSpecification(1, str, unsafe=True)
 
+# When the user clicked (as from time.time), so that traced orders can be
+# timed from the input event rather than from when the backend got to them.
+# Left out if unknown.
+CLICK_TIME_ARG  = ArgumentSpecification(1, parseFloat, repr, optional=True)
+
 
 ###############################################################################
 # The messages themselves
@@ -28,13 +34,15 @@ CenterCamera       = defineMessageType("center_camera",
                                        [("pos", G_POS_ARG)])
 Click              = defineMessageType("click",
                                        [("button", INT_ARG),
-                                        ("pos", G_POS_ARG)])
+                                        ("pos", G_POS_ARG),
+                                        ("clickTime", CLICK_TIME_ARG)])
 ShiftLClick        = defineMessageType("shift_left_click",
                                        [("pos", G_POS_ARG)])
 ControlLClick      = defineMessageType("control_left_click",
                                        [("pos", G_POS_ARG)])
 ShiftRClick        = defineMessageType("shift_right_click",
-                                       [("pos", G_POS_ARG)])
+                                       [("pos", G_POS_ARG),
+                                        ("clickTime", CLICK_TIME_ARG)])
 ControlRClick      = defineMessageType("control_right_click",
                                        [("pos", G_POS_ARG)])
 DragBox            = defineMessageType("drag_box",
@@ -53,6 +61,9 @@ MoveEntity         = defineMessageType("move_entity",
                                         ("pos", G_POS_ARG)])
 RemoveEntity       = defineMessageType("remove_entity",
                                        [("gid", GRAPHICS_ID_ARG)])
+ReportViewport     = defineMessageType("report_viewport",
+                                       [("corner1", G_POS_ARG),
+                                        ("corner2", G_POS_ARG)])
 RequestCenter      = defineMessageType("request_center", [])
 RequestQuit        = defineMessageType("request_quit", [])
 
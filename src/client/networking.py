@@ -1,14 +1,36 @@
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ClientFactory, DatagramProtocol
 from twisted.protocols.basic import Int16StringReceiver
 
-from src.shared.logconfig import newLogger
+from src.shared import messages
+from src.shared.datagram import ReliableChannel, encodePacket, \
+    decodePacket, frameData, splitFrames, KIND_HELLO, KIND_RELIABLE, \
+    KIND_UNRELIABLE, KIND_ACK, KIND_UNRELIABLE_ACK, KIND_BYE, \
+    KIND_CHALLENGE, COOKIE_SIZE, RESEND_INTERVAL, KEEPALIVE_INTERVAL
+from src.shared.logconfig import newLogger, ThrottledLogger
+from src.shared.message_infrastructure import deserializeMessage, \
+    InvalidMessageError, TOKEN_DELIM
 
 log = newLogger(__name__)
 
+# With debug logging on, every message sent and received is logged, but only
+# up to this many per second in each direction (after an initial burst of
+# twice that), so that the ticks don't drown out everything else.
+MESSAGE_LOG_RATE = 20
+messageLog = ThrottledLogger(log, MESSAGE_LOG_RATE,
+                             burst=2 * MESSAGE_LOG_RATE)
 
-def setupNetworking(reactor, backend, host, port):
-    factory = NetworkConnectionFactory(backend)
-    reactor.connectTCP(host, port, factory)
+# How a serialized DeleteObelisk starts, so that reliable messages can be
+# checked for them without parsing all of them.
+DELETE_OBELISK_PREFIX = messages.DeleteObelisk.command + TOKEN_DELIM
+
+
+def setupNetworking(reactor, backend, host, port, udp=False):
+    if udp:
+        connection = DatagramNetworkConnection(backend, host, port, reactor)
+        reactor.listenUDP(0, connection)
+    else:
+        factory = NetworkConnectionFactory(backend)
+        reactor.connectTCP(host, port, factory)
 
 
 class NetworkConnectionFactory(ClientFactory):
@@ -48,12 +70,173 @@ class NetworkConnection(Int16StringReceiver):
         self.backend.networkReady(self)
 
     def stringReceived(self, message):
-        # TODO: Multiple levels of log.debug, so we can avoid spam like this.
-        # if message != "tick":
-        log.debug("[receive] %s", message)
+        messageLog.debug("[receive] %s", message)
         self.backend.networkMessage(message)
 
-    def backendMessage(self, message):
-        log.debug("[send]    %s", message)
+    def backendMessage(self, message, traceId=None):
+        # traceId is the trace id of the order in message, if it's being
+        # traced.
+        messageLog.debug("[send]    %s", message)
         self.sendString(message)
+        self.backend.traceReached(traceId, "send")
+
+
 
+class DatagramNetworkConnection(DatagramProtocol):
+    """
+    Connection to the server over UDP; see src.shared.datagram. Presents the
+    same interface to the backend as NetworkConnection.
+    """
+
+    def __init__(self, backend, host, port, reactor):
+        self.backend = backend
+        self.host    = host
+        self.port    = port
+        self.reactor = reactor
+
+        self.reliable = ReliableChannel(self.sendPacket,
+                                        self.reliableMessageReceived, reactor)
+        # Mapping from unit ids to the sequence number of the unreliable
+        # packet their current position came from, so that an older packet
+        # arriving late doesn't undo a newer one. Units are removed from it
+        # when they're deleted.
+        self.positionSeqs = {}
+
+        # The cookie from the server's last CHALLENGE, to be echoed in our
+        # HELLOs. Until we get one, HELLOs are padded to the same size, since
+        # the server ignores anything shorter.
+        self.cookie        = "\0" * COOKIE_SIZE
+        # Set once we've heard from the server (other than a CHALLENGE).
+        self.ready         = False
+        self.timer         = None
+        self.lastKeepalive = None
+
+    def startProtocol(self):
+        # Connected UDP sockets need an IP address, not a hostname.
+        deferred = self.reactor.resolve(self.host)
+        deferred.addCallback(self.resolved)
+        deferred.addErrback(self.resolveFailed)
+
+    def resolved(self, address):
+        self.transport.connect(address, self.port)
+        self.lastKeepalive = self.reactor.seconds()
+        self.sendPacket(KIND_HELLO, 0, self.cookie)
+        self.scheduleTimer()
+
+    def resolveFailed(self, failure):
+        log.error("Failed to look up server: %s", failure.getErrorMessage())
+
+    def cleanup(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.sendPacket(KIND_BYE, 0, "")
+        self.transport.stopListening()
+
+    def sendPacket(self, kind, seq, payload):
+        self.transport.write(encodePacket(kind, seq, payload))
+
+    def datagramReceived(self, packet, address):
+        try:
+            kind, seq, payload = decodePacket(packet)
+        except InvalidMessageError:
+            log.warning("Ignoring malformed packet %r", packet)
+            return
+
+        if kind == KIND_CHALLENGE:
+            if not self.ready:
+                self.cookie = payload
+                self.sendPacket(KIND_HELLO, 0, self.cookie)
+            return
+
+        if not self.ready:
+            self.ready = True
+            log.info("Connected to server over UDP.")
+            self.backend.networkReady(self)
+
+        if kind == KIND_RELIABLE:
+            self.reliable.packetReceived(seq, payload)
+        elif kind == KIND_ACK:
+            self.reliable.handleAck(seq)
+        elif kind == KIND_UNRELIABLE:
+            self.positionsReceived(seq, payload)
+        elif kind == KIND_BYE:
+            log.info("Server hung up.")
+        else:
+            log.warning("Ignoring packet of unexpected kind %s", kind)
+
+    def reliableMessageReceived(self, data):
+        messageLog.debug("[receive] %s", data)
+        self.backend.networkMessage(data)
+
+        # Forget about the positions of deleted units. If one is sent to us
+        # again, the server resends its position in newer packets until we
+        # ack one, so an old one arriving late is soon put right.
+        if data.startswith(DELETE_OBELISK_PREFIX):
+            try:
+                message = deserializeMessage(data)
+            except InvalidMessageError:
+                # The backend has already complained about it.
+                return
+            self.positionSeqs.pop(message.unitId, None)
+
+    def positionsReceived(self, seq, payload):
+        """
+        Apply the positions in an unreliable packet, except for any that are
+        older than what we already have. Only acknowledge the packet if we
+        could apply all of it: a position for a unit we haven't been told
+        about yet (because the reliable message creating it is still on its
+        way) will be sent again as long as we don't ack it.
+        """
+
+        try:
+            dataList = splitFrames(payload)
+        except InvalidMessageError:
+            log.warning("Ignoring malformed payload %r", payload)
+            return
+
+        complete = True
+        for data in dataList:
+            try:
+                message = deserializeMessage(data)
+            except InvalidMessageError:
+                log.warning("Ignoring malformed position %r", data)
+                continue
+            if not isinstance(message, messages.SetPos):
+                log.warning("Ignoring unexpected unreliable message %r", data)
+                continue
+
+            unitId = message.unitId
+            if unitId not in self.backend.gameState.positions:
+                complete = False
+                continue
+            if self.positionSeqs.get(unitId, -1) > seq:
+                continue
+            self.positionSeqs[unitId] = seq
+            self.backend.networkMessage(data)
+
+        if complete:
+            self.sendPacket(KIND_UNRELIABLE_ACK, seq, "")
+
+    def backendMessage(self, message, traceId=None):
+        messageLog.debug("[send]    %s", message)
+        self.reliable.send(frameData(message))
+        self.backend.traceReached(traceId, "send")
+
+    def scheduleTimer(self):
+        self.timer = self.reactor.callLater(RESEND_INTERVAL, self.timerFired)
+
+    def timerFired(self):
+        self.timer = None
+
+        if not self.ready:
+            self.sendPacket(KIND_HELLO, 0, self.cookie)
+
+        self.reliable.resendDue()
+
+        now = self.reactor.seconds()
+        if now - self.lastKeepalive >= KEEPALIVE_INTERVAL:
+            self.lastKeepalive = now
+            self.sendPacket(KIND_ACK, self.reliable.nextRecvSeq, "")
+
+        self.scheduleTimer()
@@ -10,7 +10,6 @@ from panda3d.core import Point2, Point3, Mat4, Filename, LineSegs, ClockObject
 
 from src.shared.geometry import Coord, Distance
 from src.shared.logconfig import newLogger
-from src.shared.message_infrastructure import deserializeMessage
 from src.shared import messages
 from src.shared.utils import minmax, thisIsNotHandled
 from src.client.backend import worldToGraphicsPos, graphicsToWorldPos
@@ -76,8 +75,7 @@ class WartsApp(ShowBase):
     # For backward compatibility.
     # TODO[#84]: Remove when old graphics goes away; have backend just call
     # tick() directly.
-    def interfaceMessage(self, data):
-        message = deserializeMessage(data)
+    def interfaceMessage(self, message):
         if isinstance(message, messages.Tick):
             self.tick()
 
@@ -90,8 +88,8 @@ class WartsApp(ShowBase):
 
         if self.firstTick:
             if not self.gameState.hasSize:
-                log.error("GameState must be assigned a size before first "
-                          "tick().")
+                # The map is still being streamed from the server. Try again
+                # next tick.
                 return
             width, height = self.gameState.sizeInChunks
             self.groundNodes = [[None for _x in range(height)]
@@ -549,7 +547,7 @@ class WartsApp(ShowBase):
         # When in Rome, send messages like the Romans do, I guess.
         # TODO: Get rid of messages, I think.
         message = cmessages.RequestQuit()
-        self.graphicsInterface.graphicsMessage(message.serialize())
+        self.graphicsInterface.graphicsMessage(message)
 
     def setupEventHandlers(self):
         def pushKey(key, value):
@@ -1,9 +1,8 @@
 import argparse
 import sys
 
-from src.shared.logconfig import enableDebugLogging, newLogger
-from src.server.main import main as serverMain
-from src.client.main import main as clientMain
+from src.shared.logconfig import enableDebugLogging, newLogger, \
+    parseLevelSpec, setLoggerLevels, startAsyncLogging
 
 HOST_DEFAULT = "127.0.0.1"
 PORT_DEFAULT = "16097"
@@ -16,28 +15,57 @@ def main():
 
     handleSharedArguments(args)
 
+    commandMain = loadCommand(args.command)
+    if commandMain is None:
+        # This should be impossible, because argparse should prevent it.
+        log.critical("Internal error: unrecognized command '%s'", args.command)
+        return
+
     if args.command == "server":
         log.info("Running WaRTS server...")
-        serverMain(args)
-
     elif args.command == "client":
         log.info("Connecting to WaRTS server...")
-        clientMain(args)
-
+    commandMain(args)
+
+
+def loadCommand(command):
+    """
+    Return the main function for the given subcommand, or None if there's no
+    such subcommand.
+
+    The subcommands' modules are only imported here, so that each one only
+    loads what it needs. In particular, the client's graphics pull in all of
+    Panda3D, which a dedicated server has no use for.
+    """
+
+    # pylint: disable=redefined-variable-type
+    if command == "server":
+        from src.server.main import main as commandMain
+    elif command == "client":
+        from src.client.main import main as commandMain
+    elif command == "replay":
+        from src.server.replay import main as commandMain
+    elif command == "simulate":
+        from src.server.headless import main as commandMain
+    elif command == "loadtest":
+        from src.client.loadtest import main as commandMain
     else:
-        # This should be impossible, because argparse should prevent it.
-        log.critical("Internal error: unrecognized command '%s'", args.command)
+        commandMain = None
+    return commandMain
 
 
 def handleSharedArguments(args):
     if args.log_debug:
         enableDebugLogging()
+    if args.log_level:
+        setLoggerLevels(args.log_level)
+    if args.log_async:
+        startAsyncLogging()
 
-def parseArguments():
+def parseArguments(argv=None):
     parser = WartsParser()
 
-    parser.add_argument('--log-debug', action="store_true",
-                        help="Enable debug-level logging")
+    addLoggingArguments(parser)
 
     subparsers = parser.add_subparsers(title="commands")
 
@@ -47,8 +75,20 @@ def parseArguments():
     serverParser.add_argument('--port', type=int, nargs='?',
                               default=PORT_DEFAULT,
                               help="server port [Default: %(default)s]")
-    serverParser.add_argument('--log-debug', action="store_true",
-                              help="Enable debug-level logging")
+    addLoggingArguments(serverParser, subcommand=True)
+    serverParser.add_argument('--udp', action="store_true",
+                              help="Also accept clients over UDP")
+    serverParser.add_argument('--lockstep', action="store_true",
+                              help="Only relay orders; have clients run "
+                                   "the simulation themselves")
+    serverParser.add_argument('--record', type=str, metavar="FILE",
+                              help="Record a replay of the game to FILE")
+    serverParser.add_argument('--metrics-port', type=int, metavar="PORT",
+                              help="Serve Prometheus metrics on this local "
+                                   "port")
+    serverParser.add_argument('--trace', type=str, metavar="FILE",
+                              help="Write timings of orders sent by tracing "
+                                   "clients to FILE")
 
     # Server command
     clientParser = subparsers.add_parser("client",
@@ -60,13 +100,114 @@ def parseArguments():
     clientParser.add_argument('--port', type=int, nargs='?',
                               default=PORT_DEFAULT,
                               help="server port [Default: %(default)s]")
-    clientParser.add_argument('--log-debug', action="store_true",
-                              help="Enable debug-level logging")
+    addLoggingArguments(clientParser, subcommand=True)
+    clientParser.add_argument('--udp', action="store_true",
+                              help="Connect over UDP instead of TCP")
     clientParser.add_argument('--new-graphics', action="store_true",
                               help="Use new graphics implementation "
                                    "(under construction)")
-
-    return parser.parse_args()
+    clientParser.add_argument('--bot', action="store_true",
+                              help="Run without graphics, and have a bot "
+                                   "play")
+    clientParser.add_argument('--trace', type=str, metavar="FILE",
+                              help="Time how long orders take to show up, "
+                                   "writing the timings to FILE")
+
+    # Replay command
+    replayParser = subparsers.add_parser("replay",
+                                         help="Re-run a recorded game "
+                                              "headlessly, at full speed")
+    replayParser.set_defaults(command="replay")
+    replayParser.add_argument('file', type=str,
+                              help="replay log written by server --record")
+    addLoggingArguments(replayParser, subcommand=True)
+
+    # Simulate command
+    simulateParser = subparsers.add_parser("simulate",
+                                           help="Run a server with simulated "
+                                                "clients, as fast as "
+                                                "possible")
+    simulateParser.set_defaults(command="simulate")
+    simulateParser.add_argument('--players', type=int, default=4,
+                                help="number of simulated clients "
+                                     "[Default: %(default)s]")
+    simulateParser.add_argument('--units', type=int, default=20,
+                                help="units per player "
+                                     "[Default: %(default)s]")
+    simulateParser.add_argument('--ticks', type=int,
+                                help="number of ticks to run [Default: 1000, "
+                                     "or the length of the script]")
+    simulateParser.add_argument('--seed', type=int,
+                                help="seed for the random orders")
+    simulateParser.add_argument('--script', type=str, metavar="FILE",
+                                help="Send the orders from a replay log "
+                                     "instead of random ones")
+    simulateParser.add_argument('--lockstep', action="store_true",
+                                help="Run the server in lockstep mode")
+    addLoggingArguments(simulateParser, subcommand=True)
+
+    # Load test command
+    loadtestParser = subparsers.add_parser("loadtest",
+                                           help="Connect many bots to a "
+                                                "server and measure how it "
+                                                "copes")
+    loadtestParser.set_defaults(command="loadtest")
+    loadtestParser.add_argument('--host', type=str, default=HOST_DEFAULT,
+                                help="server hostname [Default: %(default)s]")
+    loadtestParser.add_argument('--port', type=int, default=PORT_DEFAULT,
+                                help="server port [Default: %(default)s]")
+    loadtestParser.add_argument('--bots', type=int, default=100,
+                                help="number of bots [Default: %(default)s]")
+    loadtestParser.add_argument('--processes', type=int, default=1,
+                                help="number of processes to split the bots "
+                                     "between [Default: %(default)s]")
+    loadtestParser.add_argument('--duration', type=float, default=30.0,
+                                help="seconds to run for, once all the bots "
+                                     "have started [Default: %(default)s]")
+    loadtestParser.add_argument('--interval', type=float, default=0.5,
+                                help="seconds between each bot's actions "
+                                     "[Default: %(default)s]")
+    loadtestParser.add_argument('--udp', action="store_true",
+                                help="Connect over UDP instead of TCP")
+    loadtestParser.add_argument('--seed', type=int,
+                                help="seed for the bots' choices")
+    loadtestParser.add_argument('--worker', action="store_true",
+                                help=argparse.SUPPRESS)
+    addLoggingArguments(loadtestParser, subcommand=True)
+
+    return parser.parse_args(argv)
+
+
+def addLoggingArguments(parser, subcommand=False):
+    """
+    Add the logging options to parser. They can be given either before or
+    after the subcommand, so they're added both to the main parser and to
+    each subcommand's parser (with subcommand=True). The subcommands' copies
+    have no defaults: in Python 2.7, whatever a subcommand's parser sets
+    replaces what the main parser already parsed, so defaults there would
+    silently undo options given before the subcommand.
+    """
+
+    flagDefault  = argparse.SUPPRESS if subcommand else False
+    levelDefault = argparse.SUPPRESS if subcommand else None
+    parser.add_argument('--log-debug', action="store_true",
+                        default=flagDefault,
+                        help="Enable debug-level logging")
+    parser.add_argument('--log-level', action="append", metavar="NAME=LEVEL",
+                        type=levelSpec, default=levelDefault,
+                        help="Set the level of one module's logger, e.g. "
+                             "networking=WARNING (may be repeated)")
+    parser.add_argument('--log-async', action="store_true",
+                        default=flagDefault,
+                        help="Format and write log messages on a background "
+                             "thread")
+
+def levelSpec(spec):
+    try:
+        parseLevelSpec(spec)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return spec
 
 
 class WartsParser(argparse.ArgumentParser):
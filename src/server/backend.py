@@ -1,5 +1,6 @@
 from src.shared.ident import unitToPlayer, getUnitSubId
 from src.shared.logconfig import newLogger
+from src.shared.sampling_profiler import SamplingProfiler, profileCommand
 
 log = newLogger(__name__)
 
@@ -12,6 +13,13 @@ class Backend(object):
 
         self.stdio = None
 
+        # The TickScheduler that calls tick(), which knows how the ticks are
+        # keeping up with real time.
+        self.tickScheduler = None
+
+        # Started and stopped from the console, with "profile ...".
+        self.samplingProfiler = SamplingProfiler()
+
     # These next two methods must be called immediately after __init__, before
     # any other methods.
     def setGameStateManager(self, gameStateManager):
@@ -20,6 +28,9 @@ class Backend(object):
     def setClientInterfacer(self, clientInterfacer):
         self.clientInterfacer = clientInterfacer
 
+    def setTickScheduler(self, tickScheduler):
+        self.tickScheduler = tickScheduler
+
     def tick(self):
         self.gameStateManager.tick()
         self.clientInterfacer.tick()
@@ -42,6 +53,28 @@ class Backend(object):
                 log.info("    %2s: %3s @ %4s, %4s",
                          unitToPlayer(uid), getUnitSubId(uid), ux, uy)
             log.info("End unit dump.")
+        elif message == "stats":
+            for line in self.gameStateManager.profiler.reportLines():
+                log.info("%s", line)
+            scheduler = self.tickScheduler
+            if scheduler is not None:
+                log.info("%d ticks run (%d to catch up), %d dropped, %d "
+                         "overran; longest %.1f ms. Simulation is %.3f "
+                         "seconds behind real time.",
+                         scheduler.ticksRun, scheduler.catchUpTicks,
+                         scheduler.droppedTicks, scheduler.overruns,
+                         scheduler.longestTick * 1000, scheduler.lag)
+            log.info("Client message handlers:")
+            for line in self.clientInterfacer.dispatcher.reportLines():
+                log.info("%s", line)
+        elif message == "trace":
+            tracer = self.gameStateManager.tracer
+            if tracer is None:
+                log.info("Not tracing; start the server with --trace.")
+            else:
+                tracer.logReport()
+        elif message.split()[:1] == ["profile"]:
+            profileCommand(self.samplingProfiler, message.split()[1:])
         else:
             # TODO: Do something sensible.
             log.info("Don't know how to handle %r.", message)
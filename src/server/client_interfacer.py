@@ -1,18 +1,68 @@
-from collections import defaultdict
+from collections import deque
+from itertools import islice
 
-from src.shared.exceptions import NoPathToTargetError
-from src.shared.geometry import Coord, findPath
+from src.server.metrics import Counter
 from src.shared.ident import unitToPlayer
-from src.shared.logconfig import newLogger
+from src.shared.logconfig import newLogger, ThrottledLogger
+from src.shared.message_dispatch import MessageHandlers
 from src.shared.message_infrastructure import deserializeMessage, \
     badEMessageArgument, illFormedEMessage, badEMessageCommand, \
     InvalidMessageError
 from src.shared import messages
-from src.shared.unit_orders import DelUnitOrder, MoveUnitOrder
+from src.shared.simulation import orderUnitCount
+from src.shared.snapshot import MapContents, UnitTable, SimulationState
+from src.shared.unit_set import UnitSet
 
 log = newLogger(__name__)
 
-MAXIMUM_MESSAGES_PER_TICK = 10
+# Admission control: handling a client's messages costs "work", charged for
+# what was actually done, and each player can only spend so much per tick.
+#
+# Each tick, TICK_WORK_BUDGET is shared out equally between the players who
+# are currently sending messages, and added to each one's allowance, which
+# can save up to BURST_TICKS ticks' worth. When a message arrives, its cost is
+# estimated from its size and the number of units it's for, before doing any
+# of the work. It's handled right away if the player's allowance covers the
+# estimate, and the allowance is then settled against what handling it
+# actually cost (path searches can't be estimated up front). Otherwise, it
+# waits in a queue until the allowance does cover it. Only if that queue is
+# full are messages dropped.
+#
+# An order for more units than the allowance could ever cover is split, and
+# applied to as many units as the allowance covers each tick. Any other
+# message is handled once the allowance is full, whatever it costs.
+#
+# A unit of work is very roughly 10 microseconds, so the budget is about half
+# of a tick.
+TICK_WORK_BUDGET = 5000
+BURST_TICKS      = 5
+MAX_QUEUED_MESSAGES_PER_PLAYER = 128
+
+# Cost of each kind of work, in the same units as TICK_WORK_BUDGET.
+WORK_PER_BYTE = 1   # bytes of the message parsed
+WORK_PER_UNIT = 40  # units ordered (for a move, each needs a path search)
+WORK_PER_NODE = 5   # chunks expanded by those path searches
+
+# Warnings about each client's bad messages are limited to this many per
+# second for each thing that can be wrong with them (after an initial burst of
+# WARNING_BURST); the rest are counted and summarized.
+WARNING_RATE  = 1
+WARNING_BURST = 5
+
+# Largest serialized UnitSnapshot we'll try to send. Messages are prefixed
+# with a 16-bit length, so anything larger can't be sent as a single message.
+MAX_SNAPSHOT_LENGTH = 2**16 - 1
+
+# Number of bytes of the serialized map (or simulation state) to put in each
+# MapSnapshotPart (or SimSnapshotPart).
+MAP_SNAPSHOT_PART_SIZE = 4096
+
+# Orders that can be applied to some of their units now and the rest later.
+SPLITTABLE_ORDERS = (messages.OrderMove, messages.OrderDel)
+ORDERS = SPLITTABLE_ORDERS + (messages.OrderNew,)
+
+# Handlers for the messages clients send us.
+messageHandlers = MessageHandlers()  # pylint: disable=invalid-name
 
 class ClientInterfacer(object):
     def __init__(self, backend, gameStateManager, connections):
@@ -24,101 +74,361 @@ class ClientInterfacer(object):
 
         self.backend.setClientInterfacer(self)
 
-        self.messageCounts = defaultdict(int)
+        # Mapping from player id to how much work we'll do for that player
+        # before queueing their messages; see TICK_WORK_BUDGET.
+        self.workAllowances = {}
+        # Mapping from player id to a deque of (message, byteWork) pairs for
+        # messages waiting for their allowance to cover them; byteWork is the
+        # cost of parsing the message, if they haven't been charged for it
+        # yet.
+        self.queuedMessages = {}
 
-    def handshake(self, playerId):
-        # Send map size (must come before ground info).
-        msg = messages.MapSize(self.gameStateManager.gameState.sizeInChunks)
-        self.connectionManager.sendMessage(playerId, msg)
+        # Logs warnings about bad messages, so that a misbehaving client can't
+        # make us spend all our time logging.
+        self.warningLog = ThrottledLogger(log, WARNING_RATE, WARNING_BURST)
 
-        # Send ground info.
+        self.dispatcher = messageHandlers.bind(self, self.unhandledMessage)
+
+        # Metrics (see src.server.metrics).
+        self.messagesReceived = Counter("warts_messages_received_total",
+                                        "Messages received from clients, by "
+                                        "type.", labelName="type")
+        self.rateLimited      = Counter("warts_rate_limited_messages_total",
+                                        "Messages dropped because a client "
+                                        "had too many waiting for their share "
+                                        "of the tick.")
+        self.messagesDelayed  = Counter("warts_delayed_messages_total",
+                                        "Messages queued until a later tick "
+                                        "because a client had used up their "
+                                        "share.")
+        self.workDone         = Counter("warts_client_work_total",
+                                        "Work done handling messages from "
+                                        "clients (see TICK_WORK_BUDGET).")
+
+        # Cached serialized MapSnapshotPart messages, and the map version they
+        # were generated from.
+        self.mapSnapshotParts   = None
+        self.mapSnapshotVersion = None
+
+    def handshake(self, playerId):
         gameState = self.gameStateManager.gameState
-        for x in range(len(gameState.groundTypes)):
-            for y in range(len(gameState.groundTypes[x])):
-                groundType = gameState.groundTypes[x][y]
-                pos = Coord.fromCBU(chunk=(x, y))
-                msg = messages.GroundInfo(pos, groundType)
+
+        # Send positions of all existing obelisks. Do this first, so that the
+        # client knows about every unit before any of the live updates that
+        # are interleaved with the map below.
+        # The gameState does not yet know about this new player, so their id
+        # should not be in the gameState's mapping.
+        assert not any(unitToPlayer(unitId) == playerId
+                       for unitId in gameState.positions)
+
+        if self.gameStateManager.lockstep:
+            # The client will run the simulation itself, so it needs
+            # everything about the units, not just where they are. That's
+            # usually too much for one message, so stream it in parts, the
+            # same way as the map (which follows it). Send the first part
+            # right away, though, so that the client knows it's in lockstep
+            # before any of the orders and ticks that come after it.
+            manager = self.gameStateManager
+            state = SimulationState.fromSimulation(gameState,
+                                                   manager.unitOrders,
+                                                   manager.elapsedTicks)
+            parts = splitSnapshot(state.serialize(),
+                                  messages.SimSnapshotPart)
+            self.connectionManager.sendData(playerId, parts[0],
+                                            messages.SimSnapshotPart)
+            def streamMap():
+                self.connectionManager.streamData(playerId,
+                                                  self.getMapSnapshotParts(),
+                                                  messages.MapSnapshotPart)
+            self.connectionManager.streamData(playerId, parts[1:],
+                                              messages.SimSnapshotPart,
+                                              onDone=streamMap)
+            return
+
+        units = UnitTable.fromGameState(gameState)
+        data = messages.UnitSnapshot(units).serialize()
+        if len(data) <= MAX_SNAPSHOT_LENGTH:
+            self.connectionManager.sendData(playerId, data,
+                                            messages.UnitSnapshot)
+        else:
+            for unitId, pos in units:
+                msg = messages.NewObelisk(unitId, pos)
                 self.connectionManager.sendMessage(playerId, msg)
+        self.connectionManager.setKnownPositions(playerId, units)
+
+        # Stream the map, a piece at a time, as fast as the client's
+        # connection allows.
+        self.connectionManager.streamData(playerId,
+                                          self.getMapSnapshotParts(),
+                                          messages.MapSnapshotPart)
 
-        # Send resource pool info.
-        for pool in self.gameStateManager.gameState.resourcePools:
-            msg = messages.ResourceLoc(pool.coord)
-            self.connectionManager.sendMessage(playerId, msg)
+    def getMapSnapshotParts(self):
+        """
+        Return a list of serialized MapSnapshotPart messages that together
+        describe the current map. The messages are only re-encoded when the
+        map changes, so this is cheap to call for each new client, and every
+        client that joins while the map is unchanged shares the same strings.
+        """
 
-        # Send positions of all existing obelisks.
-        for unitId in self.gameStateManager.gameState.positions:
-            # The gameState does not yet know about this new player, so their
-            # id should not be in the gameState's mapping.
-            assert unitToPlayer(unitId) != playerId
-            otherPos = self.gameStateManager.gameState.getPos(unitId)
-            msg = messages.NewObelisk(unitId, otherPos)
-            self.connectionManager.sendMessage(playerId, msg)
+        gameState = self.gameStateManager.gameState
+        if self.mapSnapshotVersion != gameState.mapVersion:
+            data = MapContents.fromGameState(gameState).serialize()
+            self.mapSnapshotParts   = splitSnapshot(data,
+                                                    messages.MapSnapshotPart)
+            self.mapSnapshotVersion = gameState.mapVersion
+        return self.mapSnapshotParts
 
     def stringReceived(self, playerId, data):
-        # Rate-limit the client.
-        self.messageCounts[playerId] += 1
-        if self.messageCounts[playerId] == MAXIMUM_MESSAGES_PER_TICK:
-            log.warning("Received too many messages this tick from player %s",
-                        playerId)
-        if self.messageCounts[playerId] >= MAXIMUM_MESSAGES_PER_TICK:
+        byteWork = len(data) * WORK_PER_BYTE
+        try:
+            message = deserializeMessage(data)
+        except InvalidMessageError as error:
+            self.messagesReceived.inc(label="invalid")
+            illFormedEMessage(error, self.warningLog, clientId=playerId)
+            self.allowance(playerId)
+            self.charge(playerId, byteWork)
+            return
+        self.messagesReceived.inc(label=message.command)
+
+        if playerId not in self.queuedMessages:
+            now, later = self.admit(playerId, message, byteWork)
+            if now is not None:
+                self.handleAdmitted(playerId, now, byteWork)
+                if later is None:
+                    return
+                message, byteWork = later, 0
+
+        # The player can't afford (the rest of) this message for now; handle
+        # it once they've got some more.
+        queue = self.queuedMessages.get(playerId)
+        if queue is None:
+            queue = deque()
+            self.queuedMessages[playerId] = queue
+        if len(queue) >= MAX_QUEUED_MESSAGES_PER_PLAYER:
+            self.warningLog.warning("Too many messages waiting from player "
+                                    "%s; dropping some", playerId,
+                                    key=(playerId, "rate"))
+            self.rateLimited.inc()
             return
+        queue.append((message, byteWork))
+        self.messagesDelayed.inc()
+
+    def allowance(self, playerId):
+        """
+        Return the player's current work allowance, starting them off with a
+        full one if they haven't sent anything recently.
+        """
+
+        if playerId not in self.workAllowances:
+            self.workAllowances[playerId] = self.playerShare(
+                len(self.workAllowances) + 1
+            ) * BURST_TICKS
+        return self.workAllowances[playerId]
+
+    def playerShare(self, numPlayers=None):
+        """
+        Return the work each player is allowed per tick, when numPlayers
+        (default: the number currently sending messages) share the budget.
+        """
+
+        if numPlayers is None:
+            numPlayers = len(self.workAllowances)
+        return float(TICK_WORK_BUDGET) / max(1, numPlayers)
+
+    def admit(self, playerId, message, byteWork):
+        """
+        Decide how much of a message from a player to handle now, from an
+        estimate of its cost. Return a pair (now, later), where now is the
+        message (or part of an order) to handle now, or None if the player
+        can't afford any of it yet, and later is the rest of an order that's
+        too big to handle all at once, or None.
+        """
 
+        allowance = self.allowance(playerId)
+        units = orderUnitCount(message) if isinstance(message, ORDERS) else 0
+        if byteWork + units * WORK_PER_UNIT <= allowance:
+            return (message, None)
+
+        # The allowance only ever refills to this.
+        full = allowance >= self.playerShare() * BURST_TICKS
+        if isinstance(message, SPLITTABLE_ORDERS) and units > 1:
+            affordable = int((allowance - byteWork) // WORK_PER_UNIT)
+            if full:
+                affordable = max(affordable, 1)
+            if affordable > 0:
+                return splitOrder(message, affordable)
+        elif full:
+            return (message, None)
+        return (None, None)
+
+    def handleAdmitted(self, playerId, message, byteWork):
+        """
+        Handle a message from a player, and charge them for it.
+        """
+
+        units, nodes = self.handleMessage(playerId, message)
+        self.charge(playerId, byteWork + units * WORK_PER_UNIT +
+                              nodes * WORK_PER_NODE)
+
+    def charge(self, playerId, work):
+        self.workAllowances[playerId] -= work
+        self.workDone.inc(work)
+
+    def handleMessage(self, playerId, message):
+        """
+        Handle a message from a player, and return the work the game state
+        manager did for it (see GameStateManager.orderReceived).
+        """
+
+        work = None
         try:
-            message = deserializeMessage(data)
-            gameState = self.gameStateManager.gameState
-            if isinstance(message, messages.OrderNew):
-                # TODO: This should be handled in the game state manager.
-                self.gameStateManager.unitOrders.createNewUnit(
-                    playerId, message.unitType, message.pos
-                )
-            elif isinstance(message, messages.OrderDel):
-                for unitId in message.unitSet:
-                    # TODO: Factor out this pair of checks? We're probably
-                    # going to be doing them a *lot*.
-                    if not playerId == unitToPlayer(unitId):
-                        badEMessageArgument(
-                            message, log, clientId=playerId,
-                            reason="Can't delete other player's unit"
-                        )
-                    elif not gameState.isUnitIdValid(unitId):
-                        badEMessageArgument(message, log, clientId=playerId,
-                                            reason="No such unit")
-                    else:
-                        self.gameStateManager.unitOrders.giveOrders(
-                            unitId, [DelUnitOrder()]
-                        )
-            elif isinstance(message, messages.OrderMove):
-                unitSet = message.unitSet
-                for unitId in unitSet:
-                    if not playerId == unitToPlayer(unitId):
-                        badEMessageArgument(
-                            message, log, clientId=playerId,
-                            reason="Can't order other player's unit"
-                        )
-                    elif not gameState.isUnitIdValid(unitId):
-                        badEMessageArgument(message, log, clientId=playerId,
-                                            reason="No such unit")
-                    else:
-                        try:
-                            srcPos = gameState.getPos(unitId)
-                            path = findPath(gameState, srcPos, message.dest)
-                            log.debug("Issuing orders to unit %s: %s.",
-                                      unitId, path)
-                            orders = map(MoveUnitOrder, path)
-                            self.gameStateManager.unitOrders.giveOrders(
-                                unitId, orders
-                            )
-                        except NoPathToTargetError:
-                            log.debug("Can't order unit %s to %s: "
-                                      "no path to target.",
-                                      unitId, message.dest)
-                            # If the target position is not reachable, just
-                            # drop the command.
-            else:
-                badEMessageCommand(message, log, clientId=playerId)
+            work = self.dispatcher.dispatch(message, playerId)
         except InvalidMessageError as error:
-            illFormedEMessage(error, log, clientId=playerId)
+            illFormedEMessage(error, self.warningLog, clientId=playerId)
+        # Handlers that didn't involve the game state manager don't return
+        # anything.
+        return (0, 0) if work is None else work
+
+    def unhandledMessage(self, message, playerId):
+        badEMessageCommand(message, self.warningLog, clientId=playerId)
+
+    @messageHandlers.handles(messages.OrderNew)
+    def handleOrderNew(self, message, playerId):
+        self.traceReceived(playerId, message.traceId)
+        return self.gameStateManager.orderReceived(playerId, message)
+
+    @messageHandlers.handles(messages.OrderDel)
+    def handleOrderDel(self, message, playerId):
+        unitSet = self.checkOrderedUnits(playerId, message,
+                                         "Can't delete other player's unit")
+        if unitSet:
+            return self.gameStateManager.orderReceived(
+                playerId, messages.OrderDel(unitSet)
+            )
+
+    @messageHandlers.handles(messages.OrderMove)
+    def handleOrderMove(self, message, playerId):
+        self.traceReceived(playerId, message.traceId)
+        unitSet = self.checkOrderedUnits(playerId, message,
+                                         "Can't order other player's unit")
+        if unitSet:
+            return self.gameStateManager.orderReceived(
+                playerId, messages.OrderMove(unitSet, message.dest,
+                                             message.traceId)
+            )
+
+    @messageHandlers.handles(messages.SetViewport)
+    def handleSetViewport(self, message, playerId):
+        dx, dy = message.rect.dist.unit
+        if dx < 0 or dy < 0:
+            badEMessageArgument(message, self.warningLog, clientId=playerId,
+                                reason="Negative viewport size")
+        else:
+            self.connectionManager.setViewport(playerId, message.rect)
+
+    def traceReceived(self, playerId, traceId):
+        tracer = self.gameStateManager.tracer
+        if tracer is not None and traceId is not None:
+            # Different clients' trace ids can collide, so qualify them with
+            # the player id.
+            tracer.mark((playerId, traceId), "received")
+
+    def checkOrderedUnits(self, playerId, message, notOwnedReason):
+        """
+        Return a UnitSet of the units in message.unitSet that the player is
+        allowed to give orders to, complaining about the rest (once per
+        message for each reason, rather than once per unit).
+        """
+
+        gameState = self.gameStateManager.gameState
+        reasons = []
+        # Ownership can be checked for the whole set at once.
+        ownUnits = message.unitSet.forPlayer(playerId)
+        if any(otherId != playerId
+               for otherId in message.unitSet.playerIds):
+            reasons.append(notOwnedReason)
+        validUnits = []
+        for unitId in ownUnits:
+            if gameState.isUnitIdValid(unitId):
+                validUnits.append(unitId)
+            elif "No such unit" not in reasons:
+                reasons.append("No such unit")
+        for reason in reasons:
+            badEMessageArgument(message, self.warningLog, clientId=playerId,
+                                reason=reason)
+        return UnitSet(validUnits)
+
+    def removePlayer(self, playerId):
+        self.workAllowances.pop(playerId, None)
+        self.queuedMessages.pop(playerId, None)
 
     def tick(self):
-        self.messageCounts.clear()
+        self.refillAllowances()
+        self.handleQueuedMessages()
+        self.warningLog.reportSuppressed()
+        self.connectionManager.tick()
+
+    def refillAllowances(self):
+        share = self.playerShare()
+        for playerId, allowance in self.workAllowances.items():
+            allowance = min(allowance + share, share * BURST_TICKS)
+            if allowance >= share * BURST_TICKS and \
+                    playerId not in self.queuedMessages:
+                # They're not sending anything, so stop counting them when
+                # sharing out the budget.
+                del self.workAllowances[playerId]
+            else:
+                self.workAllowances[playerId] = allowance
+
+    def handleQueuedMessages(self):
+        """
+        Handle the queued messages of each player whose allowance allows it,
+        taking turns so that nobody's messages wait behind anybody else's.
+        """
+
+        handled = True
+        while handled:
+            handled = False
+            for playerId in sorted(self.queuedMessages):
+                queue = self.queuedMessages[playerId]
+                message, byteWork = queue[0]
+                now, later = self.admit(playerId, message, byteWork)
+                if now is None:
+                    continue
+                handled = True
+                queue.popleft()
+                if later is not None:
+                    queue.appendleft((later, 0))
+                self.handleAdmitted(playerId, now, byteWork)
+                if not queue:
+                    del self.queuedMessages[playerId]
+
+
+def splitOrder(message, count):
+    """
+    Split an OrderMove or OrderDel into one for the first count of its units
+    and one for the rest. Only the first keeps the trace id, so that the
+    trace follows the units that start moving first.
+    """
+
+    first = UnitSet(islice(message.unitSet, count))
+    rest  = message.unitSet.difference(first)
+    if isinstance(message, messages.OrderMove):
+        return (messages.OrderMove(first, message.dest, message.traceId),
+                messages.OrderMove(rest, message.dest))
+    return (messages.OrderDel(first), messages.OrderDel(rest))
+
+
+def splitSnapshot(data, messageType):
+    """
+    Split a serialized snapshot into pieces of at most MAP_SNAPSHOT_PART_SIZE
+    bytes, and return a list of serialized messages of the given type
+    (MapSnapshotPart or SimSnapshotPart) that together carry all of it.
+    """
 
+    total = len(data)
+    parts = []
+    for offset in range(0, total, MAP_SNAPSHOT_PART_SIZE):
+        piece = data[offset : offset + MAP_SNAPSHOT_PART_SIZE]
+        parts.append(messageType(offset, total, piece).serialize())
+    return parts
@@ -1,36 +1,83 @@
-from collections import deque
+import time
 
+from src.server.metrics import Counter
+from src.server.tick_profiler import TickProfiler
 from src.shared.game_state import GameState
-from src.shared.game_state_change import ResourceChange
-from src.shared.geometry import Distance, Coord, Rect, isRectCollision
-from src.shared.ident import unitToPlayer
+from src.shared.geometry import Coord
 from src.shared.logconfig import newLogger
 from src.shared import messages
-from src.shared.unit_orders import UnitOrders, Order, DelUnitOrder, \
-    MoveUnitOrder
-from src.shared.utils import thisShouldNeverHappen
+from src.shared.simulation import Simulation, orderUnitCount
+from src.shared.unit_set import UnitSet
+from src.shared.unit_orders import DelUnitOrder
 
 log = newLogger(__name__)
 
-class GameStateManager(object):
-    def __init__(self, backend, connections):
-        super(GameStateManager, self).__init__()
+class GameStateManager(Simulation):
+    """
+    Runs the simulation on the server (see src.shared.simulation). Changes
+    to the game state are reported to connections, which is usually the
+    ConnectionManager.
+
+    In lockstep mode, orders aren't applied as soon as they're received.
+    Instead they're queued up, and at the start of the next tick they're
+    relayed to every client and then applied. Each client runs its own
+    Simulation, applying the same orders at the same point, so the
+    simulation only has to be deterministic for everyone to stay in sync.
+    """
+
+    def __init__(self, backend, connections, gameState=None,
+                 lockstep=False):
+        if gameState is None:
+            gameState = getDefaultGameState()
+        super(GameStateManager, self).__init__(connections, gameState)
 
         self.backend           = backend
         self.connectionManager = connections
 
-        self.backend.setGameStateManager(self)
+        if self.backend is not None:
+            self.backend.setGameStateManager(self)
 
-        self.gameState = getDefaultGameState()
-        self.unitOrders = UnitOrders()
-        self.pendingChanges = deque()
+        self.lockstep = lockstep
+        # In lockstep mode, (playerId, message) pairs for orders received
+        # since the last tick, in the order they were received.
+        self.queuedOrders = []
 
-        # TODO[#10]: Why is this in GameStateManager?
-        # I was gonna just make this a global, but pylint doesn't like globals.
-        # Fortunately, this is definitely less terrible and hacky.
-        self.elapsedTicks = 0
+        # If set, a ReplayRecorder that's told about every order we apply.
+        self.recorder = None
+        # If set, a Tracer (see src.shared.tracing) for traced orders.
+        self.tracer   = None
+
+        # How long each part of a tick takes, and how much work it does.
+        self.profiler = TickProfiler()
+        # Metrics (see src.server.metrics).
+        self.pathsComputed   = Counter("warts_paths_computed_total",
+                                       "Number of paths computed.")
+        self.pathfindingTime = Counter("warts_pathfinding_seconds_total",
+                                       "Total time spent computing paths.")
+
+    def setRecorder(self, recorder):
+        self.recorder = recorder
+        self.recorder.start(self.gameState)
+
+    def setTracer(self, tracer):
+        self.tracer = tracer
 
     def removePlayer(self, playerId):
+        if self.lockstep:
+            # Everyone else has to delete the units at the same point in the
+            # simulation, so do it as an order like any other.
+            self.queuedOrders = [(orderPlayer, message)
+                                 for orderPlayer, message in self.queuedOrders
+                                 if orderPlayer != playerId]
+            unitIds = list(self.gameState.getAllUnitsForPlayer(playerId))
+            if unitIds:
+                self.orderReceived(playerId,
+                                   messages.OrderDel(UnitSet(unitIds)))
+            return
+
+        if self.recorder is not None:
+            self.recorder.playerRemoved(self.elapsedTicks, playerId)
+
         # If a client connects and then disconnects in the same tick, just
         # don't create their units. This is the easiest way to ensure we don't
         # leak units in such cases.
@@ -54,140 +101,93 @@ class GameStateManager(object):
     # tick has elapsed. As a hack, throwing that in here, but we should really
     # create a top-level tick() function to put that in.
     def tick(self):
-        # FIXME: Shouldn't really go in tick(); I just put it here so we could
-        # test handling of ResourceAmt in client.
-        self.resolveResourceGathering()
-
-        self.applyOrders()
-        self.applyPendingChanges()
-        self.broadcastChanges()
-
-        self.pendingChanges.clear()
-        self.elapsedTicks += 1
-        self.connectionManager.broadcastMessage(messages.Tick())
-
-    def checkOverlapUnitAndResource(self, uid, pool):
-        # Pool Rectangle
-        pLeft, pBottom = pool.unit
-        pRight, pTop = (pool  + Distance.fromCBU(build=(1, 1))).unit
-        # Get back into the build square
-        pTop, pRight = pTop - 1, pRight - 1
-
-        # Unit rectangle
-        uX, uY = self.gameState.getPos(uid).unit
-        uWidth, uHeight = self.gameState.getSize(uid).unit
-        uTop = uY + uHeight // 2
-        uBottom = uY - uHeight // 2
-        uRight = uX + uWidth // 2
-        uLeft = uX - uWidth // 2
-
-        return ((uBottom < pTop and uTop  > pBottom) and
-                (uLeft < pRight and uRight  > pLeft))
-
-    def resolveResourceGathering(self):
-        if self.elapsedTicks % 5 == 0:
-            for uid in self.gameState.getAllUnits():
-                for pool in self.gameState.resourcePools:
-                    unitRect = self.gameState.getRect(uid)
-                    if isRectCollision(unitRect, pool):
-                        playerId = unitToPlayer(uid)
-                        self.scheduleChange(ResourceChange(playerId, 1))
-                        break
-
-    def scheduleChange(self, change):
-        self.pendingChanges.append(change)
-
-    def applyPendingChanges(self):
-        # TODO: Figure out a way to ensure that these are commutative (or else
-        # resolve them simultaneously). As is, this solution might give a
-        # subtle advantage to lower-numbered players, depending on what we put
-        # in GameStateChanges.
-        for change in self.pendingChanges:
-            change.apply(self.gameState)
-
-    def broadcastChanges(self):
-        for change in self.pendingChanges:
-            # FIXME: Hack to send a ResourceAmt for ResourceChanges. Really we
-            # should just send a more general GameStateUpdate message, but that
-            # doesn't exist yet.
-            if isinstance(change, ResourceChange):
-                newResources = self.gameState.resources[change.playerId]
-                msg = messages.ResourceAmt(newResources)
-                self.connectionManager.sendMessage(change.playerId, msg,
-                                                   dropOnFailure=True)
-            else:
-                thisShouldNeverHappen()
-
-    def applyOrders(self):
-        # Create any pending units.
-        for playerId, unitType, pos in self.unitOrders.getPendingNewUnits():
-            unitId = self.gameState.addUnit(playerId, unitType, pos)
-            # Should have no effect, but just to make sure we have the right
-            # position...
-            pos = self.gameState.getPos(unitId)
-
-            msg = messages.NewObelisk(unitId, pos)
-            self.connectionManager.broadcastMessage(msg)
-
-        self.unitOrders.clearPendingNewUnits()
-
-        # Resolve orders to any existing units.
-        for unitId in self.unitOrders.getAllUnitsWithOrders():
-            assert self.gameState.isUnitIdValid(unitId)
-            self.applyOrdersForUnit(unitId)
-
-    def applyOrdersForUnit(self, unitId):
-        # TODO: Refactor this?
-        done = False
-        while not done and self.unitOrders.hasNextOrder(unitId):
-            order = self.unitOrders.getNextOrder(unitId)
-
-            # Remove unit.
-            if isinstance(order, DelUnitOrder):
-                # If a client manages to connect then disconnect within a
-                # single tick, then it's possible the only order we'll ever
-                # execute for their obelisk is the "remove" order, without
-                # having first created it. In that case, we can't remove the
-                # obelisk, because it doesn't exist: gameState.removePlayer
-                # would crash if we tried and the clients would be confused if
-                # we sent them a DeleteObelisk message for an unused id.
-                #
-                # FIXME: This is the wrong solution to that. We shouldn't allow
-                # that order to be created in the first place.
-                if self.gameState.isUnitIdValid(unitId):
-                    self.gameState.removeUnit(unitId)
-                    self.unitOrders.clearOrders(unitId)
-                    msg = messages.DeleteObelisk(unitId)
-                    self.connectionManager.broadcastMessage(msg)
-                done = True
-
-            # Move player.
-            elif isinstance(order, MoveUnitOrder):
-                dest = order.dest
-                pos  = self.gameState.getPos(unitId)
-
-                # Don't try to move to the current position.
-                if dest != pos:
-                    assert dest is not None
-
-                    self.gameState.moveUnitToward(unitId, dest)
-                    pos = self.gameState.getPos(unitId)
-                    # TODO: Maybe only broadcast the new position if we handled
-                    # a valid command? Else the position isn't changed....
-                    msg = messages.SetPos(unitId, pos)
-                    self.connectionManager.broadcastMessage(msg)
-
-                    # TODO[#13]: Don't set done if the unit can move farther in
-                    # this tick.
-                    done = True
-
-                else:
-                    self.unitOrders.removeNextOrder(unitId)
-
-            elif isinstance(order, Order):
-                raise TypeError("Unrecognized sublass of Order")
-            else:
-                raise TypeError("Found non-Order object among orders")
+        timer = self.profiler
+        timer.start()
+
+        # Collect everything broadcast during the tick so that it can be
+        # encoded and written to each client in one go.
+        self.connectionManager.startBatch()
+
+        orders = None
+        if self.lockstep:
+            orders = self.queuedOrders
+            self.queuedOrders = []
+            self.relayOrders(orders)
+        self.step(orders)
+
+        # In lockstep mode, include a hash of the state, so that clients can
+        # tell right away if their copy of the simulation has diverged. Also,
+        # clients have to run every tick, so a lagging client mustn't have
+        # any skipped.
+        stateHash = self.gameState.stateHash if self.lockstep else None
+        self.connectionManager.broadcastMessage(messages.Tick(stateHash),
+                                                supersedable=not self.lockstep)
+
+        self.connectionManager.flushBatch()
+        timer.phaseDone("broadcast")
+        timer.endTick()
+
+        if self.recorder is not None:
+            self.recorder.tickDone()
+
+    def orderReceived(self, playerId, message):
+        """
+        Handle an OrderNew, OrderDel, or OrderMove from the given player. The
+        caller is responsible for making sure the player is allowed to give
+        the order.
+
+        Return how much work handling it took, as a (units touched, chunks
+        expanded by path searches) pair. In lockstep mode the order is only
+        queued, so that's just the number of units it's for.
+        """
+
+        if self.lockstep:
+            self.queuedOrders.append((playerId, message))
+            return orderUnitCount(message), 0
+        else:
+            return self.applyOrderMessage(playerId, message)
+
+    def relayOrders(self, orders):
+        # Tell the clients which orders to apply, and in what order, before
+        # we apply them ourselves.
+        currPlayer = None
+        for playerId, message in orders:
+            if playerId != currPlayer:
+                currPlayer = playerId
+                self.connectionManager.broadcastMessage(
+                    messages.OrderFrom(playerId)
+                )
+            self.connectionManager.broadcastMessage(message)
+            if self.tracer is not None and \
+                    getattr(message, "traceId", None) is not None:
+                # The relayed order is the result the client is waiting
+                # for. It goes out with the rest of this tick's batch.
+                self.tracer.mark((playerId, message.traceId), "sent")
+
+    def applyOrderMessage(self, playerId, message):
+        if self.recorder is not None:
+            self.recorder.orderApplied(self.elapsedTicks, playerId, message)
+        return super(GameStateManager, self).applyOrderMessage(playerId,
+                                                               message)
+
+    def findPath(self, srcPos, destPos, workCounter):
+        self.pathsComputed.inc()
+        startTime = time.time()
+        try:
+            return super(GameStateManager, self).findPath(srcPos, destPos,
+                                                          workCounter)
+        finally:
+            self.pathfindingTime.inc(time.time() - startTime)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close(self.elapsedTicks, self.gameState.stateHash)
+            self.recorder = None
+
+    def stopTracing(self):
+        if self.tracer is not None:
+            self.tracer.close()
+            self.tracer = None
 
 # TODO[#10]: Why is this in GameStateManager?
 def getDefaultGameState():
@@ -196,20 +196,12 @@ def getDefaultGameState():
     gameState.setSize((10, 5))
 
     # Some impassable squares, to better exercise the pathfinding.
-    gameState.groundTypes[5][3] = 1
-    gameState.groundTypes[1][1] = 1
-    gameState.groundTypes[1][2] = 1
-    gameState.groundTypes[1][3] = 1
-    gameState.groundTypes[2][3] = 1
-    gameState.groundTypes[3][2] = 1
+    for chunk in [(5, 3), (1, 1), (1, 2), (1, 3), (2, 3), (3, 2)]:
+        gameState.setGroundType(chunk, 1)
 
     # Resource pools.
-    gameState.resourcePools.extend([
-        Rect(Coord.fromCBU(chunk=(2, 2), build=(1, 4)),
-             Distance.fromCBU(build=(1, 1))),
-        Rect(Coord.fromCBU(chunk=(2, 2), build=(2, 4)),
-             Distance.fromCBU(build=(1, 1))),
-    ])
+    gameState.addResourcePool(Coord.fromCBU(chunk=(2, 2), build=(1, 4)))
+    gameState.addResourcePool(Coord.fromCBU(chunk=(2, 2), build=(2, 4)))
 
     return gameState
 
@@ -0,0 +1,263 @@
+"""
+Headless simulation harness, for load testing the server without real
+clients, sockets, or a reactor.
+
+This builds the same Backend, GameStateManager, ClientInterfacer and
+ConnectionManager as the real server, but the connections are in-memory
+ones that just count what would have been written to them, and the clients
+are simulated in-process: each tick, every simulated client sends some
+orders, exactly as a real client would (through
+ClientInterfacer.stringReceived). Ticks are then run back-to-back as fast as
+possible, rather than every config.TICK_LENGTH seconds.
+
+Orders are either random (each player spawns some units, then keeps sending
+them to random places) or scripted, taken from a replay log written by
+`warts server --record`.
+"""
+
+from collections import deque
+import random
+import time
+
+from twisted.internet.task import Clock
+
+from src.server.backend import Backend
+from src.server.client_interfacer import ClientInterfacer
+from src.server.game_state_manager import GameStateManager
+from src.server.networking import ConnectionManager, BaseConnection
+from src.server.phase_timer import PhaseTimer
+from src.server.replay import Replay
+from src.shared import config
+from src.shared.game_state import GameState
+from src.shared.geometry import Coord
+from src.shared.logconfig import newLogger
+from src.shared import messages
+from src.shared.unit_set import UnitSet
+
+log = newLogger(__name__)
+
+# Chance that a random player orders some of their units to move, each tick.
+MOVE_ORDER_CHANCE = 0.2
+
+# Most units moved by a single random OrderMove.
+MAX_UNITS_PER_MOVE = 8
+
+
+class MemoryConnection(BaseConnection):
+    """
+    A connection to a simulated client. Everything written to it is
+    discarded, but counted.
+    """
+
+    def __init__(self, playerId, clientInterfacer, connections):
+        super(MemoryConnection, self).__init__(playerId, clientInterfacer,
+                                               connections)
+        self.bytesSent  = 0
+        self.writeCount = 0
+
+    def connectionMade(self):
+        self.handshake()
+        self.clientInterfacer.handshake(self.playerId)
+
+    def connectionLost(self):
+        self.connections.removeConnection(self)
+
+    def disconnect(self):
+        self.connections.clock.callLater(0, self.connectionLost)
+
+    def sendToServer(self, message):
+        self.messageReceived(message.serialize())
+
+    def writeToTransport(self, data):
+        self.bytesSent  += len(data)
+        self.writeCount += 1
+
+
+class HeadlessSimulation(object):
+    """
+    A server with numPlayers simulated clients, each of which creates
+    unitsPerPlayer units and then orders them around at random. If script
+    (a Replay) is given, the clients instead send the orders recorded in it,
+    on the ticks they were recorded, and the game is played on its map.
+    """
+
+    def __init__(self, numPlayers=0, unitsPerPlayer=0, script=None,
+                 lockstep=False, seed=None):
+        super(HeadlessSimulation, self).__init__()
+
+        self.script = script
+        self.random = random.Random(seed)
+
+        gameState = None
+        if script is not None:
+            gameState = GameState()
+            script.mapContents.applyTo(gameState)
+            numPlayers = 1 + max([playerId
+                                  for events in script.events.values()
+                                  for playerId, _ in events] or [-1])
+
+        # Set everything up the same way server.main does.
+        self.clock = Clock()
+        self.connections = ConnectionManager(clock=self.clock,
+                                             lockstep=lockstep)
+        self.backend = Backend()
+        self.gameStateManager = GameStateManager(self.backend,
+                                                 self.connections,
+                                                 gameState=gameState,
+                                                 lockstep=lockstep)
+        self.clientInterfacer = ClientInterfacer(self.backend,
+                                                 self.gameStateManager,
+                                                 self.connections)
+        self.connections.setGameStateManager(self.gameStateManager)
+        self.connections.setClientInterfacer(self.clientInterfacer)
+        self.connections.setProfiler(self.gameStateManager.profiler)
+
+        # Times the parts of each tick outside GameStateManager.tick.
+        self.phaseTimer = PhaseTimer()
+        self.ticks = 0
+
+        # Mapping from player ids to the orders each simulated client still
+        # has to send.
+        self.outboxes = {}
+        self.clients  = []
+        for _ in range(numPlayers):
+            client = self.connections.newConnection(MemoryConnection)
+            client.connectionMade()
+            self.clients.append(client)
+            self.outboxes[client.playerId] = deque()
+
+        if script is None:
+            for client in self.clients:
+                for _ in range(unitsPerPlayer):
+                    self.outboxes[client.playerId].append(
+                        messages.OrderNew(0, self.randomPassablePos())
+                    )
+
+    def run(self, numTicks):
+        for _ in xrange(numTicks):
+            self.tick()
+
+    def tick(self):
+        timer = self.phaseTimer
+        timer.start()
+
+        if self.script is not None:
+            self.queueScriptedOrders()
+        else:
+            self.queueRandomOrders()
+        self.sendOrders()
+        timer.phaseDone("clientOrders")
+
+        self.backend.tick()
+        timer.phaseDone("tick")
+
+        # Let anything being streamed to the clients (like the map) make
+        # progress, as the reactor would between ticks.
+        self.clock.advance(0)
+        timer.phaseDone("streams")
+
+        self.ticks += 1
+
+    def queueScriptedOrders(self):
+        for playerId, message in self.script.events.get(self.ticks, []):
+            if playerId not in self.connections.connections:
+                continue
+            if message is None:
+                self.connections.connections[playerId].connectionLost()
+            else:
+                self.outboxes[playerId].append(message)
+
+    def queueRandomOrders(self):
+        gameState = self.gameStateManager.gameState
+        for client in self.clients:
+            if self.random.random() >= MOVE_ORDER_CHANCE:
+                continue
+            unitIds = list(gameState.getAllUnitsForPlayer(client.playerId))
+            if not unitIds:
+                continue
+            count = self.random.randint(1, min(len(unitIds),
+                                               MAX_UNITS_PER_MOVE))
+            unitSet = UnitSet(self.random.sample(unitIds, count))
+            self.outboxes[client.playerId].append(
+                messages.OrderMove(unitSet, self.randomPassablePos())
+            )
+
+    def sendOrders(self):
+        for client in self.clients:
+            if client.playerId not in self.connections.connections:
+                continue
+            # Send everything; if it's more than the client's share of the
+            # tick, the ClientInterfacer queues the rest, as it would for a
+            # real client.
+            outbox = self.outboxes[client.playerId]
+            while outbox:
+                client.sendToServer(outbox.popleft())
+
+    def randomPassablePos(self):
+        gameState = self.gameStateManager.gameState
+        width, height = gameState.sizeInChunks
+        while True:
+            pos = Coord.fromUnit((
+                self.random.randrange(width  * config.CHUNK_SIZE),
+                self.random.randrange(height * config.CHUNK_SIZE),
+            ))
+            if gameState.isPassable(pos):
+                return pos
+
+    @property
+    def bytesSent(self):
+        return sum(client.bytesSent for client in self.clients)
+
+    def phaseAverages(self):
+        """
+        Return a list of (phase, average seconds per tick) pairs, with the
+        parts of GameStateManager.tick broken out.
+        """
+
+        gameStatePhases = self.gameStateManager.profiler.averages()
+        phases = []
+        for phase, average in self.phaseTimer.averages():
+            if phase == "tick":
+                phases.extend(("tick." + name, gameStateAverage)
+                              for name, gameStateAverage in gameStatePhases)
+                # Whatever's left is the rest of Backend.tick.
+                average -= sum(gameStateAverage
+                               for _, gameStateAverage in gameStatePhases)
+                phase = "tick.other"
+            phases.append((phase, average))
+        return phases
+
+
+def main(args):
+    script = None
+    if args.script is not None:
+        with open(args.script) as inFile:
+            script = Replay.load(inFile)
+
+    simulation = HeadlessSimulation(numPlayers=args.players,
+                                    unitsPerPlayer=args.units,
+                                    script=script, lockstep=args.lockstep,
+                                    seed=args.seed)
+    numTicks = args.ticks
+    if numTicks is None:
+        numTicks = script.totalTicks if script is not None else 1000
+
+    log.info("Simulating %d ticks with %d players...",
+             numTicks, len(simulation.clients))
+    startTime = time.time()
+    simulation.run(numTicks)
+    elapsed = time.time() - startTime
+
+    gameState = simulation.gameStateManager.gameState
+    log.info("Ran %d ticks in %.3f seconds (%.1f ticks/second), ending with "
+             "%d units.", numTicks, elapsed,
+             numTicks / elapsed if elapsed else 0.0,
+             len(gameState.positions))
+    log.info("Sent %.1f bytes per tick to each client.",
+             float(simulation.bytesSent) /
+             (numTicks * max(1, len(simulation.clients))))
+    log.info("Time per tick, by phase:")
+    for phase, average in simulation.phaseAverages():
+        log.info("    %-18s %8.3f ms", phase, average * 1000)
+    for line in simulation.gameStateManager.profiler.reportLines():
+        log.info("%s", line)
@@ -0,0 +1,229 @@
+"""
+Interest management: keeping track of which part of the world each client
+cares about, so that they're only sent updates for units in that part.
+"""
+
+from src.shared.geometry import Distance, Rect
+from src.shared.ident import unitToPlayer
+
+# Units within this many chunks (in each direction) of one of a player's own
+# units are always of interest to that player.
+VISION_RANGE = 1
+
+# Amount to expand each client's reported viewport by, so that units just off
+# the edge of the screen are already known when the camera moves a bit.
+VIEWPORT_MARGIN = Distance.fromCBU(chunk=(1, 1))
+
+
+class InterestManager(object):
+    """
+    Keeps track of each player's viewport and of the chunks their units can
+    see, along with an index of which units are in which chunk. All of this
+    is updated incrementally as units are created, moved and deleted, so
+    that working out what changed for a player only involves the units in
+    chunks that entered or left their region (see takeChangedChunks).
+    """
+
+    def __init__(self):
+        super(InterestManager, self).__init__()
+
+        # Mapping from player ids to the Rect (in world coordinates) that
+        # player's camera is showing. Players who have never reported a
+        # viewport are interested in the whole world.
+        self.viewports = {}
+
+        # Mapping from chunks to the sets of ids of the units in them, and
+        # from unit ids to the chunks they're in.
+        self.unitsByChunk = {}
+        self.unitChunks   = {}
+        # Mapping from player ids to dicts mapping each chunk within
+        # VISION_RANGE of one of that player's units to the number of that
+        # player's units it's within range of.
+        self.visionCounts = {}
+        # Mapping from player ids (of players with viewports) to the sets of
+        # chunks that may have entered or left their regions since the last
+        # call to takeChangedChunks, or to None if anything may have.
+        self.changedChunks = {}
+
+    def setGameState(self, gameState):
+        """
+        Index the units already in gameState. Later changes have to be
+        reported through unitCreated, unitMoved and unitDeleted.
+        """
+
+        for unitId, pos in gameState.positions.iteritems():
+            self.unitCreated(unitId, pos)
+
+    def setViewport(self, playerId, rect):
+        margin = VIEWPORT_MARGIN
+        viewport = Rect(rect.coord - margin, rect.dist + margin + margin)
+
+        oldViewport = self.viewports.get(playerId)
+        self.viewports[playerId] = viewport
+        if oldViewport is None:
+            # The region used to be the whole world.
+            self.changedChunks[playerId] = None
+            return
+        changed = self.changedChunks[playerId]
+        if changed is not None:
+            changed.update(self.occupiedChunksIn(oldViewport))
+            changed.update(self.occupiedChunksIn(viewport))
+
+    def removePlayer(self, playerId):
+        self.viewports.pop(playerId, None)
+        self.changedChunks.pop(playerId, None)
+
+    def hasViewport(self, playerId):
+        return playerId in self.viewports
+
+    def unitCreated(self, unitId, pos):
+        chunk = pos.chunk
+        self.unitChunks[unitId] = chunk
+        self.unitsByChunk.setdefault(chunk, set()).add(unitId)
+        self.addVision(unitToPlayer(unitId), chunk)
+
+    def unitMoved(self, unitId, pos):
+        chunk    = pos.chunk
+        oldChunk = self.unitChunks[unitId]
+        if chunk == oldChunk:
+            return
+
+        self.unitChunks[unitId] = chunk
+        self.removeFromChunk(unitId, oldChunk)
+        self.unitsByChunk.setdefault(chunk, set()).add(unitId)
+
+        # Add the new vision before removing the old, so that chunks in
+        # range of both don't count as changing.
+        playerId = unitToPlayer(unitId)
+        self.addVision(playerId, chunk)
+        self.removeVision(playerId, oldChunk)
+
+    def unitDeleted(self, unitId):
+        chunk = self.unitChunks.pop(unitId)
+        self.removeFromChunk(unitId, chunk)
+        self.removeVision(unitToPlayer(unitId), chunk)
+
+    def removeFromChunk(self, unitId, chunk):
+        units = self.unitsByChunk[chunk]
+        units.remove(unitId)
+        if not units:
+            del self.unitsByChunk[chunk]
+
+    def addVision(self, playerId, chunk):
+        counts  = self.visionCounts.setdefault(playerId, {})
+        changed = self.changedChunks.get(playerId)
+        for visible in visionAround(chunk):
+            count = counts.get(visible, 0)
+            counts[visible] = count + 1
+            if count == 0 and changed is not None:
+                changed.add(visible)
+
+    def removeVision(self, playerId, chunk):
+        counts  = self.visionCounts[playerId]
+        changed = self.changedChunks.get(playerId)
+        for visible in visionAround(chunk):
+            count = counts[visible]
+            if count > 1:
+                counts[visible] = count - 1
+            else:
+                del counts[visible]
+                if changed is not None:
+                    changed.add(visible)
+        if not counts:
+            del self.visionCounts[playerId]
+
+    def occupiedChunksIn(self, rect):
+        """
+        Return a list of the chunks that overlap rect and have units in them.
+        """
+
+        xMin, yMin = rect.coord.chunk
+        xMax, yMax = (rect.coord + rect.dist).chunk
+        area = max(0, xMax - xMin + 1) * max(0, yMax - yMin + 1)
+        # A client can report any viewport it likes, so don't go through
+        # more chunks than there are units in.
+        if area <= len(self.unitsByChunk):
+            return [(x, y) for x in xrange(xMin, xMax + 1)
+                           for y in xrange(yMin, yMax + 1)
+                           if (x, y) in self.unitsByChunk]
+        return [(x, y) for x, y in self.unitsByChunk
+                       if xMin <= x <= xMax and yMin <= y <= yMax]
+
+    def unitsInChunks(self, chunks):
+        """
+        Return a set of the ids of the units in any of the given chunks.
+        """
+
+        units = set()
+        for chunk in chunks:
+            units.update(self.unitsByChunk.get(chunk, ()))
+        return units
+
+    def takeChangedChunks(self, playerId):
+        """
+        Return the chunks that may have entered or left the given player's
+        region since the last call, so only units in them (or that changed
+        themselves) need to be checked against it. Returns None if anything
+        may have changed, as when the player first reports a viewport.
+        """
+
+        if playerId not in self.viewports:
+            return set()
+        changed = self.changedChunks[playerId]
+        self.changedChunks[playerId] = set()
+        return changed
+
+    def getRegion(self, playerId):
+        """
+        Return an InterestRegion for the given player, based on their
+        viewport and the current positions of their units.
+        """
+
+        if playerId not in self.viewports:
+            return InterestRegion(playerId, None, None)
+        return InterestRegion(playerId, self.viewports[playerId],
+                              self.visionCounts.get(playerId, {}))
+
+
+def visionAround(chunk):
+    cx, cy = chunk
+    return [(cx + dx, cy + dy)
+            for dx in xrange(-VISION_RANGE, VISION_RANGE + 1)
+            for dy in xrange(-VISION_RANGE, VISION_RANGE + 1)]
+
+
+class InterestRegion(object):
+    """
+    The part of the world that one player currently cares about: their own
+    units, anything near their own units, and anything in (or close to) their
+    viewport. A region with no viewport contains everything.
+
+    visionChunks is anything supporting "in" for chunks, such as the live
+    dict of InterestManager.visionCounts for the player, so it always
+    reflects where their units are now.
+    """
+
+    def __init__(self, playerId, viewport, visionChunks):
+        super(InterestRegion, self).__init__()
+        self.playerId     = playerId
+        self.viewport     = viewport
+        self.visionChunks = visionChunks
+
+        if viewport is not None:
+            self.xMin, self.yMin = viewport.coord.unit
+            self.xMax, self.yMax = (viewport.coord + viewport.dist).unit
+
+    @property
+    def isEverything(self):
+        return self.viewport is None
+
+    def contains(self, unitId, pos):
+        if self.viewport is None:
+            return True
+        if unitToPlayer(unitId) == self.playerId:
+            return True
+        if pos.chunk in self.visionChunks:
+            return True
+        ux, uy = pos.unit
+        return self.xMin <= ux <= self.xMax and self.yMin <= uy <= self.yMax
+
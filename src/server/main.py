@@ -1,35 +1,59 @@
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from twisted.python import log as twistedLog
 
 from src.shared import config
 from src.server.backend import Backend
 from src.server.client_interfacer import ClientInterfacer
 from src.server.game_state_manager import GameStateManager
+from src.server.metrics import MetricsRegistry, registerServerMetrics
 from src.server.networking import startServer, ConnectionManager
+from src.server.replay import ReplayRecorder
 from src.server.stdio import setupStdio
+from src.server.tick_scheduler import TickScheduler
+from src.shared.tracing import Tracer, SERVER_STAGES
 
 def unhandledError(reason):
     twistedLog.err(reason, "Aborting due to unhandled error.")
     reactor.stop()
 
 def main(args):
-    connections = ConnectionManager()
-    startServer(args.port, connections)
+    connections = ConnectionManager(lockstep=args.lockstep)
+    startServer(args.port, connections, udp=args.udp)
 
     # TODO: have a deferred for errors raised by the backend, like we do in the
     # client? Except I'm not sure if that deferred is actually doing anything.
     backend = Backend()
-    gameStateManager = GameStateManager(backend, connections)
+    gameStateManager = GameStateManager(backend, connections,
+                                        lockstep=args.lockstep)
+    if args.record is not None:
+        gameStateManager.setRecorder(ReplayRecorder(open(args.record, "w")))
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      gameStateManager.stopRecording)
+    if args.trace is not None:
+        gameStateManager.setTracer(Tracer(SERVER_STAGES,
+                                          open(args.trace, "w")))
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      gameStateManager.stopTracing)
     clientInterfacer = ClientInterfacer(backend, gameStateManager, connections)
     setupStdio(backend)
 
     # TODO: Ugh.
     connections.setGameStateManager(gameStateManager)
     connections.setClientInterfacer(clientInterfacer)
+    connections.setProfiler(gameStateManager.profiler)
 
-    loop = LoopingCall(backend.tick)
-    deferred = loop.start(config.TICK_LENGTH)
+    scheduler = TickScheduler(backend.tick, config.TICK_LENGTH)
+    backend.setTickScheduler(scheduler)
+
+    if args.metrics_port is not None:
+        # Only load twisted.web if it's needed.
+        from src.server.metrics_server import startMetricsServer
+        registry = MetricsRegistry()
+        registerServerMetrics(registry, gameStateManager, connections,
+                              clientInterfacer, scheduler)
+        startMetricsServer(args.metrics_port, registry)
+
+    deferred = scheduler.start()
     deferred.addErrback(unhandledError)
 
     reactor.run()
@@ -0,0 +1,200 @@
+"""
+Server health metrics, in the Prometheus text format. See metrics_server
+for serving them over HTTP.
+
+Everything the server does happens on the reactor thread, so the metrics
+don't need any locking. Events are counted with Counters owned by the
+components that see them (a dict increment per event). Everything else
+(gauges such as the number of players, and figures the TickProfiler and
+TickScheduler already keep) is only computed when the metrics are scraped,
+so it costs the tick nothing.
+"""
+
+from collections import defaultdict
+
+# Quantiles of the tick duration reported in the summary.
+TICK_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter(object):
+    """
+    A monotonically increasing count of some event, optionally broken down
+    by a single label (such as the message type).
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, helpText, labelName=None):
+        super(Counter, self).__init__()
+        self.name      = name
+        self.helpText  = helpText
+        self.labelName = labelName
+        # Mapping from label value (None if there's no label) to count.
+        self.values    = defaultdict(int)
+
+    def inc(self, amount=1, label=None):
+        self.values[label] += amount
+
+    def remove(self, label):
+        # Forget a label value that will never come up again, such as a
+        # player who has left.
+        self.values.pop(label, None)
+
+    def samples(self):
+        return labelledSamples(self.labelName, self.values)
+
+
+class CallbackMetric(object):
+    """
+    A counter or gauge whose value is read from somewhere else when the
+    metrics are scraped. func returns either a number, or (if labelName is
+    given) a dict mapping label values to numbers.
+    """
+
+    def __init__(self, kind, name, helpText, func, labelName=None):
+        super(CallbackMetric, self).__init__()
+        self.kind      = kind
+        self.name      = name
+        self.helpText  = helpText
+        self.func      = func
+        self.labelName = labelName
+
+    def samples(self):
+        values = self.func()
+        if self.labelName is None:
+            values = {None: values}
+        return labelledSamples(self.labelName, values)
+
+
+class TickSummary(object):
+    """
+    Summary of tick durations, taken from a TickProfiler: quantiles over its
+    rolling window, and the sum and count over all ticks.
+    """
+
+    kind = "summary"
+
+    def __init__(self, name, helpText, profiler):
+        super(TickSummary, self).__init__()
+        self.name     = name
+        self.helpText = helpText
+        self.profiler = profiler
+
+    def samples(self):
+        samples = []
+        values = self.profiler.totalWindow.percentiles(
+            [100 * quantile for quantile in TICK_QUANTILES]
+        )
+        if values is not None:
+            for quantile, value in zip(TICK_QUANTILES, values):
+                samples.append(("", {"quantile": str(quantile)}, value))
+        samples.append(("_sum", {}, sum(self.profiler.totals.values())))
+        samples.append(("_count", {}, self.profiler.numStarts))
+        return samples
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        super(MetricsRegistry, self).__init__()
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name,
+                                               escapeHelp(metric.helpText)))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append("{}{}{} {}".format(metric.name, suffix,
+                                                formatLabels(labels),
+                                                formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+
+def registerServerMetrics(registry, gameStateManager, connections,
+                          clientInterfacer, scheduler):
+    """
+    Register the standard server metrics with registry.
+    """
+
+    gameState = gameStateManager.gameState
+    profiler  = gameStateManager.profiler
+
+    registry.register(TickSummary(
+        "warts_tick_duration_seconds", "Time spent running each tick.",
+        profiler
+    ))
+    registry.register(CallbackMetric(
+        "counter", "warts_tick_phase_seconds_total",
+        "Total time spent in each phase of the tick.",
+        lambda: dict(profiler.totals), labelName="phase"
+    ))
+    registry.register(CallbackMetric(
+        "counter", "warts_ticks_total", "Number of ticks run.",
+        lambda: scheduler.ticksRun
+    ))
+    registry.register(CallbackMetric(
+        "counter", "warts_tick_overruns_total",
+        "Number of ticks that took longer than the tick length.",
+        lambda: scheduler.overruns
+    ))
+    registry.register(CallbackMetric(
+        "counter", "warts_ticks_dropped_total",
+        "Number of ticks skipped because the server fell too far behind.",
+        lambda: scheduler.droppedTicks
+    ))
+    registry.register(CallbackMetric(
+        "gauge", "warts_simulation_lag_seconds",
+        "How far the simulation is behind real time.",
+        lambda: scheduler.lag
+    ))
+    registry.register(CallbackMetric(
+        "gauge", "warts_connected_players", "Number of connected players.",
+        lambda: len(connections.connections)
+    ))
+    registry.register(CallbackMetric(
+        "gauge", "warts_units", "Number of units in the game.",
+        lambda: len(gameState.positions)
+    ))
+    registry.register(clientInterfacer.messagesReceived)
+    registry.register(clientInterfacer.rateLimited)
+    registry.register(clientInterfacer.messagesDelayed)
+    registry.register(clientInterfacer.workDone)
+    registry.register(connections.messagesSent)
+    registry.register(connections.bytesSent)
+    registry.register(connections.bytesReceived)
+    registry.register(gameStateManager.pathsComputed)
+    registry.register(gameStateManager.pathfindingTime)
+
+
+def labelledSamples(labelName, values):
+    samples = []
+    for label, value in sorted(values.items()):
+        labels = {} if labelName is None else {labelName: str(label)}
+        samples.append(("", labels, value))
+    return samples
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escapeLabel(value))
+                          for name, value in sorted(labels.items())) + "}"
+
+
+def formatValue(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def escapeHelp(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def escapeLabel(value):
+    return escapeHelp(value).replace('"', '\\"')
@@ -0,0 +1,37 @@
+"""
+Serves the metrics from a MetricsRegistry over HTTP, for Prometheus to
+scrape.
+"""
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from src.shared.logconfig import newLogger
+
+log = newLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return self.registry.render()
+
+
+def startMetricsServer(port, registry):
+    """
+    Serve the metrics at http://localhost:<port>/metrics.
+    """
+
+    root = Resource()
+    root.putChild("metrics", MetricsResource(registry))
+    reactor.listenTCP(port, Site(root), interface="127.0.0.1")
+    log.info("Serving metrics at http://127.0.0.1:%d/metrics", port)
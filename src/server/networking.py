@@ -1,17 +1,94 @@
+import bisect
+import hashlib
+import hmac
+import logging
+import os
+from collections import deque, OrderedDict
+from struct import pack
+
 from twisted.internet import protocol, reactor, endpoints
-from twisted.protocols.basic import Int16StringReceiver
+from twisted.internet.interfaces import IPushProducer
+from twisted.protocols.basic import Int16StringReceiver, StringTooLongError
+from zope.interface import implementer
 
-from src.shared.logconfig import newLogger
+from src.server.interest import InterestManager
+from src.server.metrics import Counter
+from src.shared.datagram import ReliableChannel, encodePacket, \
+    decodePacket, KIND_HELLO, KIND_RELIABLE, KIND_UNRELIABLE, KIND_ACK, \
+    KIND_UNRELIABLE_ACK, KIND_BYE, KIND_CHALLENGE, COOKIE_SIZE, \
+    RESEND_INTERVAL, CONNECTION_TIMEOUT, FRAME_SIZE
+from src.shared.geometry import Distance
+from src.shared.ident import unitToPlayer
+from src.shared.logconfig import newLogger, ThrottledLogger
+from src.shared.message_infrastructure import InvalidMessageError
 from src.shared import messages
 
 log = newLogger(__name__)
 
+# Every message received from a client is logged, but only up to this many
+# per second per client (after an initial burst of twice that), so that a
+# busy server doesn't spend its ticks writing to the terminal.
+MESSAGE_LOG_RATE = 10
+messageLog = ThrottledLogger(log, MESSAGE_LOG_RATE,
+                             burst=2 * MESSAGE_LOG_RATE)
+
+# Maximum number of messages a StreamingProducer writes before giving the
+# reactor a chance to run other things (such as ticks).
+MAX_MESSAGES_PER_BURST = 4
+
+# Each unit's position is sent as an absolute SetPos (a "keyframe") at least
+# once every this many batches, even if it could be sent as a delta. This
+# bounds how long any error in a client's copy of a position can persist.
+KEYFRAME_INTERVAL = 50
+
+# Placeholder in ConnectionManager.pendingBroadcasts for where the batch's
+# unit updates go. Those are encoded separately for each connection, since
+# they depend on what that connection has already been sent and which part of
+# the world it's interested in.
+UNITS_SLOT = object()
+
+# If a connection's transport has been refusing data for longer than this many
+# seconds, stop queueing supersedable messages for it and send it a full
+# resync once it catches up.
+MAX_LAG = 2.0
+
+# Maximum number of messages queued for a connection whose transport isn't
+# accepting data. Exceeding it also triggers a resync.
+MAX_QUEUED_MESSAGES = 256
+
+# Messages that a resync doesn't cover (such as lockstep ticks) still have to
+# be queued for a resyncing connection. If it has been refusing data for
+# longer than this many seconds, or has MAX_QUEUED_MESSAGES of those queued,
+# give up on it and disconnect it, rather than let the queue grow forever.
+MAX_STALL = 30.0
+
+# A DatagramConnection counts as congested once this many bytes sent on its
+# reliable channel are waiting to be acknowledged, and stops being congested
+# once that's down to half this.
+MAX_UNACKED_BYTES = 2**16
 
-def startServer(port, connections):
+# Seconds for which the cookie in a KIND_CHALLENGE stays the same. A client
+# has between one and two of these to echo it back.
+COOKIE_LIFETIME = 10.0
+
+# Number of SetPos messages per unreliable packet.
+MAX_POSITIONS_PER_PACKET = 32
+
+# Number of unacknowledged unreliable packets a DatagramConnection remembers
+# the contents of. Acks for older packets are ignored, which just means the
+# positions in them get sent again.
+MAX_INFLIGHT_PACKETS = 64
+
+
+def startServer(port, connections, udp=False):
     serverString = "tcp:{}".format(port)
     server = endpoints.serverFromString(reactor, serverString)
     server.listen(NetworkConnectionFactory(connections))
 
+    # UDP clients connect to the same port number.
+    if udp:
+        reactor.listenUDP(port, DatagramServer(connections))
+
 
 class NetworkConnectionFactory(protocol.Factory):
     def __init__(self, connections):
@@ -25,64 +102,863 @@ class NetworkConnectionFactory(protocol.Factory):
 
 
 class ConnectionManager(object):
-    def __init__(self):
+    def __init__(self, maxLag=MAX_LAG, maxQueued=MAX_QUEUED_MESSAGES,
+                 clock=None, lockstep=False, maxStall=MAX_STALL):
         # Mapping from player indices to connection objects.
         self.connections = {}
+        # The same connections, in ascending order by ID. This is kept up to
+        # date as connections come and go, so that broadcasting doesn't have
+        # to sort the ids every time. Store it as a tuple and replace it on
+        # every change, so that anyone iterating over the old one isn't
+        # disturbed if a connection is added or removed partway through.
+        self.sortedIds         = []
+        self.sortedConnections = ()
         # TODO: Don't let the ID grow forever.
         self.nextId      = 0
 
+        # Thresholds past which a lagging connection is resynced, and then
+        # disconnected; see BaseConnection.checkLag.
+        self.maxLag    = maxLag
+        self.maxQueued = maxQueued
+        self.maxStall  = maxStall
+        # Used to measure how long connections have been lagging. Tests can
+        # substitute a twisted.internet.task.Clock.
+        self.clock     = reactor if clock is None else clock
+
+        # (data, supersedable) pairs for broadcasts that have been batched up
+        # but not yet written to the connections, or None if we aren't
+        # batching. The data is already framed.
+        self.pendingBroadcasts = None
+        # True if any connection has messages of its own held back for the
+        # current batch; see sendData.
+        self.unicastsPending   = False
+        # Ids of units that have been created, moved, or deleted during the
+        # current batch.
+        self.changedUnits   = set()
+        # Mapping from ids of units whose change during the current batch
+        # was the result of a traced order (see src.shared.tracing) to the
+        # trace id. Updates for them are always sent as a NewObelisk or
+        # SetPos, which can carry the trace id.
+        self.tracedUnits    = {}
+        # Number of batches that included unit updates, used to schedule
+        # keyframes.
+        self.unitBatchCount = 0
+
+        # Tracks which part of the world each client cares about.
+        self.interest = InterestManager()
+        # True if some client's interest region has changed since the last
+        # batch that included unit updates.
+        self.interestChanged = False
+
+        # In lockstep mode, clients run the simulation themselves, so they
+        # aren't sent any unit updates or resource amounts.
+        self.lockstep = lockstep
+
         self.gameStateManager = None
         self.clientInterfacer = None
+        # If set, a TickProfiler that counts the messages and bytes sent.
+        self.profiler         = None
+
+        # Metrics (see src.server.metrics).
+        # Messages are counted when they're framed for a connection (see
+        # messagesFramed), so this includes any that are later dropped from a
+        # congested connection's queue.
+        self.messagesSent = Counter("warts_messages_sent_total",
+                                    "Messages sent to clients, by type.",
+                                    labelName="type")
+        self.bytesSent    = Counter("warts_bytes_sent_total",
+                                    "Bytes sent to each connected player.",
+                                    labelName="player")
+        self.bytesReceived = Counter("warts_bytes_received_total",
+                                     "Bytes received from each connected "
+                                     "player.", labelName="player")
 
     # These next two methods must be called immediately after __init__, before
     # any other methods.
     def setGameStateManager(self, gameStateManager):
         self.gameStateManager = gameStateManager
+        self.interest.setGameState(gameStateManager.gameState)
 
     def setClientInterfacer(self, clientInterfacer):
         self.clientInterfacer = clientInterfacer
 
-    def newConnection(self):
-        connection = NetworkConnection(self.nextId, self.clientInterfacer,
-                                       self)
+    def setProfiler(self, profiler):
+        self.profiler = profiler
+
+    def newConnection(self, connectionType=None, *args):
+        """
+        Create a connection for a new player and return it. By default this
+        is a NetworkConnection; otherwise it's
+            connectionType(playerId, clientInterfacer, self, *args)
+        """
+
+        if connectionType is None:
+            connectionType = NetworkConnection
+        connection = connectionType(self.nextId, self.clientInterfacer, self,
+                                    *args)
         self.connections[self.nextId] = connection
+        bisect.insort(self.sortedIds, self.nextId)
+        self.updateSortedConnections()
         self.nextId += 1
         return connection
 
     def removeConnection(self, connection):
         if connection.playerId in self.connections:
             del self.connections[connection.playerId]
+            index = bisect.bisect_left(self.sortedIds, connection.playerId)
+            del self.sortedIds[index]
+            self.updateSortedConnections()
+            self.interest.removePlayer(connection.playerId)
+            self.bytesSent.remove(connection.playerId)
+            self.bytesReceived.remove(connection.playerId)
+            if self.clientInterfacer is not None:
+                self.clientInterfacer.removePlayer(connection.playerId)
             self.gameStateManager.removePlayer(connection.playerId)
         else:
             log.warning("Failed to remove connection.")
 
+    def tick(self):
+        # Report messages from clients that went unlogged, and forget about
+        # clients that have gone quiet.
+        messageLog.reportSuppressed()
+
+    def updateSortedConnections(self):
+        self.sortedConnections = tuple(self.connections[playerId]
+                                       for playerId in self.sortedIds)
+
     def reportRemainingConnections(self):
         log.info("%s connections remain.", len(self.connections))
 
-    def broadcastMessage(self, message):
+    def startBatch(self):
+        """
+        Start collecting broadcast messages instead of sending them right
+        away. They are sent all at once by the next call to flushBatch.
+        """
+
+        if self.pendingBroadcasts is None:
+            self.pendingBroadcasts = []
+            if self.interestChanged:
+                self.pendingBroadcasts.append(UNITS_SLOT)
+
+    def flushBatch(self):
+        """
+        Send any messages collected since startBatch, and stop batching.
+        """
+
+        pending = self.pendingBroadcasts
+        self.pendingBroadcasts = None
+        unicastsPending = self.unicastsPending
+        self.unicastsPending = False
+        if not pending and not unicastsPending:
+            return
+
+        if UNITS_SLOT not in pending:
+            for connection in self:
+                entries = self.batchEntries(connection, pending)
+                if entries:
+                    connection.writeBroadcasts(entries)
+            return
+
+        # Everything other than the unit updates is shared by all the
+        # connections (apart from any messages to just one of them), so
+        # still only join those once.
+        shared = splitAtUnitsSlot(pending)
+
+        changedUnits = self.changedUnits
+        self.changedUnits = set()
+        self.interestChanged = False
+        self.unitBatchCount += 1
+
+        gameState = self.gameStateManager.gameState
+
+        # Connections that have been sent the same things in the past and are
+        # interested in the same things will usually be sent the same updates
+        # now, so only encode each distinct set of updates once.
+        encodings = {}
         for connection in self:
-            connection.sendMessage(message)
+            entries = self.batchEntries(connection, pending)
+            if connection.congested:
+                # Don't send this connection anything about units until it
+                # has caught up; by then some of these updates may have been
+                # superseded. See connectionDrained.
+                connection.staleUnits.update(changedUnits)
+                connection.queueBroadcasts(entries)
+                continue
+            if entries is pending:
+                before, after = shared
+            else:
+                before, after = splitAtUnitsSlot(entries)
+            updates = self.computeUnitUpdates(connection, gameState,
+                                              changedUnits)
+            self.writeUnitUpdates(connection, updates, gameState, encodings,
+                                  before, after)
+
+        if self.tracedUnits:
+            tracer = self.gameStateManager.tracer
+            if tracer is not None:
+                for unitId, traceId in self.tracedUnits.iteritems():
+                    tracer.mark((unitToPlayer(unitId), traceId), "sent")
+            self.tracedUnits = {}
+
+    @staticmethod
+    def batchEntries(connection, pending):
+        """
+        Return the entries of a batch to write to a connection: pending (the
+        broadcasts), with any messages sent to just that connection during
+        the batch merged in where they were sent. Returns pending itself if
+        there weren't any.
+        """
+
+        unicasts = connection.pendingUnicasts
+        if not unicasts:
+            return pending
+        connection.pendingUnicasts = []
+
+        entries = []
+        start = 0
+        for index, data, supersedable in unicasts:
+            entries.extend(pending[start:index])
+            entries.append((data, supersedable))
+            start = index
+        entries.extend(pending[start:])
+        return entries
+
+    def computeUnitUpdates(self, connection, gameState, changedUnits,
+                           resync=False):
+        """
+        Work out which unit updates to send to the given connection, and
+        record them as that connection's new baseline. Return a tuple
+            (entered, left, deltas, keyframes)
+        where:
+          - entered is a tuple of ids of units that the client should be told
+            about, because they were just created or have entered its
+            interest region
+          - left is a tuple of ids of units the client should forget about,
+            because they were deleted or have left its interest region
+          - deltas is a tuple of (unitId, (dx, dy)) pairs for units that moved
+            a short distance
+          - keyframes is a tuple of ids of units whose absolute positions
+            should be sent
+        The result is hashable, so that identical updates for different
+        connections can share an encoding.
+
+        If resync is True, every unit the client knows about is sent as a
+        keyframe, whether or not it has moved.
+
+        Apart from the units in changedUnits, only units in chunks that may
+        have entered or left the client's interest region are looked at.
+        """
+
+        playerId = connection.playerId
+        region = self.interest.getRegion(playerId)
+
+        changedChunks = self.interest.takeChangedChunks(playerId)
+        if resync or changedChunks is None:
+            # We need to resend everything (or the region may have changed
+            # anywhere), so consider every unit.
+            candidates = set(gameState.positions)
+            candidates.update(connection.knownPositions)
+            candidates.update(changedUnits)
+        elif changedChunks:
+            candidates = self.interest.unitsInChunks(changedChunks)
+            candidates.update(changedUnits)
+        else:
+            candidates = changedUnits
+        connection.interestChanged = False
+
+        entered   = []
+        left      = []
+        deltas    = []
+        keyframes = []
+        knownPositions = connection.knownPositions
+        for unitId in sorted(candidates):
+            pos    = gameState.positions.get(unitId)
+            oldPos = knownPositions.get(unitId)
+            isVisible = pos is not None and region.contains(unitId, pos)
+
+            if not isVisible:
+                if oldPos is not None:
+                    del knownPositions[unitId]
+                    self.unitLeft(connection, unitId)
+                    left.append(unitId)
+                continue
+
+            knownPositions[unitId] = pos
+            if oldPos is None:
+                self.unitEntered(connection, unitId)
+                entered.append(unitId)
+            elif resync:
+                keyframes.append(unitId)
+            elif oldPos != pos:
+                delta = pos - oldPos
+                dx, dy = delta.unit
+                if not self.isKeyframeDue(unitId) and \
+                        unitId not in self.tracedUnits and \
+                        abs(dx) <= messages.MAX_POS_DELTA and \
+                        abs(dy) <= messages.MAX_POS_DELTA:
+                    deltas.append((unitId, (dx, dy)))
+                else:
+                    keyframes.append(unitId)
+
+        return (tuple(entered), tuple(left), tuple(deltas), tuple(keyframes))
+
+    @staticmethod
+    def encodeUnitUpdates(updates, gameState, traceIds):
+        """
+        Serialize and frame the result of computeUnitUpdates. traceIds maps
+        unit ids to the trace ids to send with their updates.
+        """
+
+        entered, left, deltas, keyframes = updates
+        parts = []
+        for unitId in left:
+            msg = messages.DeleteObelisk(unitId)
+            parts.append(frameString(msg.serialize()))
+        for unitId in entered:
+            msg = messages.NewObelisk(unitId, gameState.getPos(unitId),
+                                      traceIds.get(unitId))
+            parts.append(frameString(msg.serialize()))
+        if deltas:
+            msg = messages.PosDeltas([(unitId, Distance.fromUnit(delta))
+                                      for unitId, delta in deltas])
+            parts.append(frameString(msg.serialize()))
+        for unitId in keyframes:
+            msg = messages.SetPos(unitId, gameState.getPos(unitId),
+                                  traceIds.get(unitId))
+            parts.append(frameString(msg.serialize()))
+        return "".join(parts)
+
+    def countUnitUpdates(self, updates):
+        """
+        Count the messages that encodeUnitUpdates makes for updates.
+        """
+
+        entered, left, deltas, keyframes = updates
+        if left:
+            self.messagesFramed(messages.DeleteObelisk.command, len(left))
+        if entered:
+            self.messagesFramed(messages.NewObelisk.command, len(entered))
+        if deltas:
+            self.messagesFramed(messages.PosDeltas.command)
+        if keyframes:
+            self.messagesFramed(messages.SetPos.command, len(keyframes))
+
+    def writeUnitUpdates(self, connection, updates, gameState, encodings,
+                         before="", after=""):
+        """
+        Write the result of computeUnitUpdates to a connection, between the
+        already-framed data before and after. encodings is a dict used to
+        share encodings between connections.
+
+        For connections that send positions over an unreliable channel, only
+        the units entering and leaving go with the rest of the data; the
+        moved units are handed to the connection separately (except for
+        traced units, whose updates have to carry their trace ids). So are
+        the entering ones, even though their positions are in the reliable
+        NewObelisks: a unit may be entering again after having left, and
+        its position has to be sent in a newer unreliable packet than any
+        from before it left that may still be on the way.
+        """
+
+        moved = None
+        if connection.unreliablePositions:
+            entered, left, deltas, keyframes = updates
+            moved = list(entered)
+            moved.extend(unitId for unitId, _ in deltas)
+            moved.extend(unitId for unitId in keyframes
+                         if unitId not in self.tracedUnits)
+            traced = tuple(unitId for unitId in keyframes
+                           if unitId in self.tracedUnits)
+            updates = (entered, left, (), traced)
+
+        if updates not in encodings:
+            encodings[updates] = self.encodeUnitUpdates(updates, gameState,
+                                                        self.tracedUnits)
+        self.countUnitUpdates(updates)
+        data = before + encodings[updates] + after
+        if data:
+            connection.writeFramed(data)
+
+        if moved:
+            connection.positionsChanged(moved)
+
+    def messagesFramed(self, command, count=1):
+        """
+        Count count messages of the given type that have been framed to be
+        written to some connection. A message broadcast to every connection
+        counts once for each of them.
+        """
+
+        self.messagesSent.values[command] += count
+        if self.profiler is not None:
+            self.profiler.count("messagesSent", count)
+
+    def dataSent(self, connection, length):
+        """
+        Called with the number of bytes written to any connection's
+        transport. (The messages in them have already been counted, by
+        messagesFramed.)
+        """
 
-    def sendMessage(self, playerId, message, dropOnFailure=False):
+        self.bytesSent.inc(length, label=connection.playerId)
+        if self.profiler is not None:
+            self.profiler.count("bytesSent", length)
+
+    def unitEntered(self, connection, unitId):
+        # Called when a client is about to be told about a unit, either
+        # because it's new or because it has come into view.
+        log.debug("Unit %s entered the interest region of player %s.",
+                  unitId, connection.playerId)
+
+    def unitLeft(self, connection, unitId):
+        # Called when a client is about to be told to forget about a unit,
+        # either because it's been deleted or because it has gone out of view.
+        log.debug("Unit %s left the interest region of player %s.",
+                  unitId, connection.playerId)
+
+    def isKeyframeDue(self, unitId):
+        # Stagger the keyframes for different units across batches, but keep
+        # them on the same batch for every connection, so that connections
+        # can keep sharing encodings.
+        return (self.unitBatchCount + hash(unitId)) % KEYFRAME_INTERVAL == 0
+
+    def interruptBatch(self):
+        """
+        Send anything batched so far, but keep batching afterward. Used before
+        writing to a single player other than through the batch: anything
+        broadcast earlier in the batch was logically sent before that, so it
+        has to go out first to keep everything in order.
+        """
+
+        if self.pendingBroadcasts is not None:
+            self.flushBatch()
+            self.startBatch()
+
+    def broadcastMessage(self, message, supersedable=False):
+        """
+        Send a message to every player. If supersedable is True, the message
+        may be dropped for clients that have fallen far behind, because the
+        resync they'll get when they catch up makes it redundant.
+        """
+
+        # Serialize the message only once, no matter how many clients there
+        # are.
+        data = frameString(message.serialize())
+        self.messagesFramed(message.command, len(self.sortedConnections))
+        if self.pendingBroadcasts is not None:
+            self.pendingBroadcasts.append((data, supersedable))
+        else:
+            for connection in self:
+                connection.writeFramed(data, supersedable)
+
+    def unitCreated(self, unitId, traceId=None):
+        gameState = self.gameStateManager.gameState
+        self.interest.unitCreated(unitId, gameState.getPos(unitId))
+        self.unitChanged(unitId, traceId)
+
+    def unitDeleted(self, unitId):
+        self.interest.unitDeleted(unitId)
+        self.unitChanged(unitId)
+
+    def unitMoved(self, unitId, traceId=None):
+        gameState = self.gameStateManager.gameState
+        self.interest.unitMoved(unitId, gameState.getPos(unitId))
+        self.unitChanged(unitId, traceId)
+
+    def unitChanged(self, unitId, traceId=None):
+        """
+        Note that a unit has been created, moved, or deleted in the game
+        state. Clients who are interested in that unit will be sent an update
+        when the current batch is flushed: a NewObelisk or DeleteObelisk if
+        the unit has entered or left their interest region (which includes
+        being created or deleted), otherwise a compact delta from the last
+        position that client was sent or an absolute SetPos.
+
+        If the change was the result of a traced order, traceId is its trace
+        id, to be sent along with the update.
+        """
+
+        if self.lockstep:
+            return
+
+        if self.pendingBroadcasts is None:
+            self.startBatch()
+            self.unitChanged(unitId, traceId)
+            self.flushBatch()
+            return
+
+        if traceId is not None:
+            self.tracedUnits[unitId] = traceId
+
+        if not self.changedUnits and \
+                UNITS_SLOT not in self.pendingBroadcasts:
+            self.pendingBroadcasts.append(UNITS_SLOT)
+        self.changedUnits.add(unitId)
+
+    def resourcesChanged(self, playerId, amount):
+        if self.lockstep:
+            return
+        # If the player has fallen behind, a resync will send them their
+        # latest resource amount anyway.
+        self.sendMessage(playerId, messages.ResourceAmt(amount),
+                         dropOnFailure=True, supersedable=True)
+
+    def setViewport(self, playerId, rect):
+        """
+        Record the part of the world that a player's camera is showing. Their
+        updates will be limited to units near that and near their own units,
+        starting from the next batch.
+        """
+
+        if self.lockstep:
+            # Everyone simulates every unit anyway.
+            return
+
+        self.interest.setViewport(playerId, rect)
+        self.connections[playerId].interestChanged = True
+        # Make sure the next batch updates this connection even if nothing
+        # else happens.
+        self.interestChanged = True
+
+    def setKnownPositions(self, playerId, units):
+        """
+        Record that a player has been sent the given (unitId, pos) pairs by
+        some other means (such as a UnitSnapshot), so that later updates can
+        be sent as deltas from them.
+        """
+
+        knownPositions = self.connections[playerId].knownPositions
+        for unitId, pos in units:
+            knownPositions[unitId] = pos
+
+    def connectionDrained(self, connection):
+        """
+        Called when a connection's transport starts accepting data again
+        after having been full. Send everything that was held back while it
+        was full, and catch it up on any units that changed in the meantime.
+        The catch-up goes where the first of the updates it replaces would
+        have gone, so that the client isn't sent the ticks that passed while
+        it was behind before the moves that happened during them. Since unit
+        updates are computed against what the client was last sent, a unit
+        that moved many times only gets one update here.
+        """
+
+        self.interruptBatch()
+
+        resync = connection.needsResync
+        caughtUp = False
+        for data, supersedable in connection.takeQueued():
+            if data is UNITS_SLOT:
+                self.catchUp(connection, resync)
+                caughtUp = True
+            else:
+                connection.writeFramed(data, supersedable)
+        if not caughtUp:
+            self.catchUp(connection, resync)
+
+    def catchUp(self, connection, resync):
+        """
+        Send a connection that has fallen behind the unit updates it missed,
+        or if resync is True, everything it needs to know about the current
+        state.
+        """
+
+        gameState = self.gameStateManager.gameState
+        if resync:
+            playerId = connection.playerId
+            connection.sendMessage(
+                messages.ResourceAmt(gameState.resources[playerId])
+            )
+
+        if connection.staleUnits or connection.interestChanged or resync:
+            staleUnits = connection.staleUnits
+            connection.staleUnits = set()
+            updates = self.computeUnitUpdates(connection, gameState,
+                                              staleUnits, resync=resync)
+            self.writeUnitUpdates(connection, updates, gameState, {})
+
+    def sendMessage(self, playerId, message, dropOnFailure=False,
+                    supersedable=False):
         if dropOnFailure and playerId not in self.connections:
             return
-        self.connections[playerId].sendMessage(message)
+        self.sendData(playerId, message.serialize(), type(message),
+                      supersedable)
+
+    def sendData(self, playerId, data, messageType, supersedable=False):
+        """
+        Send an already-serialized message, of the given type, to a single
+        player. See broadcastMessage for the meaning of supersedable.
+        """
+
+        self.messagesFramed(messageType.command)
+        connection = self.connections[playerId]
+        data = frameString(data)
+        if self.pendingBroadcasts is None:
+            connection.writeFramed(data, supersedable)
+            return
+
+        # Anything broadcast earlier in the batch was logically sent before
+        # this, so it has to go out first. Rather than sending the batch so
+        # far (and so writing to every connection once more), hold this back
+        # too, noting where it goes among the broadcasts.
+        connection.pendingUnicasts.append(
+            (len(self.pendingBroadcasts), data, supersedable)
+        )
+        self.unicastsPending = True
+
+    def streamData(self, playerId, dataList, messageType, onDone=None):
+        """
+        Send a sequence of already-serialized messages, all of the given
+        type, to a single player, only as fast as their connection can take
+        them. Messages sent by other means in the meantime are interleaved
+        with these. onDone, if given, is called with no arguments once the
+        last one has been written.
+        """
+
+        self.interruptBatch()
+        # Count them all now, rather than as each one is written.
+        self.messagesFramed(messageType.command, len(dataList))
+        producer = StreamingProducer(self.connections[playerId], dataList,
+                                     onDone=onDone, clock=self.clock)
+        producer.start()
 
     def __iter__(self):
         # Iterate over all connections, in ascending order by ID.
-        for playerId in sorted(self.connections.keys()):
-            yield self.connections[playerId]
+        return iter(self.sortedConnections)
+
+
+@implementer(IPushProducer)
+class BaseConnection(object):
+    """
+    Connection to a single client, independent of the transport used.
+
+    The connection acts as a push producer for its transport, so that it's
+    told when the transport can't take any more data. While that's the case
+    (the connection is "congested"), messages are held in a bounded queue
+    instead of piling up in the transport, and unit updates are not computed
+    at all; ConnectionManager.connectionDrained catches the client up once
+    the transport is ready again. If the client falls too far behind,
+    supersedable messages are dropped and it gets a full resync instead.
+
+    Subclasses must define writeToTransport, and disconnect, which closes the
+    connection without waiting for anything to be sent and arranges for it
+    to be removed from the ConnectionManager (not right away, since that may
+    be in the middle of a tick).
+    """
 
+    # True if unit positions are sent to this client over an unreliable
+    # channel, via positionsChanged, rather than along with everything else.
+    unreliablePositions = False
 
-class NetworkConnection(Int16StringReceiver):
     def __init__(self, playerId, clientInterfacer, connections):
         self.playerId = playerId
         self.connections = connections
         self.clientInterfacer = clientInterfacer
 
+        # Set when this client's interest region has changed in some way other
+        # than their own units moving.
+        self.interestChanged = False
+
+        # Mapping from unit ids to the last position of that unit we sent to
+        # this client. This has an entry for exactly the units the client
+        # currently knows about. Everything except positions sent over an
+        # unreliable channel is sure to reach the client eventually (or else
+        # the connection will be lost), so these are the baselines that
+        # PosDeltas are relative to.
+        self.knownPositions = {}
+
+        # True while the transport can't take any more data.
+        self.congested      = False
+        # When the connection last became congested.
+        self.congestedSince = None
+        # (data, supersedable) pairs held back while congested. data may also
+        # be UNITS_SLOT, marking where the first unit updates that weren't
+        # computed would have gone; see ConnectionManager.connectionDrained.
+        self.outboundQueue  = deque()
+        # True if outboundQueue has a UNITS_SLOT in it.
+        self.unitsSlotQueued = False
+        # Set once this client has fallen so far behind that it needs a full
+        # resync when it catches up.
+        self.needsResync    = False
+        # Ids of units that changed while congested.
+        self.staleUnits     = set()
+        # (index, data, supersedable) for messages sent to just this client
+        # during the current batch, where index is the number of broadcasts
+        # in the batch that go before it. See ConnectionManager.sendData.
+        self.pendingUnicasts = []
+        # The StreamingProducer currently writing to this connection, if any.
+        # A transport only accepts one producer, so this connection passes
+        # pauses and resumes on to it.
+        self.stream         = None
+        # Set once this client has fallen hopelessly behind and is being
+        # disconnected; nothing more is written to it.
+        self.abandoned      = False
+
+    def handshake(self):
+        self.sendMessage(messages.YourIdIs(self.playerId))
+
+    def sendMessage(self, message):
+        self.connections.messagesFramed(message.command)
+        self.sendString(message.serialize())
+
+    def sendString(self, string):
+        # Whoever serialized string is responsible for counting it; see
+        # ConnectionManager.messagesFramed.
+        self.writeFramed(frameString(string))
+
+    def writeFramed(self, data, supersedable=False):
+        """
+        Write data that has already been framed by frameString, or queue it
+        if the transport isn't currently accepting data.
+        """
+
+        if self.abandoned:
+            return
+        if not self.congested:
+            self.sendToTransport(data)
+            return
+
+        self.checkLag()
+        if self.abandoned or (supersedable and self.needsResync):
+            # The resync will cover this (or there won't be one).
+            return
+        self.outboundQueue.append((data, supersedable))
+
+    def writeBroadcasts(self, entries):
+        """
+        Write a list of (data, supersedable) pairs.
+        """
+
+        if not self.congested:
+            self.sendToTransport("".join(data for data, _ in entries))
+            return
+
+        for data, supersedable in entries:
+            self.writeFramed(data, supersedable)
+
+    def queueBroadcasts(self, entries):
+        """
+        Queue a batch's entries while congested. Unlike writeBroadcasts, the
+        entries may include UNITS_SLOT, which marks where the batch's unit
+        updates would have gone.
+        """
+
+        for entry in entries:
+            if entry is not UNITS_SLOT:
+                self.writeFramed(*entry)
+            elif not self.unitsSlotQueued and not self.abandoned:
+                # Only the first one matters: the catch-up covers them all.
+                self.outboundQueue.append((UNITS_SLOT, False))
+                self.unitsSlotQueued = True
+
+    def messageReceived(self, data):
+        # Count the length prefix too, to match the bytes sent.
+        self.connections.bytesReceived.inc(FRAME_SIZE + len(data),
+                                           label=self.playerId)
+        self.clientInterfacer.stringReceived(self.playerId, data)
+
+    def sendToTransport(self, data):
+        self.connections.dataSent(self, len(data))
+        self.writeToTransport(data)
+
+    def takeQueued(self):
+        """
+        Return everything held back while congested, and clear the queue and
+        needsResync. The caller must write it all (see
+        ConnectionManager.connectionDrained). Note that writing it may make
+        the connection congested again partway through, in which case the
+        rest is queued again, in order.
+        """
+
+        queue = self.outboundQueue
+        self.outboundQueue   = deque()
+        self.needsResync     = False
+        self.unitsSlotQueued = False
+        return queue
+
+    def checkLag(self):
+        """
+        Start a resync if this connection has been congested for too long or
+        has too much queued, and give up on it if even that isn't enough.
+        """
+
+        connections = self.connections
+        lag = connections.clock.seconds() - self.congestedSince
+        if not self.needsResync and (
+                lag > connections.maxLag or
+                len(self.outboundQueue) >= connections.maxQueued):
+            log.warning("Player %s has fallen %.1f seconds (%s messages) "
+                        "behind; resyncing.",
+                        self.playerId, lag, len(self.outboundQueue))
+            self.needsResync = True
+            self.outboundQueue = deque(
+                entry for entry in self.outboundQueue if not entry[1]
+            )
+
+        # What's left can't be dropped, so if there's still too much of it,
+        # the client will never catch up.
+        if self.needsResync and (
+                lag > connections.maxStall or
+                len(self.outboundQueue) >= connections.maxQueued):
+            log.warning("Player %s has fallen %.1f seconds (%s messages) "
+                        "behind, even after a resync; disconnecting.",
+                        self.playerId, lag, len(self.outboundQueue))
+            self.abandon()
+
+    def abandon(self):
+        """
+        Stop writing to this connection, throw away everything queued for it,
+        and disconnect it.
+        """
+
+        self.abandoned     = True
+        self.outboundQueue = deque()
+        self.stopProducing()
+        self.disconnect()
+
+    def registerStream(self, stream):
+        if self.stream is not None:
+            raise RuntimeError("Connection {} is already streaming."
+                               .format(self.playerId))
+        self.stream = stream
+        if self.congested:
+            stream.pauseProducing()
+
+    def unregisterStream(self):
+        self.stream = None
+
+    def pauseProducing(self):
+        if not self.congested:
+            self.congested = True
+            self.congestedSince = self.connections.clock.seconds()
+        if self.stream is not None:
+            self.stream.pauseProducing()
+
+    def resumeProducing(self):
+        self.congested = False
+        self.connections.connectionDrained(self)
+
+        # Catching up may have filled the buffer again, in which case the
+        # stream will have to wait some more.
+        if not self.congested and self.stream is not None:
+            self.stream.resumeProducing()
+
+    def stopProducing(self):
+        if self.stream is not None:
+            self.stream.stopProducing()
+
+
+
+class NetworkConnection(BaseConnection, Int16StringReceiver):
+    """
+    Connection to a single client over TCP.
+    """
+
     def connectionMade(self):
         peer = self.transport.getPeer()
 
+        self.transport.registerProducer(self, True)
+
         self.handshake()
         self.clientInterfacer.handshake(self.playerId)
 
@@ -90,9 +966,6 @@ class NetworkConnection(Int16StringReceiver):
         log.info("[%s:%s] <new connection with id %s>",
                  peer.host, peer.port, self.playerId)
 
-    def handshake(self):
-        self.sendMessage(messages.YourIdIs(self.playerId))
-
     def connectionLost(self, reason=protocol.connectionDone):
         peer = self.transport.getPeer()
         self.connections.removeConnection(self)
@@ -103,10 +976,382 @@ class NetworkConnection(Int16StringReceiver):
         self.connections.reportRemainingConnections()
 
     def stringReceived(self, data):
-        peer = self.transport.getPeer()
-        self.clientInterfacer.stringReceived(self.playerId, data)
+        self.messageReceived(data)
 
-        log.info("[%s:%s] %r", peer.host, peer.port, data)
+        if messageLog.isEnabledFor(logging.INFO):
+            peer = self.transport.getPeer()
+            messageLog.info("[%s:%s] %r", peer.host, peer.port, data,
+                            key=self.playerId)
 
-    def sendMessage(self, message):
-        self.sendString(message.serialize())
+    def writeToTransport(self, data):
+        self.transport.write(data)
+
+    def disconnect(self):
+        # Not loseConnection, which would wait for everything already in the
+        # transport's buffer to be sent first. connectionLost is still called
+        # (later).
+        self.transport.abortConnection()
+
+
+class DatagramServer(protocol.DatagramProtocol):
+    """
+    Accepts UDP clients and passes each packet on to the connection for the
+    address it came from.
+
+    A HELLO from a new address is answered with a CHALLENGE holding a cookie
+    derived from the address, and only a HELLO that echoes the cookie back
+    sets up a connection. That way nothing is sent to a (possibly forged)
+    address beyond a packet no bigger than the one that came from it, and no
+    state is kept for addresses that haven't proved they can receive.
+    """
+
+    def __init__(self, connections):
+        # Parent class has no init so we cannot call it
+        self.connections = connections
+        # Mapping from (host, port) pairs to DatagramConnections.
+        self.connectionsByAddress = {}
+        # Key for the cookies; a new one each run, so cookies from an earlier
+        # run are no good.
+        self.secret = os.urandom(16)
+
+    def datagramReceived(self, packet, address):
+        try:
+            kind, seq, payload = decodePacket(packet)
+        except InvalidMessageError:
+            log.warning("[%s:%s] Ignoring malformed packet %r",
+                        address[0], address[1], packet)
+            return
+
+        connection = self.connectionsByAddress.get(address)
+        if connection is None:
+            if kind != KIND_HELLO:
+                # Probably left over from a connection that's since timed
+                # out.
+                log.debug("[%s:%s] Ignoring packet from unknown client",
+                          address[0], address[1])
+                return
+            if len(payload) < COOKIE_SIZE:
+                # Answering would send more than we received.
+                log.debug("[%s:%s] Ignoring short HELLO",
+                          address[0], address[1])
+                return
+            if not self.cookieValid(address, payload[:COOKIE_SIZE]):
+                self.sendPacket(address, KIND_CHALLENGE, 0,
+                                self.cookie(address, self.cookieWindow()))
+                return
+            connection = self.connections.newConnection(DatagramConnection,
+                                                        self, address)
+            self.connectionsByAddress[address] = connection
+            connection.connectionMade()
+        else:
+            connection.packetReceived(kind, seq, payload)
+
+    def sendPacket(self, address, kind, seq, payload):
+        self.transport.write(encodePacket(kind, seq, payload), address)
+
+    def cookieWindow(self):
+        # Cookies change every COOKIE_LIFETIME seconds; one from the previous
+        # window is still accepted, so a cookie is good for at least that
+        # long.
+        return int(self.connections.clock.seconds() // COOKIE_LIFETIME)
+
+    def cookie(self, address, window):
+        host, port = address
+        return hmac.new(self.secret, "{}:{}:{}".format(host, port, window),
+                        hashlib.sha256).digest()[:COOKIE_SIZE]
+
+    def cookieValid(self, address, cookie):
+        window = self.cookieWindow()
+        return any(hmac.compare_digest(cookie, self.cookie(address, w))
+                   for w in (window, window - 1))
+
+    def forgetConnection(self, connection):
+        self.connectionsByAddress.pop(connection.address, None)
+
+
+class DatagramConnection(BaseConnection):
+    """
+    Connection to a single client over UDP; see src.shared.datagram.
+
+    Unit positions are sent on the unreliable channel as SetPos messages.
+    Each unit's latest position is resent until the client acknowledges a
+    packet containing it, so a lost packet is made up for by the next one
+    rather than holding up everything behind it. Everything else is sent on
+    the reliable channel, whose unacknowledged data plays the part of the
+    transport's buffer for congestion purposes.
+    """
+
+    unreliablePositions = True
+
+    def __init__(self, playerId, clientInterfacer, connections, server,
+                 address):
+        super(DatagramConnection, self).__init__(playerId, clientInterfacer,
+                                                 connections)
+
+        self.server  = server
+        self.address = address
+        self.clock   = connections.clock
+
+        self.reliable = ReliableChannel(self.sendPacket,
+                                        self.reliableMessageReceived,
+                                        self.clock)
+
+        self.nextUnreliableSeq = 0
+        # Incremented each time positionsChanged is called.
+        self.positionsVersion  = 0
+        # Mapping from unit ids to the positionsVersion at which they last
+        # moved, for units whose latest positions the client hasn't yet
+        # acknowledged.
+        self.pendingPositions  = {}
+        # Mapping from unreliable sequence numbers to (positionsVersion,
+        # unitIds) for recently sent packets.
+        self.inflight          = OrderedDict()
+        self.lastPositionsSent = None
+
+        self.lastHeard = self.clock.seconds()
+        self.timer     = None
+        self.lost      = False
+
+    def connectionMade(self):
+        self.scheduleTimer()
+
+        self.handshake()
+        self.clientInterfacer.handshake(self.playerId)
+
+        log.info("[%s:%s] <new UDP connection with id %s>",
+                 self.address[0], self.address[1], self.playerId)
+
+    def connectionLost(self, reason):
+        if self.lost:
+            return
+        self.lost = True
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.stopProducing()
+        self.server.forgetConnection(self)
+        self.connections.removeConnection(self)
+
+        log.info("[%s:%s] <connection %s lost: %s>",
+                 self.address[0], self.address[1], self.playerId, reason)
+
+        self.connections.reportRemainingConnections()
+
+    def disconnect(self):
+        self.sendPacket(KIND_BYE, 0, "")
+        # Don't remove the connection right away; this may be in the middle
+        # of a tick.
+        self.clock.callLater(0, self.connectionLost, "fell too far behind")
+
+    def sendPacket(self, kind, seq, payload):
+        self.server.sendPacket(self.address, kind, seq, payload)
+
+    def packetReceived(self, kind, seq, payload):
+        self.lastHeard = self.clock.seconds()
+
+        if kind == KIND_RELIABLE:
+            self.reliable.packetReceived(seq, payload)
+        elif kind == KIND_ACK:
+            self.reliable.handleAck(seq)
+            if self.congested and \
+                    self.reliable.unackedBytes <= MAX_UNACKED_BYTES // 2:
+                self.resumeProducing()
+        elif kind == KIND_UNRELIABLE_ACK:
+            self.positionsAcked(seq)
+        elif kind == KIND_HELLO:
+            # The client hasn't heard from us yet; it will stop once it does.
+            pass
+        elif kind == KIND_BYE:
+            self.connectionLost("client hung up")
+        else:
+            log.warning("[%s:%s] Ignoring packet of unexpected kind %s",
+                        self.address[0], self.address[1], kind)
+
+    def reliableMessageReceived(self, data):
+        self.messageReceived(data)
+        messageLog.info("[%s:%s] %r", self.address[0], self.address[1], data,
+                        key=self.playerId)
+
+    def writeToTransport(self, data):
+        self.reliable.send(data)
+        if not self.congested and \
+                self.reliable.unackedBytes > MAX_UNACKED_BYTES:
+            self.pauseProducing()
+
+    def positionsChanged(self, unitIds):
+        """
+        Send the latest positions (as recorded in knownPositions) of the given
+        units, and keep sending them until the client acknowledges them.
+        """
+
+        self.positionsVersion += 1
+        for unitId in unitIds:
+            self.pendingPositions[unitId] = self.positionsVersion
+        self.sendPositions()
+
+    def sendPositions(self):
+        unitIds = []
+        for unitId in sorted(self.pendingPositions):
+            if unitId in self.knownPositions:
+                unitIds.append(unitId)
+            else:
+                # The client has since been told to forget about it.
+                del self.pendingPositions[unitId]
+
+        for start in range(0, len(unitIds), MAX_POSITIONS_PER_PACKET):
+            packetIds = unitIds[start : start + MAX_POSITIONS_PER_PACKET]
+            payload = "".join(
+                frameString(messages.SetPos(unitId,
+                                            self.knownPositions[unitId])
+                            .serialize())
+                for unitId in packetIds
+            )
+            seq = self.nextUnreliableSeq
+            self.nextUnreliableSeq += 1
+            self.inflight[seq] = (self.positionsVersion, packetIds)
+            self.connections.messagesFramed(messages.SetPos.command,
+                                            len(packetIds))
+            self.connections.dataSent(self, len(payload))
+            while len(self.inflight) > MAX_INFLIGHT_PACKETS:
+                self.inflight.popitem(last=False)
+            self.sendPacket(KIND_UNRELIABLE, seq, payload)
+
+        self.lastPositionsSent = self.clock.seconds()
+
+    def positionsAcked(self, seq):
+        entry = self.inflight.pop(seq, None)
+        if entry is None:
+            return
+        version, unitIds = entry
+        for unitId in unitIds:
+            # Only stop sending it if it hasn't moved again since.
+            if unitId in self.pendingPositions and \
+                    self.pendingPositions[unitId] <= version:
+                del self.pendingPositions[unitId]
+
+    def scheduleTimer(self):
+        self.timer = self.clock.callLater(RESEND_INTERVAL, self.timerFired)
+
+    def timerFired(self):
+        self.timer = None
+
+        now = self.clock.seconds()
+        if now - self.lastHeard > CONNECTION_TIMEOUT:
+            self.connectionLost("timed out")
+            return
+
+        self.reliable.resendDue()
+        if self.pendingPositions and \
+                now - self.lastPositionsSent >= RESEND_INTERVAL:
+            self.sendPositions()
+
+        self.scheduleTimer()
+
+
+@implementer(IPushProducer)
+class StreamingProducer(object):
+    """
+    Push producer that writes a list of messages to a NetworkConnection in
+    small bursts. It is registered with the connection, which pauses it
+    whenever the transport's outgoing buffer fills up and resumes it once the
+    buffer has drained. That way only a bounded amount of the data is ever
+    sitting in memory waiting to be sent, regardless of how slowly the client
+    reads it.
+    """
+
+    def __init__(self, connection, dataList, onDone=None, clock=None):
+        super(StreamingProducer, self).__init__()
+
+        self.connection = connection
+        self.dataList   = dataList
+        self.onDone     = onDone
+        # Used to schedule the next burst. Tests can substitute a
+        # twisted.internet.task.Clock.
+        self.clock      = reactor if clock is None else clock
+
+        self.index       = 0
+        self.paused      = False
+        self.stopped     = False
+        self.pendingCall = None
+
+    def start(self):
+        self.connection.registerStream(self)
+        if not self.paused:
+            self.scheduleBurst()
+
+    @property
+    def done(self):
+        return self.index >= len(self.dataList)
+
+    def pauseProducing(self):
+        self.paused = True
+        self.cancelBurst()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.scheduleBurst()
+
+    def stopProducing(self):
+        # The connection has gone away; there's no one left to send to.
+        self.stopped = True
+        self.cancelBurst()
+
+    def scheduleBurst(self):
+        if self.pendingCall is None and not self.stopped:
+            self.pendingCall = self.clock.callLater(0, self.produceBurst)
+
+    def cancelBurst(self):
+        if self.pendingCall is not None:
+            self.pendingCall.cancel()
+            self.pendingCall = None
+
+    def produceBurst(self):
+        self.pendingCall = None
+
+        # Note that sendString can call pauseProducing, so check self.paused
+        # again after each message.
+        count = 0
+        while not (self.paused or self.stopped or self.done) and \
+                count < MAX_MESSAGES_PER_BURST:
+            self.connection.sendString(self.dataList[self.index])
+            self.index += 1
+            count      += 1
+
+        if self.done:
+            self.connection.unregisterStream()
+            self.stopped = True
+            if self.onDone is not None:
+                self.onDone()
+        elif not self.paused:
+            # Don't write the rest in this same reactor iteration; that would
+            # hold up ticks until the whole thing had been sent.
+            self.scheduleBurst()
+
+
+def splitAtUnitsSlot(entries):
+    """
+    Split a batch's entries at UNITS_SLOT. Return a pair (before, after) of
+    the joined data of the entries before and after the slot.
+    """
+
+    index  = entries.index(UNITS_SLOT)
+    before = "".join(data for data, _ in entries[:index])
+    after  = "".join(data for data, _ in entries[index + 1:])
+    return (before, after)
+
+
+def frameString(data):
+    """
+    Add the length prefix that Int16StringReceiver.sendString would add to
+    data, so that the result can be written directly to any number of
+    transports.
+    """
+
+    structFormat = NetworkConnection.structFormat
+    prefixLength = NetworkConnection.prefixLength
+    if len(data) >= 2 ** (8 * prefixLength):
+        raise StringTooLongError(
+            "Tried to send {} bytes, but the maximum is {}.".format(
+                len(data), 2 ** (8 * prefixLength)))
+    return pack(structFormat, len(data)) + data
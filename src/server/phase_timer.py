@@ -0,0 +1,48 @@
+from collections import OrderedDict
+import time
+
+
+class PhaseTimer(object):
+    """
+    Accumulates how much time is spent in each phase of some repeated piece
+    of work (such as a tick). Call start() at the beginning, then
+    phaseDone(name) at the end of each phase; the time since the previous
+    call is charged to that phase. This is cheap enough to leave on all the
+    time: one clock read per phase.
+    """
+
+    def __init__(self, clock=time.time):
+        super(PhaseTimer, self).__init__()
+
+        self.clock = clock
+
+        # Mapping from phase name to total seconds spent in it, in the order
+        # the phases were first seen.
+        self.totals     = OrderedDict()
+        # Number of times start() has been called.
+        self.numStarts  = 0
+        self.phaseStart = None
+
+    def start(self):
+        self.numStarts += 1
+        self.phaseStart = self.clock()
+
+    def phaseDone(self, phase):
+        now = self.clock()
+        self.totals[phase] = self.totals.get(phase, 0.0) + \
+            (now - self.phaseStart)
+        self.phaseStart = now
+
+    def reset(self):
+        self.totals.clear()
+        self.numStarts = 0
+
+    def averages(self):
+        """
+        Return a list of (phase, average seconds per start()) pairs.
+        """
+
+        if self.numStarts == 0:
+            return []
+        return [(phase, total / self.numStarts)
+                for phase, total in self.totals.iteritems()]
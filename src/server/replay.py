@@ -0,0 +1,229 @@
+"""
+Recording games and playing them back.
+
+A replay log records the initial map plus every order the simulation
+applied, tagged with the tick it was applied before and the player who gave
+it. Since the simulation is deterministic, that's enough to reproduce the
+whole game: the replay runner loads the map, feeds the orders back in at the
+same points, and runs the ticks as fast as it can. This lets us reproduce
+problems from real games, and benchmark tick throughput on them.
+
+The log is a text file with one record per line, appended to as the game
+goes on. Each record is built with buildMessage, so the existing tokenizer
+can read it back:
+    warts_replay <version>
+    map <MapContents>
+    order <tick> <playerId> |<serialized order message>
+    leave <tick> <playerId>
+    end <ticks> <state hash in hex>
+The end record is only written if the server shuts down cleanly. When it's
+there, the runner also checks that the replay ended in the same state.
+"""
+
+from collections import defaultdict
+import time
+
+from src.server.game_state_manager import GameStateManager
+from src.shared.game_state import GameState
+from src.shared.logconfig import newLogger
+from src.shared.message_infrastructure import buildMessage, tokenize, \
+    deserializeMessage, InvalidMessageError
+from src.shared.snapshot import MapContents
+
+log = newLogger(__name__)
+
+REPLAY_VERSION = 1
+
+# Record types.
+HEADER_RECORD = "warts_replay"
+MAP_RECORD    = "map"
+ORDER_RECORD  = "order"
+LEAVE_RECORD  = "leave"
+END_RECORD    = "end"
+
+# Report progress every this many ticks while replaying.
+PROGRESS_INTERVAL = 1000
+
+
+class ReplayRecorder(object):
+    """
+    Writes a replay log as the game is played. Attach it to a
+    GameStateManager with setRecorder.
+    """
+
+    def __init__(self, outFile):
+        super(ReplayRecorder, self).__init__()
+        self.outFile = outFile
+        self.closed  = False
+
+    def start(self, gameState):
+        self.writeRecord(HEADER_RECORD, [REPLAY_VERSION])
+        self.writeRecord(MAP_RECORD,
+                         [MapContents.fromGameState(gameState).serialize()])
+
+    def orderApplied(self, tick, playerId, message):
+        self.writeRecord(ORDER_RECORD, [tick, playerId, message.serialize()],
+                         lastIsUnsafe=True)
+
+    def playerRemoved(self, tick, playerId):
+        self.writeRecord(LEAVE_RECORD, [tick, playerId])
+
+    def tickDone(self):
+        # Flush once per tick rather than per record, so that a crash loses at
+        # most the tick in progress.
+        self.outFile.flush()
+
+    def close(self, ticks, stateHash):
+        if self.closed:
+            return
+        self.closed = True
+        self.writeRecord(END_RECORD, [ticks, "{:x}".format(stateHash)])
+        self.outFile.close()
+
+    def writeRecord(self, recordType, fields, lastIsUnsafe=False):
+        self.outFile.write(buildMessage(recordType, fields,
+                                        lastIsUnsafe=lastIsUnsafe) + "\n")
+
+
+class Replay(object):
+    """
+    A replay log, read back in.
+    """
+
+    def __init__(self, mapContents, events, endTicks=None, endHash=None):
+        super(Replay, self).__init__()
+        self.mapContents = mapContents
+        # Mapping from tick to a list of (playerId, message) pairs, in the
+        # order they were applied. A message of None means the player left.
+        self.events      = events
+        # The number of ticks the game ran for and the hash of its final
+        # state, if the log has an end record.
+        self.endTicks    = endTicks
+        self.endHash     = endHash
+
+    @property
+    def totalTicks(self):
+        if self.endTicks is not None:
+            return self.endTicks
+        # Without an end record, at least get through the last order.
+        return max(self.events) + 1 if self.events else 0
+
+    @classmethod
+    def load(cls, inFile):
+        mapContents = None
+        events      = defaultdict(list)
+        endTicks    = None
+        endHash     = None
+
+        for lineNum, line in enumerate(inFile, 1):
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            try:
+                recordType, fields = tokenize(line)
+                if lineNum == 1:
+                    if recordType != HEADER_RECORD or \
+                            fields != [str(REPLAY_VERSION)]:
+                        raise InvalidMessageError(line,
+                                                  "Not a replay log, or an "
+                                                  "unsupported version.")
+                elif recordType == MAP_RECORD:
+                    mapContents = MapContents.deserialize(fields[0])
+                elif recordType == ORDER_RECORD:
+                    tick, playerId = int(fields[0]), int(fields[1])
+                    message = deserializeMessage(fields[2])
+                    events[tick].append((playerId, message))
+                elif recordType == LEAVE_RECORD:
+                    tick, playerId = int(fields[0]), int(fields[1])
+                    events[tick].append((playerId, None))
+                elif recordType == END_RECORD:
+                    endTicks = int(fields[0])
+                    endHash  = int(fields[1], 16)
+                else:
+                    raise InvalidMessageError(line, "Unknown record type.")
+            except (ValueError, IndexError) as exc:
+                raise InvalidMessageError(line, str(exc))
+
+        if mapContents is None:
+            raise InvalidMessageError("", "Replay log has no map.")
+        return cls(mapContents, dict(events), endTicks, endHash)
+
+    def run(self, progress=None):
+        """
+        Play back the whole replay, as fast as possible. Return the
+        GameStateManager, with the final state.
+        """
+
+        gameState = GameState()
+        self.mapContents.applyTo(gameState)
+        gameStateManager = GameStateManager(None, HeadlessConnections(),
+                                            gameState=gameState)
+
+        for tick in xrange(self.totalTicks):
+            for playerId, message in self.events.get(tick, []):
+                if message is None:
+                    gameStateManager.removePlayer(playerId)
+                else:
+                    gameStateManager.applyOrderMessage(playerId, message)
+            gameStateManager.tick()
+            if progress is not None:
+                progress(tick + 1)
+
+        return gameStateManager
+
+
+class HeadlessConnections(object):
+    """
+    Stands in for the ConnectionManager when there aren't any clients to tell
+    about changes.
+    """
+
+    def startBatch(self):
+        pass
+
+    def flushBatch(self):
+        pass
+
+    def broadcastMessage(self, message, supersedable=False):
+        pass
+
+    def unitCreated(self, unitId, traceId=None):
+        pass
+
+    def unitDeleted(self, unitId):
+        pass
+
+    def unitMoved(self, unitId, traceId=None):
+        pass
+
+    def resourcesChanged(self, playerId, amount):
+        pass
+
+
+def main(args):
+    with open(args.file) as inFile:
+        replay = Replay.load(inFile)
+
+    totalTicks = replay.totalTicks
+    log.info("Replaying %d ticks from %s...", totalTicks, args.file)
+
+    def progress(tick):
+        if tick % PROGRESS_INTERVAL == 0:
+            log.info("  ...%d/%d ticks.", tick, totalTicks)
+
+    startTime = time.time()
+    gameStateManager = replay.run(progress)
+    elapsed = time.time() - startTime
+
+    log.info("Replayed %d ticks in %.3f seconds (%.1f ticks/second).",
+             totalTicks, elapsed, totalTicks / elapsed if elapsed else 0.0)
+
+    stateHash = gameStateManager.gameState.stateHash
+    if replay.endHash is None:
+        log.info("Final state hash %x (the log has no end record to check "
+                 "it against).", stateHash)
+    elif stateHash != replay.endHash:
+        log.error("Replay diverged: final state hash %x, but the recorded "
+                  "game ended with %x.", stateHash, replay.endHash)
+    else:
+        log.info("Final state matches the recorded game.")
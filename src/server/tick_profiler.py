@@ -0,0 +1,128 @@
+from collections import deque, OrderedDict
+import math
+
+from src.server.phase_timer import PhaseTimer
+
+# Number of recent ticks that percentiles are computed over: a minute's worth
+# at the default tick length.
+STATS_WINDOW_TICKS = 600
+
+# Percentiles reported by the stats command.
+REPORTED_PERCENTILES = (50, 95, 99)
+
+
+class RollingWindow(object):
+    """
+    The most recent samples of some per-tick quantity. Adding a sample is
+    just an append; the work of sorting them is only done when someone asks
+    for percentiles.
+    """
+
+    def __init__(self, size=STATS_WINDOW_TICKS):
+        super(RollingWindow, self).__init__()
+        self.samples = deque(maxlen=size)
+
+    def add(self, sample):
+        self.samples.append(sample)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentiles(self, percents):
+        """
+        Return a list of the given percentiles of the current samples
+        (nearest-rank), or None if there aren't any samples yet.
+        """
+
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        count = len(ordered)
+        return [ordered[max(0, int(math.ceil(count * percent / 100.0)) - 1)]
+                for percent in percents]
+
+
+class TickProfiler(PhaseTimer):
+    """
+    Always-on instrumentation for ticks. As well as the running totals kept
+    by a PhaseTimer, this keeps a rolling window of how long each phase took
+    on each recent tick, and of per-tick counts of interesting events (units
+    moved, paths computed, messages and bytes sent, ...).
+
+    Events can be counted at any time with count(); everything counted since
+    the previous endTick() is charged to the tick that endTick() finishes.
+    """
+
+    def __init__(self, windowSize=STATS_WINDOW_TICKS, **kwargs):
+        super(TickProfiler, self).__init__(**kwargs)
+
+        self.windowSize = windowSize
+
+        # Mapping from phase name to a RollingWindow of its durations.
+        self.phaseWindows   = OrderedDict()
+        # Mapping from counter name to a RollingWindow of per-tick counts.
+        self.counterWindows = OrderedDict()
+        self.totalWindow    = RollingWindow(windowSize)
+
+        # Time spent in each phase and counts of each event so far this tick.
+        self.currentPhases   = OrderedDict()
+        self.currentCounters = OrderedDict()
+
+    def phaseDone(self, phase):
+        start = self.phaseStart
+        super(TickProfiler, self).phaseDone(phase)
+        self.currentPhases[phase] = self.currentPhases.get(phase, 0.0) + \
+            (self.phaseStart - start)
+
+    def count(self, counter, amount=1):
+        self.currentCounters[counter] = \
+            self.currentCounters.get(counter, 0) + amount
+
+    def endTick(self):
+        total = 0.0
+        for phase, duration in self.currentPhases.iteritems():
+            self.getWindow(self.phaseWindows, phase).add(duration)
+            total += duration
+        self.totalWindow.add(total)
+
+        # Counters that have been seen before but didn't come up this tick
+        # still get a sample, of 0.
+        for counter in self.currentCounters:
+            self.getWindow(self.counterWindows, counter)
+        for counter, window in self.counterWindows.iteritems():
+            window.add(self.currentCounters.get(counter, 0))
+
+        self.currentPhases.clear()
+        self.currentCounters.clear()
+
+    def getWindow(self, windows, name):
+        if name not in windows:
+            windows[name] = RollingWindow(self.windowSize)
+        return windows[name]
+
+    def reportLines(self, percents=REPORTED_PERCENTILES):
+        """
+        Return a list of lines describing the given percentiles of each phase
+        time and counter over the recent ticks.
+        """
+
+        header = "  ".join("{:>9}".format("p{}".format(percent))
+                           for percent in percents)
+        lines = ["Last {} ticks:".format(len(self.totalWindow)),
+                 "    {:<16}{}".format("phase (ms)", header)]
+        phases = list(self.phaseWindows.items()) + \
+            [("total", self.totalWindow)]
+        for phase, window in phases:
+            values = window.percentiles(percents)
+            if values is not None:
+                lines.append("    {:<16}{}".format(phase, "  ".join(
+                    "{:9.3f}".format(value * 1000) for value in values
+                )))
+        lines.append("    {:<16}{}".format("per tick", header))
+        for counter, window in self.counterWindows.iteritems():
+            values = window.percentiles(percents)
+            if values is not None:
+                lines.append("    {:<16}{}".format(counter, "  ".join(
+                    "{:9d}".format(value) for value in values
+                )))
+        return lines
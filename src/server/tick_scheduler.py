@@ -0,0 +1,202 @@
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from src.shared.logconfig import newLogger
+
+log = newLogger(__name__)
+
+# Most ticks run back-to-back to catch up after falling behind schedule.
+# Beyond this, the missed ticks are dropped instead, since trying to run them
+# all would just leave us further behind.
+MAX_CATCH_UP_TICKS = 5
+
+# Overruns are summarized in the log at most once every this many seconds.
+OVERRUN_REPORT_INTERVAL = 10.0
+
+
+class TickScheduler(object):
+    """
+    Calls tickFunc once every tickLength seconds, on a fixed schedule.
+
+    The simulation always advances by exactly one tick's worth of time per
+    tick, so that it stays deterministic (which lockstep mode and replays
+    depend on). To keep it in step with the real world anyway, ticks are
+    scheduled against the time the scheduler started rather than the end of
+    the previous tick: if one tick runs long, the next one starts early, and
+    if we're a whole tick or more behind, the missed ticks are run
+    back-to-back, up to MAX_CATCH_UP_TICKS of them at a time. Ticks missed
+    beyond that are dropped and counted, and the simulation falls behind real
+    time by that much for good.
+
+    Unlike a LoopingCall, nothing is skipped silently: drift, catch-up ticks,
+    dropped ticks, and overruns (ticks that took longer than tickLength) are
+    all recorded and reported.
+    """
+
+    def __init__(self, tickFunc, tickLength, clock=None,
+                 maxCatchUp=MAX_CATCH_UP_TICKS):
+        super(TickScheduler, self).__init__()
+
+        self.tickFunc   = tickFunc
+        self.tickLength = tickLength
+        # Tests can substitute a twisted.internet.task.Clock.
+        self.clock      = reactor if clock is None else clock
+        self.maxCatchUp = maxCatchUp
+
+        self.startTime    = None
+        # When the next tick is due.
+        self.nextTickTime = None
+        # When the last tick started.
+        self.lastTickTime = None
+        self.pendingCall  = None
+        self.deferred     = None
+
+        # Number of ticks run, and how many of those were run immediately
+        # after another one to catch up.
+        self.ticksRun      = 0
+        self.catchUpTicks  = 0
+        # Number of ticks skipped because we were too far behind.
+        self.droppedTicks  = 0
+        # Number of ticks that took longer than tickLength, and the longest
+        # any tick has taken.
+        self.overruns      = 0
+        self.longestTick   = 0.0
+        # Real time between the starts of the last two ticks. Normally
+        # tickLength, but shorter while catching up and longer if the reactor
+        # was held up.
+        self.lastTickInterval = tickLength
+        # How late the last tick started, and the latest any tick has been.
+        self.drift         = 0.0
+        self.maxDrift      = 0.0
+        # True if the previous tick ended after the next one was due, so that
+        # the next one is being run late to catch up.
+        self.catchingUp    = False
+
+        # Overruns since they were last reported.
+        self.unreportedOverruns = 0
+        self.unreportedLongest  = 0.0
+        self.lastOverrunReport  = None
+
+    def start(self):
+        """
+        Run the first tick right away, and schedule the rest. Returns a
+        Deferred that fires when the scheduler is stopped, or errbacks if a
+        tick raises an exception (after which no more ticks are run).
+        """
+
+        assert self.deferred is None
+        self.deferred = Deferred()
+        self.startTime = self.clock.seconds()
+        self.nextTickTime = self.startTime
+        self.lastOverrunReport = self.startTime
+        self.runDueTicks()
+        return self.deferred
+
+    def stop(self):
+        if self.pendingCall is not None:
+            self.pendingCall.cancel()
+            self.pendingCall = None
+        if self.deferred is not None and not self.deferred.called:
+            self.deferred.callback(self)
+
+    @property
+    def realTime(self):
+        """
+        Seconds of real time since the scheduler started.
+        """
+
+        if self.startTime is None:
+            return 0.0
+        return self.clock.seconds() - self.startTime
+
+    @property
+    def simulatedTime(self):
+        """
+        Seconds of game time that have been simulated so far.
+        """
+
+        return self.ticksRun * self.tickLength
+
+    @property
+    def lag(self):
+        """
+        How far the simulation is behind real time, in seconds, counting each
+        tick as simulating the tickLength seconds starting when it was due.
+        Normally less than one tick; this only grows if ticks are dropped.
+        """
+
+        return max(0.0, self.realTime + self.tickLength - self.simulatedTime)
+
+    def runDueTicks(self):
+        self.pendingCall = None
+
+        now = self.clock.seconds()
+        due = 0
+        if now >= self.nextTickTime:
+            due = 1 + int((now - self.nextTickTime) // self.tickLength)
+        if due > self.maxCatchUp:
+            dropped = due - self.maxCatchUp
+            log.warning("Fell %.3f seconds behind schedule; dropping %d "
+                        "ticks.", now - self.nextTickTime, dropped)
+            self.droppedTicks += dropped
+            self.nextTickTime += dropped * self.tickLength
+            due = self.maxCatchUp
+
+        for index in range(due):
+            if index > 0 or self.catchingUp:
+                self.catchUpTicks += 1
+            if not self.runTick():
+                return
+
+        delay = self.nextTickTime - self.clock.seconds()
+        self.catchingUp = delay <= 0
+        self.pendingCall = self.clock.callLater(max(0.0, delay),
+                                                self.runDueTicks)
+
+    def runTick(self):
+        """
+        Run a single tick. Return False if it raised an exception.
+        """
+
+        tickStart = self.clock.seconds()
+        self.drift = tickStart - self.nextTickTime
+        self.maxDrift = max(self.maxDrift, self.drift)
+        if self.lastTickTime is not None:
+            self.lastTickInterval = tickStart - self.lastTickTime
+        self.lastTickTime = tickStart
+
+        try:
+            self.tickFunc()
+        except Exception:  # pylint: disable=broad-except
+            self.deferred.errback(Failure())
+            return False
+
+        self.ticksRun += 1
+        self.nextTickTime += self.tickLength
+
+        duration = self.clock.seconds() - tickStart
+        self.longestTick = max(self.longestTick, duration)
+        if duration > self.tickLength:
+            self.overruns += 1
+            self.overrunOccurred(duration)
+        return True
+
+    def overrunOccurred(self, duration):
+        # Don't flood the log if every tick is overrunning; just say how many
+        # have since the last time we said anything.
+        self.unreportedOverruns += 1
+        self.unreportedLongest = max(self.unreportedLongest, duration)
+        now = self.clock.seconds()
+        if now - self.lastOverrunReport >= OVERRUN_REPORT_INTERVAL or \
+                self.overruns == 1:
+            log.warning("%d ticks overran their %.0f ms in the last %.1f "
+                        "seconds (longest %.1f ms). %d ticks dropped so far; "
+                        "simulation is %.3f seconds behind.",
+                        self.unreportedOverruns, self.tickLength * 1000,
+                        now - self.lastOverrunReport,
+                        self.unreportedLongest * 1000, self.droppedTicks,
+                        self.lag)
+            self.unreportedOverruns = 0
+            self.unreportedLongest  = 0.0
+            self.lastOverrunReport  = now
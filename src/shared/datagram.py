@@ -0,0 +1,227 @@
+"""
+Packet format and channels for the optional UDP transport.
+
+Every datagram starts with a header giving its kind and a sequence number.
+The rest of the datagram is a payload. Messages are framed exactly as
+Int16StringReceiver would frame them (a 2-byte big-endian length followed by
+the serialized message), so the same message schemas are used over UDP as
+over TCP.
+
+There are two channels:
+  - The reliable channel delivers a stream of framed messages exactly once
+    and in order. The stream is cut into payloads of at most
+    MAX_PAYLOAD_SIZE bytes regardless of where the messages start and end,
+    so a message may span several payloads; the receiver reassembles them.
+    Every payload is resent until the peer acknowledges it. Acks are
+    cumulative: an ack with sequence number n means every payload before n
+    arrived.
+  - The unreliable channel is fire-and-forget. Each of its payloads holds
+    whole messages: position updates that supersede any older ones, so
+    losing one only matters until the next one arrives. The receiver acks
+    each of these it applies, so that the sender knows which updates it can
+    stop resending.
+
+Before the server sets up a connection for a new address, that address has
+to prove that it can receive packets, by echoing a cookie (see
+KIND_CHALLENGE). Otherwise anyone could make the server send a stream of
+data to a forged source address.
+"""
+
+from struct import pack, unpack, calcsize
+
+from src.shared.message_infrastructure import InvalidMessageError
+
+HEADER_FORMAT = "!BI"
+HEADER_SIZE   = calcsize(HEADER_FORMAT)
+
+FRAME_FORMAT = "!H"
+FRAME_SIZE   = calcsize(FRAME_FORMAT)
+
+# Packet kinds.
+KIND_HELLO           = 0  # Client asking to join.
+KIND_RELIABLE        = 1  # Payload on the reliable channel.
+KIND_UNRELIABLE      = 2  # Payload on the unreliable channel.
+KIND_ACK             = 3  # Cumulative ack of the reliable channel.
+KIND_UNRELIABLE_ACK  = 4  # Ack of a single unreliable packet.
+KIND_BYE             = 5  # Either side hanging up.
+KIND_CHALLENGE       = 6  # Server's reply to a HELLO without a valid cookie.
+
+# Size in bytes of the cookie in a KIND_CHALLENGE, which the client echoes in
+# its next HELLO. Until it has one, the client pads its HELLOs to this size
+# anyway, and the server ignores shorter ones, so that a challenge is never
+# bigger than the HELLO that prompted it.
+COOKIE_SIZE = 16
+
+# Payloads are split so that packets stay under this size, which avoids IP
+# fragmentation on typical links (and keeps well under the limit on the size
+# of a UDP datagram).
+MAX_PAYLOAD_SIZE = 1200
+
+# Seconds between retransmissions of an unacknowledged reliable payload.
+RESEND_INTERVAL = 0.2
+
+# A peer that hasn't been heard from for this many seconds is assumed to be
+# gone. Clients send a keepalive every KEEPALIVE_INTERVAL seconds so that this
+# doesn't happen just because they have nothing to say.
+CONNECTION_TIMEOUT = 10.0
+KEEPALIVE_INTERVAL = 1.0
+
+# Maximum number of out-of-order reliable payloads a receiver will hold on to
+# while waiting for an earlier one.
+MAX_REORDER_WINDOW = 256
+
+
+def encodePacket(kind, seq, payload=""):
+    return pack(HEADER_FORMAT, kind, seq) + payload
+
+
+def decodePacket(packet):
+    """
+    Return a (kind, seq, payload) triple.
+    """
+
+    if len(packet) < HEADER_SIZE:
+        raise InvalidMessageError(packet, "Truncated packet header.")
+    kind, seq = unpack(HEADER_FORMAT, packet[:HEADER_SIZE])
+    return (kind, seq, packet[HEADER_SIZE:])
+
+
+def frameData(data):
+    """
+    Frame a single serialized message for inclusion in a payload.
+    """
+
+    return pack(FRAME_FORMAT, len(data)) + data
+
+
+def splitFrames(payload):
+    """
+    Return a list of the messages framed in payload.
+    """
+
+    messages = []
+    index = 0
+    while index < len(payload):
+        if index + FRAME_SIZE > len(payload):
+            raise InvalidMessageError(payload, "Truncated frame length.")
+        length, = unpack(FRAME_FORMAT, payload[index : index + FRAME_SIZE])
+        index += FRAME_SIZE
+        if index + length > len(payload):
+            raise InvalidMessageError(payload, "Truncated frame.")
+        messages.append(payload[index : index + length])
+        index += length
+    return messages
+
+
+def splitPayload(data):
+    """
+    Split part of the reliable channel's stream into payloads of at most
+    MAX_PAYLOAD_SIZE bytes.
+    """
+
+    if len(data) <= MAX_PAYLOAD_SIZE:
+        return [data]
+    return [data[start : start + MAX_PAYLOAD_SIZE]
+            for start in xrange(0, len(data), MAX_PAYLOAD_SIZE)]
+
+
+def completeFramesLength(data):
+    """
+    Return the length of the longest prefix of data made up of whole framed
+    messages.
+    """
+
+    index = 0
+    while index + FRAME_SIZE <= len(data):
+        length, = unpack(FRAME_FORMAT, data[index : index + FRAME_SIZE])
+        if index + FRAME_SIZE + length > len(data):
+            break
+        index += FRAME_SIZE + length
+    return index
+
+
+class ReliableChannel(object):
+    """
+    One end of a reliable, sequenced channel. sendPacket(kind, seq, payload)
+    is called to put packets on the wire, and deliver(data) with each
+    (serialized) message received, in order.
+    """
+
+    def __init__(self, sendPacket, deliver, clock):
+        super(ReliableChannel, self).__init__()
+
+        self.sendPacket = sendPacket
+        self.deliver    = deliver
+        self.clock      = clock
+
+        # Sending side.
+        self.nextSendSeq  = 0
+        # Mapping from sequence numbers to (payload, time last sent) for
+        # payloads the peer hasn't acknowledged yet.
+        self.unacked      = {}
+        self.unackedBytes = 0
+
+        # Receiving side.
+        self.nextRecvSeq = 0
+        # Payloads that arrived before one or more earlier ones, by sequence
+        # number.
+        self.outOfOrder  = {}
+        # The start of a message whose end hasn't arrived yet.
+        self.partial     = ""
+
+    def send(self, data):
+        """
+        Send data, which is one or more framed messages.
+        """
+
+        for payload in splitPayload(data):
+            seq = self.nextSendSeq
+            self.nextSendSeq += 1
+            self.unacked[seq] = (payload, self.clock.seconds())
+            self.unackedBytes += len(payload)
+            self.sendPacket(KIND_RELIABLE, seq, payload)
+
+    def handleAck(self, ack):
+        for seq in [seq for seq in self.unacked if seq < ack]:
+            payload, _ = self.unacked.pop(seq)
+            self.unackedBytes -= len(payload)
+
+    def resendDue(self):
+        """
+        Resend every payload that has gone unacknowledged for at least
+        RESEND_INTERVAL.
+        """
+
+        now = self.clock.seconds()
+        for seq in sorted(self.unacked):
+            payload, lastSent = self.unacked[seq]
+            if now - lastSent >= RESEND_INTERVAL:
+                self.unacked[seq] = (payload, now)
+                self.sendPacket(KIND_RELIABLE, seq, payload)
+
+    def packetReceived(self, seq, payload):
+        if seq == self.nextRecvSeq:
+            self.nextRecvSeq += 1
+            self.payloadArrived(payload)
+            while self.nextRecvSeq in self.outOfOrder:
+                payload = self.outOfOrder.pop(self.nextRecvSeq)
+                self.nextRecvSeq += 1
+                self.payloadArrived(payload)
+        elif self.nextRecvSeq < seq < self.nextRecvSeq + MAX_REORDER_WINDOW:
+            self.outOfOrder[seq] = payload
+        # Otherwise it's either a duplicate or too far ahead to hold on to;
+        # either way the sender will learn what we have from the ack.
+
+        # Ack everything, including duplicates, since a duplicate probably
+        # means our last ack was lost.
+        self.sendPacket(KIND_ACK, self.nextRecvSeq, "")
+
+    def payloadArrived(self, payload):
+        # Called with each payload in order. Deliver the messages it
+        # completes, and hold on to the start of any message it doesn't.
+        data = self.partial + payload if self.partial else payload
+        end = completeFramesLength(data)
+        self.partial = data[end:]
+        if end:
+            for message in splitFrames(data[:end]):
+                self.deliver(message)
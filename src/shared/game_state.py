@@ -1,26 +1,53 @@
 from collections import defaultdict
 
 from src.shared.ident import UnitId, unitToPlayer, getUnitSubId
-from src.shared.geometry import Distance, Rect
+from src.shared.geometry import Coord, Distance, Rect
+from src.shared.utils import integerSqrt, divideAndRound
 
 # Maximum distance (in unit coords) a unit can move in one tick.
 # TODO: Take in elapsed ticks; have an actual speed, rather than a constant
 # "move amount per update".
-MAX_SPEED = 3.0
+MAX_SPEED = 3
 UNIT_SIZE = Distance.fromCBU(build=(2,2))
 
+# State hashes are kept to this many bits.
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+# Distinguish the keys for different kinds of things in the state hash, so
+# that (for example) a unit can't cancel out a resource amount.
+UNIT_KEY_TAG     = 1
+RESOURCE_KEY_TAG = 2
+
 class GameState(object):
     def __init__(self):
         self.positions = {}
         self.unitTypes = {}
         self.resources = defaultdict(int)
 
+        # A fingerprint of the units and resources, used to check that two
+        # copies of the simulation agree. Each unit and each player's
+        # resource amount has a pseudorandom key, and the hash is the XOR of
+        # all of them (as in Zobrist hashing), so every change to the state
+        # updates it in constant time by XORing the old key out and the new
+        # one in. Anything that changes positions, unitTypes, or resources
+        # must go through the methods below to keep it up to date.
+        self.stateHash = 0
+
         self.mapSize     = None
         self.groundTypes = None
-        # List of build coordinates. For now, individual resource pools are
-        # 1x1, so if you want something larger just create multiple pools.
+        # List of Coords of the corners of the resource pools, on both the
+        # server and the client. For now, individual resource pools are one
+        # build square, so if you want something larger just create multiple
+        # pools.
         self.resourcePools = []
 
+        # Incremented whenever the static parts of the map (size, terrain,
+        # resource pools) change, so that anything derived from them can be
+        # cached until the next change. Code that modifies groundTypes or
+        # resourcePools directly should call markMapChanged().
+        self.mapVersion = 0
+
     def setSize(self, mapSize):
         if self.hasSize:
             raise RuntimeError("GameState size already set; can't change.")
@@ -29,6 +56,22 @@ class GameState(object):
         # Reference chunks as [x][y].
         self.groundTypes = [[0 for _x in range(mapHeight)]
                             for _y in range(mapWidth)]
+        self.markMapChanged()
+
+    def setGroundType(self, chunk, terrainType):
+        cx, cy = chunk
+        self.groundTypes[cx][cy] = terrainType
+        self.markMapChanged()
+
+    def addResourcePool(self, pos):
+        if not isinstance(pos, Coord):
+            raise TypeError("Resource pools are stored as Coords. Found {}"
+                            .format(type(pos)))
+        self.resourcePools.append(pos)
+        self.markMapChanged()
+
+    def markMapChanged(self):
+        self.mapVersion += 1
 
     @property
     def hasSize(self):
@@ -49,37 +92,71 @@ class GameState(object):
 
     def addUnit(self, playerId, unitType, position):
         unitId = self.createNewUnitId(playerId)
+        self.insertUnit(unitId, unitType, position)
+        return unitId
+
+    def insertUnit(self, unitId, unitType, position):
+        """
+        Add a unit with a known id, as when loading a snapshot.
+        """
+
         assert unitId not in self.positions
 
         self.positions[unitId] = position
         self.unitTypes[unitId] = unitType
-        return unitId
+        self.stateHash ^= unitKey(unitId, unitType, position)
 
     def removeUnit(self, unitId):
         self.checkId(unitId)
+        self.stateHash ^= unitKey(unitId, self.unitTypes[unitId],
+                                  self.positions[unitId])
         del self.positions[unitId]
         del self.unitTypes[unitId]
 
     def moveUnitToward(self, unitId, dest):
         self.checkId(unitId)
 
+        # Only use integer math here, so that every client running the
+        # simulation in lockstep gets exactly the same result.
         oldPos = self.getPos(unitId)
-        distance = (dest - oldPos).length()
-        if distance <= MAX_SPEED:
+        dx, dy = (dest - oldPos).unit
+        if dx**2 + dy**2 <= MAX_SPEED**2:
             # We have enough speed to reach our destination this tick.
             newPos = dest
         else:
-            # MAX_SPEED is nonzero, and distance > MAX_SPEED, so we are not
-            # dividing by zero. (Or distance is NaN, in which case
-            # distance !> MAX_SPEED, but we're still not dividing by zero.)
-            fraction = MAX_SPEED / distance
-            newPos = oldPos + fraction * (dest - oldPos)
+            # dx**2 + dy**2 > MAX_SPEED**2 >= 1, so distance is positive.
+            distance = integerSqrt(dx**2 + dy**2)
+            step = Distance((divideAndRound(dx * MAX_SPEED, distance),
+                             divideAndRound(dy * MAX_SPEED, distance)))
+            newPos = oldPos + step
 
         self.moveUnitTo(unitId, newPos)
 
     def moveUnitTo(self, unitId, newPos):
         self.checkId(unitId)
+        unitType = self.unitTypes[unitId]
+        self.stateHash ^= unitKey(unitId, unitType, self.positions[unitId])
         self.positions[unitId] = newPos
+        self.stateHash ^= unitKey(unitId, unitType, newPos)
+
+    def setResources(self, playerId, amount):
+        self.stateHash ^= resourceKey(playerId, self.resources[playerId])
+        self.resources[playerId] = amount
+        self.stateHash ^= resourceKey(playerId, amount)
+
+    def computeStateHash(self):
+        """
+        Compute the state hash from scratch. This is much slower than just
+        reading stateHash, and is only meant for checking that it's been kept
+        up to date.
+        """
+
+        stateHash = 0
+        for unitId, pos in self.positions.iteritems():
+            stateHash ^= unitKey(unitId, self.unitTypes[unitId], pos)
+        for playerId, amount in self.resources.iteritems():
+            stateHash ^= resourceKey(playerId, amount)
+        return stateHash
 
     def getPos(self, unitId):
         self.checkId(unitId)
@@ -115,3 +192,35 @@ class GameState(object):
     def isUnitIdValid(self, unitId):
         return unitId in self.positions
 
+
+
+def unitKey(unitId, unitType, pos):
+    x, y = pos.unit
+    return hashInts(UNIT_KEY_TAG, unitToPlayer(unitId), getUnitSubId(unitId),
+                    unitType, x, y)
+
+def resourceKey(playerId, amount):
+    # Not having an entry in resources is the same as having 0, so make sure
+    # they hash the same.
+    if amount == 0:
+        return 0
+    return hashInts(RESOURCE_KEY_TAG, playerId, amount)
+
+def hashInts(*values):
+    """
+    Hash a sequence of integers to a pseudorandom HASH_BITS-bit integer.
+    Unlike hash(), the result is the same on every machine (and every
+    run), which it has to be for clients to compare state hashes.
+    """
+
+    result = 0
+    for value in values:
+        result = _mixBits((result ^ value) & HASH_MASK)
+    return result
+
+def _mixBits(x):
+    # The finalizer from SplitMix64: every input bit affects every output bit.
+    x = (x + 0x9e3779b97f4a7c15) & HASH_MASK
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & HASH_MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & HASH_MASK
+    return x ^ (x >> 31)
@@ -20,7 +20,9 @@ class ResourceChange(GameStateChange):
         self.delta    = delta
 
     def apply(self, gameState):
-        gameState.resources[self.playerId] += self.delta
+        gameState.setResources(self.playerId,
+                               gameState.resources[self.playerId] +
+                               self.delta)
         if gameState.resources[self.playerId] < 0:
             log.error("Player %d has %r resources.",
                       self.playerId, gameState.resources[self.playerId])
@@ -9,23 +9,29 @@ import math
 from src.shared.config import CHUNK_SIZE, BUILD_SIZE
 from src.shared.exceptions import NoPathToTargetError
 from src.shared.logconfig import newLogger
+from src.shared.utils import integerSqrt
 
 log = newLogger(__name__)
 
 BUILDS_PER_CHUNK = CHUNK_SIZE / BUILD_SIZE
 
 # Costs used by pathfinding code.
-# Measure distances in unit coordinates.
+# Measure distances in unit coordinates. Pathfinding only uses integer math,
+# so that every client running the simulation in lockstep finds exactly the
+# same paths.
 ORTHOGONAL_COST = CHUNK_SIZE
-DIAGONAL_COST   = int(ORTHOGONAL_COST * math.sqrt(2))
+DIAGONAL_COST   = integerSqrt(2 * ORTHOGONAL_COST**2)
 
-def findPath(gameState, srcPos, destPos):
+def findPath(gameState, srcPos, destPos, workCounter=None):
     """
     Compute and return a path from srcPos to destPos, avoiding any obstacles.
 
     The returned path will be a list of waypoints such that a unit at srcPos
     could travel by straight line to each of the waypoints in order and thus
     get to destPos without hitting any obstacles.
+
+    If workCounter is given, it's called with the number of chunks expanded
+    once a search has been done, whether or not it found a path.
     """
 
     log.debug("Searching for path from %s to %s", srcPos, destPos)
@@ -74,6 +80,7 @@ def findPath(gameState, srcPos, destPos):
     heapq.heappush(chunksToCheck, (_heuristicDistance(srcChunk, destChunk),
                                    srcChunk))
 
+    nodesExpanded = 0
     while len(chunksToCheck) > 0:
         _, currChunk = heapq.heappop(chunksToCheck)
         log.debug("Pathfinding: search out from %s", currChunk)
@@ -84,6 +91,7 @@ def findPath(gameState, srcPos, destPos):
             # Already expanded from this node; don't do it again.
             continue
         nodeFinalized[cx][cy] = True
+        nodesExpanded += 1
 
         log.debug("Pathfinding: checking neighbors.")
         for addlDist, neighbor in _getValidNeighbors(currChunk, gameState):
@@ -98,6 +106,9 @@ def findPath(gameState, srcPos, destPos):
                 neighborEstCost = neighborStartDist + neighborFwdDist
                 heapq.heappush(chunksToCheck, (neighborEstCost, neighbor))
 
+    if workCounter is not None:
+        workCounter(nodesExpanded)
+
     if      (not _chunkInBounds(gameState, destChunk)) or \
             parents[destCX][destCY] is None:
         raise NoPathToTargetError("No path exists from {} to {}."
@@ -148,7 +159,7 @@ def _heuristicDistance(chunkA, chunkB):
     bx, by = chunkB
     deltaX = ORTHOGONAL_COST * (bx - ax)
     deltaY = ORTHOGONAL_COST * (by - ay)
-    return int(math.hypot(deltaX, deltaY))
+    return integerSqrt(deltaX**2 + deltaY**2)
 
 # Helper function for findPath.
 def _getValidNeighbors(chunkPos, gameState):
@@ -198,9 +209,37 @@ def _chunkIsPassable(gameState, chunkPos):
 
 
 class AbstractCoord(object):
+    """
+    A position (Coord) or offset (Distance) in unit coordinates.
+
+    These are immutable values: equal ones hash equally, so they can be used
+    as dict keys, and a single instance can safely be shared. They have no
+    per-instance __dict__, and derived positions (chunk, build) are computed
+    at most once per instance.
+    """
+
+    # _chunk, _build and _hash cache derived values. They're left unset until
+    # first used, so that constructing one (which happens on every bit of
+    # arithmetic) costs as little as possible.
+    __slots__ = ("x", "y", "_chunk", "_build", "_hash")
+
+    # Mixed into the hash; see __hash__. A string rather than the class
+    # itself, so that hashes are the same in every process.
+    _hashSalt = "AbstractCoord"
+
     def __init__(self, uPos):
-        super(AbstractCoord, self).__init__()
-        self.x, self.y = uPos
+        # Skip calling super().__init__, for the same reason; it's object's,
+        # which does nothing.
+        x, y = uPos
+        # __setattr__ refuses to change anything, so set the slots directly.
+        _setX(self, x)
+        _setY(self, y)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable.".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable.".format(type(self).__name__))
 
     @classmethod
     def fromUnit(cls, unit):
@@ -217,11 +256,21 @@ class AbstractCoord(object):
 
     @property
     def chunk(self):
-        return (self.x // CHUNK_SIZE, self.y // CHUNK_SIZE)
+        try:
+            return self._chunk
+        except AttributeError:
+            chunk = (self.x // CHUNK_SIZE, self.y // CHUNK_SIZE)
+            _setChunk(self, chunk)
+            return chunk
 
     @property
     def build(self):
-        return (self.x // BUILD_SIZE, self.y // BUILD_SIZE)
+        try:
+            return self._build
+        except AttributeError:
+            build = (self.x // BUILD_SIZE, self.y // BUILD_SIZE)
+            _setBuild(self, build)
+            return build
 
     @property
     def unit(self):
@@ -263,20 +312,42 @@ class AbstractCoord(object):
             cx=cx, cy=cy, bx=bx, by=by, ux=ux, uy=uy
         )
 
+    # Equality only holds between coordinates of the same type; anything
+    # else (including a Coord and a Distance, or a Coord and a plain tuple)
+    # is unequal, so that mixed dicts and sets work. The hash includes the
+    # type, so that a Coord and a Distance at the same place don't collide.
+
     def __eq__(self, rhs):
-        if not isinstance(self, type(rhs)) and not isinstance(rhs, type(self)):
-            raise TypeError("Cannot compare {} with {}.".format(
-                type(self), type(rhs)
-            ))
+        if type(rhs) is not type(self):
+            return NotImplemented
         return self.x == rhs.x and self.y == rhs.y
 
     def __ne__(self, rhs):
-        if not isinstance(self, type(rhs)) and not isinstance(rhs, type(self)):
-            raise TypeError("Cannot compare {} with {}.".format(
-                type(self), type(rhs)
-            ))
+        if type(rhs) is not type(self):
+            return NotImplemented
         return self.x != rhs.x or self.y != rhs.y
 
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            value = hash((self._hashSalt, self.x, self.y))
+            _setHash(self, value)
+            return value
+
+    # Since __setattr__ refuses to do anything, copying and pickling have to
+    # be told how to make one. Being immutable, a copy can just be the same
+    # object.
+
+    def __reduce__(self):
+        return (type(self), ((self.x, self.y),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
     # Coord + Coord = err
     # Coord + Dist  = Coord
     # Dist  + Coord = Coord
@@ -289,36 +360,30 @@ class AbstractCoord(object):
     #
     #       - Coord = err
     #       - Dist  = Dist
+    #
+    # The result types are looked up in _SUM_TYPES and _DIFFERENCE_TYPES
+    # (below), which is cheaper than checking the operands with isinstance.
 
     def __add__(self, rhs):
-        if isinstance(self, Coord) and isinstance(rhs, Coord):
-            raise TypeError("Cannot add two Coords.")
-        elif isinstance(self, Distance) and isinstance(rhs, Distance):
-            retType = Distance
-        else:
-            # Coord + Distance or Distance + Coord
-            retType = Coord
-
-        x = self.x + rhs.x
-        y = self.y + rhs.y
-        return retType((x, y))
+        retType = _SUM_TYPES.get((type(self), type(rhs)))
+        if retType is None:
+            if isinstance(self, Coord) and isinstance(rhs, Coord):
+                raise TypeError("Cannot add two Coords.")
+            return NotImplemented
+        return retType((self.x + rhs.x, self.y + rhs.y))
 
     def __sub__(self, rhs):
-        if isinstance(self, Coord) == isinstance(rhs, Coord):
-            # Coord - Coord or Distance - Distance
-            retType = Distance
-        elif isinstance(self, Coord):
-            # Coord - Distance
-            retType = Coord
-        else:
-            # Distance - Coord
-            raise TypeError("Cannot subtract Distance - Coord.")
-
-        x = self.x - rhs.x
-        y = self.y - rhs.y
-        return retType((x, y))
+        retType = _DIFFERENCE_TYPES.get((type(self), type(rhs)))
+        if retType is None:
+            if isinstance(self, Distance) and isinstance(rhs, Coord):
+                raise TypeError("Cannot subtract Distance - Coord.")
+            return NotImplemented
+        return retType((self.x - rhs.x, self.y - rhs.y))
 
 class Distance(AbstractCoord):
+    __slots__ = ()
+    _hashSalt = "Distance"
+
     def length(self):
         "Return the Euclidean length of this Distance."
         return math.hypot(self.x, self.y)
@@ -339,6 +404,9 @@ class Distance(AbstractCoord):
         return rhs * self
 
 class Coord(AbstractCoord):
+    __slots__ = ()
+    _hashSalt = "Coord"
+
     @property
     def chunkCenter(self):
         """
@@ -347,6 +415,28 @@ class Coord(AbstractCoord):
         return self.fromCBU(chunk=self.chunk,
                             unit=(CHUNK_SIZE // 2, CHUNK_SIZE // 2))
 
+# Setters for AbstractCoord's slots, which bypass its __setattr__.
+# pylint: disable=invalid-name
+_setX     = AbstractCoord.x.__set__
+_setY     = AbstractCoord.y.__set__
+_setChunk = AbstractCoord._chunk.__set__  # pylint: disable=protected-access
+_setBuild = AbstractCoord._build.__set__  # pylint: disable=protected-access
+_setHash  = AbstractCoord._hash.__set__   # pylint: disable=protected-access
+# pylint: enable=invalid-name
+
+# Result types of sums and differences, by the types of the operands. Any
+# combination not listed is an error.
+_SUM_TYPES = {
+    (Coord,    Distance): Coord,
+    (Distance, Coord):    Coord,
+    (Distance, Distance): Distance,
+}
+_DIFFERENCE_TYPES = {
+    (Coord,    Coord):    Distance,
+    (Coord,    Distance): Coord,
+    (Distance, Distance): Distance,
+}
+
 class Rect(object):
     def __init__(self, coord, dist):
         if not isinstance(coord, Coord):
@@ -1,11 +1,18 @@
+import atexit
 import colorlog
 import logging
 import os
+import Queue
+import threading
+import time
 
-# Set the root logger to log all messages. This means that any logger that we
-# don't explicitly call setLevel() on will log all messages, allowing the
-# handlers to control which logs actually go through.
-logging.getLogger().setLevel(logging.DEBUG)
+# The root logger's level decides which messages go through, for any logger
+# that we don't explicitly call setLevel() on (see setLoggerLevels). Filter
+# here rather than in the handler: a logger that isn't enabled for a level
+# returns straight away, whereas one that is has to build a LogRecord and pass
+# it on to the handler before it can be thrown away. That adds up for the
+# log.debug calls made for every message sent and received.
+logging.getLogger().setLevel(logging.INFO)
 
 MAX_NAME_LENGTH = 11
 
@@ -31,15 +38,23 @@ formatter = colorlog.ColoredFormatter(  # pylint: disable=invalid-name
     style='%'
 )
 handler.setFormatter(formatter)
-handler.setLevel(logging.INFO)
+handler.setLevel(logging.DEBUG)
 
 def enableDebugLogging():
-    handler.setLevel(logging.DEBUG)
+    logging.getLogger().setLevel(logging.DEBUG)
 
 # String to use to replace the middle part of a long module name.
 SHORTENED_MIDDLE = "..."
 
 def newLogger(fullname):
+    return logging.getLogger(loggerName(fullname))
+
+def loggerName(fullname):
+    """
+    Return the (short) name of the logger that newLogger uses for the module
+    with the given __name__.
+    """
+
     # Empirically __name__'s are dot-separated in these modules, not
     # slash-separated. We could do an os.basename to deal with the case where
     # they're slash-separated, but if that happens then the rpartition below is
@@ -72,5 +87,326 @@ def newLogger(fullname):
 
         name = begin + middle + end
 
-    log = logging.getLogger(name)
-    return log
+    return name
+
+
+########################################################################
+# Per-logger levels
+
+def parseLevelSpec(spec):
+    """
+    Parse a "NAME=LEVEL" string, as given to --log-level, into a (logger
+    name, level) pair. NAME is a module (src.server.networking) or the name
+    its logger is shown with (networking); LEVEL is a level name such as
+    DEBUG or WARNING. Raises ValueError if spec isn't of that form.
+    """
+
+    name, sep, levelName = spec.partition("=")
+    level = getattr(logging, levelName.strip().upper(), None)
+    if not sep or not name.strip() or not isinstance(level, int):
+        raise ValueError("expected NAME=LEVEL, got {!r}".format(spec))
+    return loggerName(name.strip()), level
+
+def setLoggerLevels(specs):
+    """
+    Override the level of individual loggers, given "NAME=LEVEL" strings
+    (see parseLevelSpec). This works in both directions: it can turn on
+    debug logging for just one module, or quieten a noisy one.
+    """
+
+    for spec in specs:
+        name, level = parseLevelSpec(spec)
+        logging.getLogger(name).setLevel(level)
+
+
+########################################################################
+# Asynchronous logging
+
+# Most records we'll hold on to before we start dropping them, if the
+# background thread can't keep up.
+MAX_QUEUED_RECORDS = 10000
+
+# Types of log arguments that can safely be formatted later, on another
+# thread, because they can't change in the meantime.
+IMMUTABLE_ARG_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler that just puts records on a queue, for a QueueListener to handle
+    on another thread. (Python 3's logging.handlers has one of these, but
+    2.7's doesn't.)
+
+    If the queue is full, records are dropped rather than making the caller
+    wait; the listener reports how many were lost.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue   = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Strings and numbers are left for the background thread to format.
+        # Anything else could be changed by the time it gets around to it (say
+        # a set of unit ids), so format the message now. That's rare; the
+        # common case is cheap.
+        if record.args and not all(isinstance(arg, IMMUTABLE_ARG_TYPES)
+                                   for arg in record.args):
+            record.msg  = record.getMessage()
+            record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Background thread that takes records off a queue and passes them to the
+    real handler, so that formatting them and writing them out happens off
+    the reactor thread.
+    """
+
+    # Put on the queue to tell the thread to stop.
+    STOP = object()
+
+    def __init__(self, queue, handler, queueHandler=None):
+        super(QueueListener, self).__init__()
+
+        self.queue        = queue
+        self.handler      = handler
+        # Used to report records dropped because the queue was full.
+        self.queueHandler = queueHandler
+        self.thread       = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="logging")
+        # Don't keep the process alive just for this; stop() is registered to
+        # run at exit to flush whatever is left.
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self.STOP:
+                break
+            self.handleRecord(record)
+
+    def handleRecord(self, record):
+        self.reportDropped()
+        if record.levelno >= self.handler.level:
+            self.handler.handle(record)
+
+    def reportDropped(self):
+        if self.queueHandler is None or not self.queueHandler.dropped:
+            return
+        # Not exact if the reactor thread drops another one in the meantime,
+        # but close enough.
+        dropped = self.queueHandler.dropped
+        self.queueHandler.dropped -= dropped
+        self.handler.handle(logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            "Logging fell behind; dropped %d messages.", (dropped,), None
+        ))
+
+    def stop(self):
+        """
+        Handle everything that's already queued, then stop the thread.
+        """
+
+        if self.thread is None:
+            return
+        # Block if the queue is full: it's worth waiting for at this point.
+        self.queue.put(self.STOP)
+        self.thread.join()
+        self.thread = None
+        self.reportDropped()
+
+
+# The QueueListener, once startAsyncLogging has been called.
+listener = None  # pylint: disable=invalid-name
+
+def startAsyncLogging():
+    """
+    Move formatting and writing out log messages to a background thread.
+    Logging calls then just put the record on a queue, so verbose logging
+    doesn't hold up the reactor (and the tick) while colorlog formats it and
+    the terminal catches up.
+    """
+
+    global listener  # pylint: disable=global-statement,invalid-name
+    if listener is not None:
+        return
+
+    queue = Queue.Queue(MAX_QUEUED_RECORDS)
+    queueHandler = QueueHandler(queue)
+    root = logging.getLogger()
+    root.removeHandler(handler)
+    root.addHandler(queueHandler)
+    listener = QueueListener(queue, handler, queueHandler)
+    listener.start()
+    atexit.register(stopAsyncLogging)
+
+def stopAsyncLogging():
+    """
+    Flush any queued messages and go back to logging synchronously.
+    """
+
+    global listener  # pylint: disable=global-statement,invalid-name
+    if listener is None:
+        return
+
+    root = logging.getLogger()
+    root.removeHandler(listener.queueHandler)
+    listener.stop()
+    root.addHandler(handler)
+    listener = None
+
+
+########################################################################
+# Limiting hot logging sites
+
+class ThrottledLogger(object):
+    """
+    Wraps a logger for a call site that may log far more often than anyone
+    could read, such as once per network message, or once per bad message
+    from a misbehaving client. Each kind of message (by default, each format
+    string) is allowed a burst of messages, refilled at a steady rate per
+    second; beyond that, messages are counted and dropped. The count is
+    reported with the next one that gets through, or by reportSuppressed if
+    there isn't a next one.
+
+    Messages at levels the logger isn't enabled for are ignored before any
+    of that, so a throttled log.debug costs next to nothing normally.
+    """
+
+    def __init__(self, logger, rate, burst=None, clock=time.time,
+                 summaryInterval=10.0):
+        super(ThrottledLogger, self).__init__()
+
+        self.logger          = logger
+        self.rate            = float(rate)
+        self.burst           = float(rate if burst is None else burst)
+        self.clock           = clock
+        # Minimum number of seconds between calls to reportSuppressed that
+        # actually do something.
+        self.summaryInterval = summaryInterval
+        self.lastSummary     = clock()
+
+        # Mapping from key to ThrottleBucket.
+        self.buckets = {}
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, *args, **kwargs):
+        """
+        Log msg % args at level, unless too many messages with the same key
+        have been logged recently. The key defaults to msg; pass key= to
+        throttle separately by something else (such as which client a
+        warning is about).
+        """
+
+        if not self.logger.isEnabledFor(level):
+            return
+        key = kwargs.pop("key", msg)
+
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = ThrottleBucket(self.burst, now)
+            self.buckets[key] = bucket
+        else:
+            bucket.refill(now, self.rate, self.burst)
+
+        if bucket.tokens < 1:
+            if not bucket.suppressed:
+                # Remember what was suppressed, for reportSuppressed.
+                bucket.level = level
+                bucket.msg   = msg
+                bucket.args  = args
+            bucket.suppressed += 1
+            return
+        bucket.tokens -= 1
+
+        if bucket.suppressed:
+            msg = "{} (suppressed {:,} similar {})".format(
+                msg, bucket.suppressed, describeLevel(level)
+            )
+            bucket.suppressed = 0
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def reportSuppressed(self):
+        """
+        Log a summary line for each kind of message that's been suppressed
+        and not yet reported, so that a flood that stops still gets counted.
+        Meant to be called regularly (say every tick); only does anything
+        once every summaryInterval seconds.
+        """
+
+        now = self.clock()
+        if now - self.lastSummary < self.summaryInterval:
+            return
+        self.lastSummary = now
+
+        for key, bucket in self.buckets.items():
+            if bucket.suppressed:
+                self.logger.log(bucket.level,
+                                "Suppressed {:,} similar {} like: {}".format(
+                                    bucket.suppressed,
+                                    describeLevel(bucket.level), bucket.msg
+                                ), *bucket.args)
+                bucket.suppressed = 0
+                bucket.args       = None
+            else:
+                # Forget about anything that's gone quiet; it would start
+                # with a full bucket anyway.
+                bucket.refill(now, self.rate, self.burst)
+                if bucket.tokens >= self.burst:
+                    del self.buckets[key]
+
+
+class ThrottleBucket(object):
+    """
+    A ThrottledLogger's record of one kind of message.
+    """
+
+    def __init__(self, tokens, now):
+        super(ThrottleBucket, self).__init__()
+
+        # Number of messages that can be logged right now.
+        self.tokens     = tokens
+        # Time the tokens were last refilled.
+        self.updated    = now
+        # Number suppressed since the last one was logged, and the first of
+        # them.
+        self.suppressed = 0
+        self.level      = None
+        self.msg        = None
+        self.args       = None
+
+    def refill(self, now, rate, burst):
+        self.tokens  = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+def describeLevel(level):
+    if level >= logging.WARNING:
+        return "warnings"
+    return "messages"
@@ -0,0 +1,115 @@
+"""
+Dispatching messages to handlers by command.
+
+A component that handles many types of messages declares a MessageHandlers
+table at module level, and marks each handler method with the types of
+messages it handles:
+
+    networkHandlers = MessageHandlers()
+
+    class Backend(object):
+        def __init__(self):
+            self.networkDispatcher = networkHandlers.bind(
+                self, self.unhandledNetworkMessage
+            )
+
+        @networkHandlers.handles(messages.SetPos)
+        def handleSetPos(self, message):
+            ...
+
+Calling self.networkDispatcher.dispatch(message, *args) then costs a single
+dict lookup, however many types of messages there are, rather than a scan
+down a chain of isinstance checks. Each dispatcher also counts how many times
+each handler has been called and how long it's taken.
+"""
+
+from collections import defaultdict
+import time
+
+
+class MessageHandlers(object):
+    """
+    Table of which method handles each type of message, shared by every
+    instance of a component.
+    """
+
+    def __init__(self):
+        super(MessageHandlers, self).__init__()
+
+        # Mapping from message command to (unbound) handler function.
+        self.handlers = {}
+
+    def handles(self, *messageTypes):
+        """
+        Decorator marking a method as the handler for the given message types.
+        """
+
+        def register(func):
+            for messageType in messageTypes:
+                assert messageType.command not in self.handlers, \
+                    "Two handlers for {!r}".format(messageType.command)
+                self.handlers[messageType.command] = func
+            return func
+        return register
+
+    def bind(self, component, fallback):
+        """
+        Return a MessageDispatcher that calls component's handlers. Messages
+        with no handler are passed to fallback instead.
+        """
+
+        return MessageDispatcher(self, component, fallback)
+
+
+class MessageDispatcher(object):
+    """
+    The handlers from a MessageHandlers table, bound to one component.
+    """
+
+    def __init__(self, table, component, fallback):
+        super(MessageDispatcher, self).__init__()
+
+        # Mapping from message command to bound handler method.
+        self.handlers = dict((command, func.__get__(component))
+                             for command, func in table.handlers.iteritems())
+        self.fallback = fallback
+
+        # How many times each command's handler has been called, and the
+        # total time spent in it, in seconds.
+        self.calls = defaultdict(int)
+        self.times = defaultdict(float)
+
+    def dispatch(self, message, *args):
+        """
+        Call the handler for message, passing it the message followed by
+        args, and return whatever it returns.
+        """
+
+        command = message.command
+        handler = self.handlers.get(command)
+        if handler is None:
+            return self.fallback(message, *args)
+
+        startTime = time.time()
+        try:
+            return handler(message, *args)
+        finally:
+            self.calls[command] += 1
+            self.times[command] += time.time() - startTime
+
+    def reportLines(self):
+        """
+        Return a list of lines describing how often each handler has been
+        called and how long it's taken, busiest first.
+        """
+
+        lines = ["    {:<20} {:>9} {:>11} {:>10}".format(
+            "command", "calls", "total (ms)", "mean (us)"
+        )]
+        for command in sorted(self.calls, key=lambda c: -self.times[c]):
+            calls = self.calls[command]
+            total = self.times[command]
+            lines.append("    {:<20} {:>9d} {:>11.1f} {:>10.1f}".format(
+                command, calls, total * 1000, total / calls * 1e6
+            ))
+        return lines
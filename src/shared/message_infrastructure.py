@@ -1,8 +1,9 @@
 from collections import namedtuple
+import logging
 import sys
 import traceback
 
-from src.shared.logconfig import newLogger
+from src.shared.logconfig import newLogger, ThrottledLogger
 
 log = newLogger(__name__)
 
@@ -52,6 +53,14 @@ def defineMessageType(commandWord, argNamesAndSpecs):
         raise ValueError("Message command {0!r} is already taken."
                          .format(commandWord))
     assert not any(nameSpec[1].unsafe for nameSpec in argNamesAndSpecs[:-1])
+    # Optional arguments can only come at the end, after all the required
+    # ones; otherwise we couldn't tell which ones were left out.
+    numOptional = 0
+    for _name, spec in argNamesAndSpecs:
+        if spec.optional:
+            numOptional += 1
+        else:
+            assert numOptional == 0
 
     # TODO: snake_case to BigCamelCase?
     # Ideally we'd choose this name so that it matches the actual message class
@@ -63,6 +72,10 @@ def defineMessageType(commandWord, argNamesAndSpecs):
         [nameSpec[0] for nameSpec in argNamesAndSpecs]
     )
 
+    # Optional arguments default to None.
+    if numOptional > 0:
+        NamedTupleType.__new__.__defaults__ = (None,) * numOptional
+
     # Subclass from Message before NamedTupleType, so that we can override some
     # methods of NamedTupleType in Message. (We may want to do this with
     # __str__?)
@@ -80,7 +93,12 @@ def defineMessageType(commandWord, argNamesAndSpecs):
 def serializeMessage(message):
     argStrings = []
     assert len(message.argSpecs) == len(message)
-    for argSpec, arg in zip(message.argSpecs, message):
+    # Leave off any optional arguments at the end that weren't given.
+    numArgs = len(message)
+    while numArgs > 0 and message.argSpecs[numArgs - 1].optional and \
+            message[numArgs - 1] is None:
+        numArgs -= 1
+    for argSpec, arg in zip(message.argSpecs[:numArgs], message[:numArgs]):
         argWords = argSpec.encode(arg)
         if argSpec.count == 1:
             argWords = (argWords,)
@@ -102,6 +120,9 @@ def deserializeMessage(data, errorOnFail=True):
 
         args = []
         for argSpec in messageType.argSpecs:
+            if argSpec.optional and not argStrings:
+                args.append(None)
+                continue
             if argSpec.count > len(argStrings):
                 raise InvalidMessageError(data,
                                           "Not enough arguments for command.")
@@ -117,25 +138,8 @@ def deserializeMessage(data, errorOnFail=True):
 
         return messageType(*args)
     except StandardError, exc:
-        # Log the full traceback, noting where we are, much like what Twisted
-        # does for an uncaught exception.
-        stackBelow = traceback.format_exception(sys.exc_type, sys.exc_value,
-                                                sys.exc_traceback)
-        stackAbove = traceback.format_stack()
-        # Remove the last stack entry from stackAbove, because that's the call
-        # to format_stack() which isn't part of the exception's traceback.
-        stackAbove = stackAbove[:-1]
-        # Remove the first entry from stackBelow, because that's the "Traceback
-        # (most recent call last)" line which we want at the top of the
-        # traceback, rather than the middle.
-        headerLine = stackBelow[0]
-        stackBelow = stackBelow[1:]
-        # Add an extra entry in the middle noting that this is where we caught
-        # the exception.
-        midLine = "--- <exception caught here> ---\n"
-        fullStack = [headerLine] + stackAbove + [midLine] + stackBelow
-        log.debug("Caught exception in deserializeMessage.\n" +
-                  "".join(fullStack))
+        if log.isEnabledFor(logging.DEBUG):
+            logDeserializeTraceback()
 
         if errorOnFail:
             # Reraise the exception, but converted (if necessary) to an
@@ -149,6 +153,34 @@ def deserializeMessage(data, errorOnFail=True):
             return None
 
 
+def logDeserializeTraceback():
+    """
+    Log the full traceback of the exception being handled, noting where we
+    are, much like what Twisted does for an uncaught exception. This is only
+    done with debug logging on: formatting it takes far longer than failing
+    to parse the message did, and a client sending garbage could otherwise
+    keep the server busy doing just that.
+    """
+
+    stackBelow = traceback.format_exception(*sys.exc_info())
+    stackAbove = traceback.format_stack()
+    # Remove the last two stack entries from stackAbove: the call to
+    # format_stack() here, and deserializeMessage's call to this function.
+    # The exception's traceback starts in deserializeMessage already.
+    stackAbove = stackAbove[:-2]
+    # Remove the first entry from stackBelow, because that's the "Traceback
+    # (most recent call last)" line which we want at the top of the
+    # traceback, rather than the middle.
+    headerLine = stackBelow[0]
+    stackBelow = stackBelow[1:]
+    # Add an extra entry in the middle noting that this is where we caught
+    # the exception.
+    midLine = "--- <exception caught here> ---\n"
+    fullStack = [headerLine] + stackAbove + [midLine] + stackBelow
+    log.debug("Caught exception in deserializeMessage.\n" +
+              "".join(fullStack))
+
+
 class ArgumentSpecification(object):
     """
     Class used to describe how one logical argument to a message is encoded and
@@ -157,7 +189,8 @@ class ArgumentSpecification(object):
     position is encoded as two words, one for each coordinate.
     """
 
-    def __init__(self, numWords, decodeFunc, encodeFunc=None, unsafe=False):
+    def __init__(self, numWords, decodeFunc, encodeFunc=None, unsafe=False,
+                 optional=False):
         """
         Initialize an ArgumentSpecification.
           - numWords is the number of words used to encode this argument in a
@@ -171,8 +204,13 @@ class ArgumentSpecification(object):
             just be str()ed.
           - unsafe indicates whether the last word of this argument is an
             unsafe string.
+          - optional indicates that this argument may be left out, in which
+            case it's None. Optional arguments must come after all required
+            ones, and can't be unsafe.
         """
 
+        assert not (unsafe and optional)
+
         self.count      = numWords
         self.decodeFunc = decodeFunc
 
@@ -183,7 +221,8 @@ class ArgumentSpecification(object):
         else:
             self.encodeFunc = encodeFunc
 
-        self.unsafe = unsafe
+        self.unsafe   = unsafe
+        self.optional = optional
 
     def encode(self, arg):
         """
@@ -311,7 +350,8 @@ def illFormedEMessage(error, otherLog, clientId=None):
     if clientId is not None:
         sender = "client {}".format(clientId)
 
-    otherLog.warning("Received invalid message from %s: %s", sender, error)
+    warnAboutSender(otherLog, (clientId, "invalid"),
+                    "Received invalid message from %s: %s", sender, error)
 
 
 def badEMessageCommand(message, otherLog, clientId=None):
@@ -326,8 +366,9 @@ def badEMessageCommand(message, otherLog, clientId=None):
     if clientId is not None:
         sender = "client {}".format(clientId)
 
-    otherLog.warning("Could not handle message type from %s: %s",
-                     sender, message.command)
+    warnAboutSender(otherLog, (clientId, "command", message.command),
+                    "Could not handle message type from %s: %s",
+                    sender, message.command)
 
 
 def badEMessageArgument(message, otherLog, clientId=None, reason=""):
@@ -341,11 +382,28 @@ def badEMessageArgument(message, otherLog, clientId=None, reason=""):
     sender = "external source"
     if clientId is not None:
         sender = "client {}".format(clientId)
+    key = (clientId, "argument", message.command, reason)
     if reason:
         reason = "\n    " + reason
 
-    otherLog.warning("Invalid argument to message from %s: %s%s",
-                     sender, message, reason)
+    warnAboutSender(otherLog, key,
+                    "Invalid argument to message from %s: %s%s",
+                    sender, message, reason)
+
+
+def warnAboutSender(otherLog, key, msg, *args):
+    """
+    Log a warning about a bad message from an external source. If otherLog
+    is a ThrottledLogger, warnings are throttled separately for each key:
+    each combination of sender and what was wrong. That way a client
+    flooding the server with bad messages can't make it spend all its time
+    logging them, or drown out the warnings about anybody else.
+    """
+
+    if isinstance(otherLog, ThrottledLogger):
+        otherLog.warning(msg, *args, key=key)
+    else:
+        otherLog.warning(msg, *args)
 
 
 # In this case you should just let error propagate up, rather than catching it
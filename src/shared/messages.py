@@ -1,9 +1,11 @@
 import math
 
 from src.shared.geometry import Coord, Distance, Rect
-from src.shared.ident import encodeUnitId, parseUnitId
+from src.shared.ident import UnitId, encodeUnitId, parseUnitId, \
+    unitToPlayer, getUnitSubId
 from src.shared.message_infrastructure import defineMessageType, \
     ArgumentSpecification, InvalidMessageError
+from src.shared.snapshot import MapContents, UnitTable
 from src.shared.unit_set import UnitSet
 
 
@@ -74,6 +76,53 @@ def parseBool(desc):
         raise ValueError
 
 
+# State hashes -- big unsigned integers, encoded in hex to keep them short.
+
+def encodeHex(value):
+    return "{:x}".format(value)
+
+def parseHex(desc):
+    value = int(desc, 16)
+    if value < 0:
+        raise ValueError
+    return value
+
+
+# Position deltas -- a list of (unitId, Distance) pairs, packed into a single
+# word. Each entry is "<playerId>.<subId>.<dx><dy>", with the ids in hex and
+# each delta coordinate as a single hex digit (offset so that it's never
+# negative). Entries are separated by commas.
+
+# Largest change in either coordinate that can be sent as a delta. Anything
+# bigger has to be sent as an absolute SetPos.
+MAX_POS_DELTA    = 7
+POS_DELTA_OFFSET = MAX_POS_DELTA + 1
+
+def encodePosDeltas(deltas):
+    parts = []
+    for unitId, delta in deltas:
+        dx, dy = delta.unit
+        assert abs(dx) <= MAX_POS_DELTA and abs(dy) <= MAX_POS_DELTA
+        parts.append("{:x}.{:x}.{:x}{:x}".format(
+            unitToPlayer(unitId), getUnitSubId(unitId),
+            dx + POS_DELTA_OFFSET, dy + POS_DELTA_OFFSET
+        ))
+    return ",".join(parts)
+
+def parsePosDeltas(desc):
+    deltas = []
+    for part in desc.split(","):
+        playerDesc, subIdDesc, deltaDesc = part.split(".")
+        if len(deltaDesc) != 2:
+            raise ValueError("Bad position delta {!r}".format(deltaDesc))
+        dx, dy = [int(d, 16) - POS_DELTA_OFFSET for d in deltaDesc]
+        if abs(dx) > MAX_POS_DELTA or abs(dy) > MAX_POS_DELTA:
+            raise ValueError("Position delta out of range")
+        unitId = UnitId(int(playerDesc, 16), int(subIdDesc, 16))
+        deltas.append((unitId, Distance.fromUnit((dx, dy))))
+    return deltas
+
+
 ###############################################################################
 # Argument specifications
 
@@ -103,6 +152,27 @@ RECT_ARG       = ArgumentSpecification(4, Rect.deserialize, Rect.serialize)
 # The type of ground on a certain chunk.
 TERRAIN_TYPE_ARG = INT_ARG
 
+POS_DELTAS_ARG = ArgumentSpecification(1, parsePosDeltas, encodePosDeltas)
+
+# Whole-map and all-units snapshots, sent to newly-joined clients.
+MAP_CONTENTS_ARG = ArgumentSpecification(1,
+                                         MapContents.deserialize,
+                                         MapContents.serialize)
+UNIT_TABLE_ARG   = ArgumentSpecification(1,
+                                         UnitTable.deserialize,
+                                         UnitTable.serialize)
+# A GameState's stateHash, for checking that a client running the simulation
+# agrees with the server. Left out when the server isn't running in lockstep.
+STATE_HASH_ARG   = ArgumentSpecification(1, parseHex, encodeHex,
+                                         optional=True)
+# Identifies an order whose latency is being traced (see src.shared.tracing),
+# and the unit update that resulted from it. Left out when not tracing.
+TRACE_ID_ARG     = ArgumentSpecification(1, parseHex, encodeHex,
+                                         optional=True)
+# A piece of a serialized MapContents or SimulationState, for sending it a
+# little at a time.
+SNAPSHOT_DATA_ARG = ArgumentSpecification(1, str, unsafe=True)
+
 
 ###############################################################################
 # The messages themselves
@@ -116,19 +186,45 @@ GroundInfo    = defineMessageType("ground_info",
                                    ("terrainType", TERRAIN_TYPE_ARG)])
 MapSize       = defineMessageType("map_size",
                                   [("size", INT_PAIR_ARG)])
+MapSnapshot   = defineMessageType("map_snapshot",
+                                  [("contents", MAP_CONTENTS_ARG)])
+MapSnapshotPart = defineMessageType("map_snapshot_part",
+                                    [("offset", INT_ARG),
+                                     ("total", INT_ARG),
+                                     ("data", SNAPSHOT_DATA_ARG)])
 NewObelisk    = defineMessageType("new_obelisk",
                                   [("unitId", UNIT_ID_ARG),
-                                   ("pos", POS_ARG)])
+                                   ("pos", POS_ARG),
+                                   ("traceId", TRACE_ID_ARG)])
 OrderDel      = defineMessageType("order_del", [("unitSet", UNIT_SET_ARG)])
+# In lockstep mode, the server relays each tick's orders to every client. This
+# says which player the orders after it (up to the next OrderFrom or Tick)
+# came from.
+OrderFrom     = defineMessageType("order_from",
+                                  [("playerId", PLAYER_ID_ARG)])
 OrderMove     = defineMessageType("order_move", [("unitSet", UNIT_SET_ARG),
-                                                 ("dest", POS_ARG)])
+                                                 ("dest", POS_ARG),
+                                                 ("traceId", TRACE_ID_ARG)])
 OrderNew      = defineMessageType("order_new", [("unitType", UNIT_TYPE_ARG),
-                                                ("pos", POS_ARG)])
+                                                ("pos", POS_ARG),
+                                                ("traceId", TRACE_ID_ARG)])
+PosDeltas     = defineMessageType("pos_deltas",
+                                  [("deltas", POS_DELTAS_ARG)])
 ResourceAmt   = defineMessageType("resource_amount", [("amount", INT_ARG)])
 ResourceLoc   = defineMessageType("resource_loc", [("pos", POS_ARG)])
 SetPos        = defineMessageType("set_pos",
                                   [("unitId", UNIT_ID_ARG),
-                                   ("pos", POS_ARG)])
-Tick          = defineMessageType("tick", [])
+                                   ("pos", POS_ARG),
+                                   ("traceId", TRACE_ID_ARG)])
+SetViewport   = defineMessageType("set_viewport", [("rect", RECT_ARG)])
+# In lockstep mode, the server sends a newly-joined client a serialized
+# SimulationState, in pieces, the same way as the map.
+SimSnapshotPart = defineMessageType("sim_snapshot_part",
+                                    [("offset", INT_ARG),
+                                     ("total", INT_ARG),
+                                     ("data", SNAPSHOT_DATA_ARG)])
+Tick          = defineMessageType("tick", [("stateHash", STATE_HASH_ARG)])
+UnitSnapshot  = defineMessageType("unit_snapshot",
+                                  [("units", UNIT_TABLE_ARG)])
 YourIdIs      = defineMessageType("your_id_is", [("playerId", PLAYER_ID_ARG)])
 
@@ -0,0 +1,171 @@
+"""
+Statistical sampling profiler, for finding out where the reactor thread's
+time goes in a live game.
+
+While running, a signal timer (setitimer with ITIMER_PROF, which counts CPU
+time used by the process) interrupts the main thread every so often, and the
+signal handler records the stack it interrupted. Recording a sample is just
+walking the stack into a tuple of code objects and bumping a count in a
+dict, so at the default rate the overhead is small enough to leave running
+during a match. Time spent idle waiting for network traffic uses no CPU, so
+it isn't sampled.
+
+Python only runs signal handlers in the main thread, which is the one
+running the reactor, so that's the thread that gets profiled.
+
+The results are written in the "collapsed stack" format used by flamegraph
+tools (flamegraph.pl, speedscope, ...): one line per distinct stack, with the
+frames from outermost to innermost separated by semicolons, followed by the
+number of samples of that stack.
+"""
+
+from collections import defaultdict
+import os
+import signal
+import time
+
+from src.shared.logconfig import newLogger
+
+log = newLogger(__name__)
+
+# Default number of samples taken per second of CPU time.
+DEFAULT_SAMPLE_RATE = 100
+
+# Stacks are truncated to their innermost this-many frames.
+MAX_STACK_DEPTH = 100
+
+# Where "profile stop" writes the samples if no file is given.
+DEFAULT_OUTPUT_FILE = "warts-profile.folded"
+
+
+class SamplingProfiler(object):
+    def __init__(self):
+        super(SamplingProfiler, self).__init__()
+
+        # Mapping from stacks (tuples of code objects, innermost first) to
+        # the number of times they've been sampled.
+        self.samples = defaultdict(int)
+        self.running = False
+        self.rate    = None
+        # The SIGPROF handler that was installed before we started, so that
+        # we can put it back.
+        self.previousHandler = None
+        self.startTime = None
+        # Wall-clock seconds spent running, not counting the current run.
+        self.elapsed   = 0.0
+
+    @property
+    def sampleCount(self):
+        return sum(self.samples.itervalues())
+
+    def start(self, rate=DEFAULT_SAMPLE_RATE):
+        """
+        Start taking rate samples per second of CPU time. Samples from
+        previous runs are kept until clear() is called.
+        """
+
+        if self.running:
+            raise RuntimeError("Profiler is already running.")
+        if rate <= 0:
+            raise ValueError("Sample rate must be positive, not {}."
+                             .format(rate))
+
+        self.rate = rate
+        self.previousHandler = signal.signal(signal.SIGPROF, self.sample)
+        # Restart any system calls the signal interrupts, rather than having
+        # them fail with EINTR.
+        signal.siginterrupt(signal.SIGPROF, False)
+        interval = 1.0 / rate
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        self.running = True
+        self.startTime = time.time()
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previousHandler)
+        self.previousHandler = None
+        self.running = False
+        self.elapsed += time.time() - self.startTime
+        self.startTime = None
+
+    def clear(self):
+        self.samples.clear()
+        self.elapsed = 0.0
+
+    def sample(self, signalNum, frame):
+        # Signal handler; keep this as cheap as possible.
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.samples[tuple(stack)] += 1
+
+    def collapsedLines(self):
+        """
+        Return the samples as a list of lines in collapsed stack format.
+        """
+
+        # Different stacks of code objects can have the same names (say, two
+        # lambdas on the same line), so merge them after naming.
+        counts = defaultdict(int)
+        for stack, count in self.samples.iteritems():
+            key = ";".join(frameName(code) for code in reversed(stack))
+            counts[key] += count
+        return ["{} {}".format(names, count)
+                for names, count in sorted(counts.iteritems())]
+
+    def write(self, outFile):
+        for line in self.collapsedLines():
+            outFile.write(line + "\n")
+
+
+def frameName(code):
+    # Keep the name free of the semicolons that separate frames.
+    filename = os.path.relpath(code.co_filename).replace(";", ":")
+    return "{} ({}:{})".format(code.co_name, filename, code.co_firstlineno)
+
+
+def profileCommand(profiler, words):
+    """
+    Handle a "profile ..." command typed into a stdio console; words is the
+    rest of the line, split on whitespace.
+
+        profile start [RATE]  Start sampling RATE times per second.
+        profile stop [FILE]   Stop, and write the samples to FILE.
+        profile status        Say how many samples have been taken.
+    """
+
+    command = words[0] if words else "status"
+    if command == "start":
+        try:
+            rate = float(words[1]) if len(words) > 1 \
+                else DEFAULT_SAMPLE_RATE
+            profiler.start(rate)
+        except (RuntimeError, ValueError) as error:
+            log.error("Can't start profiler: %s", error)
+            return
+        log.info("Profiling at %g samples per second.", rate)
+    elif command == "stop":
+        if not profiler.running:
+            log.error("Profiler isn't running.")
+            return
+        profiler.stop()
+        path = words[1] if len(words) > 1 else DEFAULT_OUTPUT_FILE
+        try:
+            with open(path, "w") as outFile:
+                profiler.write(outFile)
+        except IOError as error:
+            log.error("Can't write profile: %s", error)
+            return
+        log.info("Wrote %d samples over %.1f seconds to %s.",
+                 profiler.sampleCount, profiler.elapsed, path)
+        profiler.clear()
+    elif command == "status":
+        log.info("Profiler is %s; %d samples so far.",
+                 "running" if profiler.running else "stopped",
+                 profiler.sampleCount)
+    else:
+        log.error("Unknown profile command %r; expected start, stop, or "
+                  "status.", command)
@@ -0,0 +1,262 @@
+"""
+The deterministic part of running the game: advancing a GameState a tick at
+a time, according to the orders players give. The server runs this (see
+src.server.game_state_manager), and so does each client when the server is
+in lockstep mode, fed the same orders at the same points, so that everyone
+ends up with the same state.
+"""
+
+from collections import deque
+
+from src.shared.exceptions import NoPathToTargetError
+from src.shared.game_state_change import ResourceChange
+from src.shared.geometry import Distance, Rect, isRectCollision, findPath
+from src.shared.ident import unitToPlayer
+from src.shared.logconfig import newLogger
+from src.shared import messages
+from src.shared.unit_orders import UnitOrders, Order, DelUnitOrder, \
+    MoveUnitOrder
+from src.shared.utils import thisShouldNeverHappen
+
+log = newLogger(__name__)
+
+# Size of each resource pool.
+POOL_SIZE = Distance.fromCBU(build=(1, 1))
+
+class Simulation(object):
+    """
+    Runs the simulation on a GameState. Changes to the game state are
+    reported to listener, through its unitCreated, unitDeleted, unitMoved
+    and resourcesChanged methods.
+    """
+
+    def __init__(self, listener, gameState):
+        super(Simulation, self).__init__()
+
+        self.listener  = listener
+        self.gameState = gameState
+        self.unitOrders = UnitOrders()
+        self.pendingChanges = deque()
+
+        # If set, a TickProfiler (see src.server.tick_profiler) that times
+        # the parts of each step and counts what they do.
+        self.profiler = None
+
+        self.elapsedTicks = 0
+
+    def step(self, orders=None):
+        """
+        Advance the simulation by one tick. orders, if given, is a list of
+        (playerId, message) pairs for orders to apply first, in that order.
+        """
+
+        if orders is not None:
+            for playerId, message in orders:
+                self.applyOrderMessage(playerId, message)
+            self.phaseDone("queuedOrders")
+
+        # FIXME: Shouldn't really go in tick(); I just put it here so we could
+        # test handling of ResourceAmt in client.
+        self.resolveResourceGathering()
+        self.phaseDone("resources")
+
+        self.applyOrders()
+        self.phaseDone("orders")
+        self.applyPendingChanges()
+        self.reportChanges()
+        self.phaseDone("changes")
+
+        self.pendingChanges.clear()
+        self.elapsedTicks += 1
+
+    def applyOrderMessage(self, playerId, message):
+        """
+        Apply an OrderNew, OrderDel, or OrderMove from the given player.
+        Return how much work it took, as a (units touched, chunks expanded by
+        path searches) pair.
+        """
+
+        # Units may have been deleted since the order was checked, so skip any
+        # that no longer exist. (In lockstep mode, every client does the same,
+        # so they still agree.)
+
+        # Number of chunks expanded by path searches, in a list so that
+        # countNodes can add to it.
+        nodesExpanded = [0]
+        def countNodes(count):
+            nodesExpanded[0] += count
+
+        if isinstance(message, messages.OrderNew):
+            self.unitOrders.createNewUnit(playerId, message.unitType,
+                                          message.pos, message.traceId)
+        elif isinstance(message, messages.OrderDel):
+            for unitId in message.unitSet:
+                if self.gameState.isUnitIdValid(unitId):
+                    self.unitOrders.giveOrders(unitId, [DelUnitOrder()])
+        elif isinstance(message, messages.OrderMove):
+            for unitId in message.unitSet:
+                if not self.gameState.isUnitIdValid(unitId):
+                    continue
+                try:
+                    srcPos = self.gameState.getPos(unitId)
+                    path = self.findPath(srcPos, message.dest, countNodes)
+                    log.debug("Issuing orders to unit %s: %s.",
+                              unitId, path)
+                    orders = map(MoveUnitOrder, path)
+                    self.unitOrders.giveOrders(unitId, orders,
+                                               message.traceId)
+                except NoPathToTargetError:
+                    log.debug("Can't order unit %s to %s: "
+                              "no path to target.",
+                              unitId, message.dest)
+                    # If the target position is not reachable, just drop the
+                    # command.
+        else:
+            thisShouldNeverHappen()
+
+        return orderUnitCount(message), nodesExpanded[0]
+
+    def findPath(self, srcPos, destPos, workCounter):
+        # Separate so that the server can time it.
+        self.count("pathsComputed")
+        return findPath(self.gameState, srcPos, destPos,
+                        workCounter=workCounter)
+
+    def count(self, counter, amount=1):
+        if self.profiler is not None:
+            self.profiler.count(counter, amount)
+
+    def phaseDone(self, phase):
+        if self.profiler is not None:
+            self.profiler.phaseDone(phase)
+
+    def checkOverlapUnitAndResource(self, uid, pool):
+        # Pool Rectangle
+        pLeft, pBottom = pool.unit
+        pRight, pTop = (pool  + Distance.fromCBU(build=(1, 1))).unit
+        # Get back into the build square
+        pTop, pRight = pTop - 1, pRight - 1
+
+        # Unit rectangle
+        uX, uY = self.gameState.getPos(uid).unit
+        uWidth, uHeight = self.gameState.getSize(uid).unit
+        uTop = uY + uHeight // 2
+        uBottom = uY - uHeight // 2
+        uRight = uX + uWidth // 2
+        uLeft = uX - uWidth // 2
+
+        return ((uBottom < pTop and uTop  > pBottom) and
+                (uLeft < pRight and uRight  > pLeft))
+
+    def resolveResourceGathering(self):
+        if self.elapsedTicks % 5 == 0:
+            for uid in self.gameState.getAllUnits():
+                for pool in self.gameState.resourcePools:
+                    unitRect = self.gameState.getRect(uid)
+                    if isRectCollision(unitRect, getPoolRect(pool)):
+                        playerId = unitToPlayer(uid)
+                        self.scheduleChange(ResourceChange(playerId, 1))
+                        break
+
+    def scheduleChange(self, change):
+        self.pendingChanges.append(change)
+
+    def applyPendingChanges(self):
+        # TODO: Figure out a way to ensure that these are commutative (or else
+        # resolve them simultaneously). As is, this solution might give a
+        # subtle advantage to lower-numbered players, depending on what we put
+        # in GameStateChanges.
+        for change in self.pendingChanges:
+            change.apply(self.gameState)
+
+    def reportChanges(self):
+        for change in self.pendingChanges:
+            # FIXME: Hack to send a ResourceAmt for ResourceChanges. Really we
+            # should just send a more general GameStateUpdate message, but that
+            # doesn't exist yet.
+            if isinstance(change, ResourceChange):
+                newResources = self.gameState.resources[change.playerId]
+                self.listener.resourcesChanged(change.playerId, newResources)
+            else:
+                thisShouldNeverHappen()
+
+    def applyOrders(self):
+        # Create any pending units.
+        for playerId, unitType, pos, traceId in \
+                self.unitOrders.getPendingNewUnits():
+            unitId = self.gameState.addUnit(playerId, unitType, pos)
+            self.listener.unitCreated(unitId, traceId=traceId)
+
+        self.unitOrders.clearPendingNewUnits()
+
+        # Resolve orders to any existing units. Go through them in a fixed
+        # order, so that every client running the simulation agrees.
+        for unitId in sorted(self.unitOrders.getAllUnitsWithOrders()):
+            assert self.gameState.isUnitIdValid(unitId)
+            self.applyOrdersForUnit(unitId)
+
+    def applyOrdersForUnit(self, unitId):
+        # TODO: Refactor this?
+        done = False
+        while not done and self.unitOrders.hasNextOrder(unitId):
+            order = self.unitOrders.getNextOrder(unitId)
+
+            # Remove unit.
+            if isinstance(order, DelUnitOrder):
+                # If a client manages to connect then disconnect within a
+                # single tick, then it's possible the only order we'll ever
+                # execute for their obelisk is the "remove" order, without
+                # having first created it. In that case, we can't remove the
+                # obelisk, because it doesn't exist: gameState.removePlayer
+                # would crash if we tried and the clients would be confused if
+                # we sent them a DeleteObelisk message for an unused id.
+                #
+                # FIXME: This is the wrong solution to that. We shouldn't allow
+                # that order to be created in the first place.
+                if self.gameState.isUnitIdValid(unitId):
+                    self.gameState.removeUnit(unitId)
+                    self.unitOrders.clearOrders(unitId)
+                    self.listener.unitDeleted(unitId)
+                done = True
+
+            # Move player.
+            elif isinstance(order, MoveUnitOrder):
+                dest = order.dest
+                pos  = self.gameState.getPos(unitId)
+
+                # Don't try to move to the current position.
+                if dest != pos:
+                    assert dest is not None
+
+                    self.gameState.moveUnitToward(unitId, dest)
+                    self.count("unitsMoved")
+                    # TODO: Maybe only broadcast the new position if we handled
+                    # a valid command? Else the position isn't changed....
+                    self.listener.unitMoved(
+                        unitId, traceId=self.unitOrders.popTraceId(unitId)
+                    )
+
+                    # TODO[#13]: Don't set done if the unit can move farther in
+                    # this tick.
+                    done = True
+
+                else:
+                    self.unitOrders.removeNextOrder(unitId)
+
+            elif isinstance(order, Order):
+                raise TypeError("Unrecognized sublass of Order")
+            else:
+                raise TypeError("Found non-Order object among orders")
+
+def orderUnitCount(message):
+    """
+    Return the number of units an order message is for.
+    """
+
+    if isinstance(message, messages.OrderNew):
+        return 1
+    return len(message.unitSet)
+
+def getPoolRect(pool):
+    # Resource pools are stored by their corners; see GameState.
+    return Rect(pool, POOL_SIZE)
@@ -0,0 +1,263 @@
+"""
+Compact descriptions of a whole map (or a whole set of units), so that a
+newly-joined client can be brought up to date with a single message instead
+of one message per chunk, resource pool, and unit.
+
+Each snapshot serializes to a single message token (no TOKEN_DELIM), so it
+can be used directly as a message argument.
+"""
+
+from src.shared.geometry import Coord
+from src.shared.ident import UnitId, unitToPlayer, getUnitSubId
+from src.shared.message_infrastructure import InvalidMessageError
+from src.shared.unit_orders import DelUnitOrder, MoveUnitOrder
+
+# Separators used within a serialized snapshot. None of these may be
+# TOKEN_DELIM or START_STRING.
+SECTION_SEP = "/"
+ITEM_SEP    = ","
+FIELD_SEP   = ":"
+RUN_SEP     = "*"
+ORDER_SEP   = ";"
+COORD_SEP   = "."
+
+# Stands for a DelUnitOrder in a serialized list of orders.
+DEL_ORDER = "D"
+
+# Placeholder for an empty table, so that a snapshot is never an empty token.
+EMPTY_TABLE = "-"
+
+
+class MapContents(object):
+    """
+    The static parts of a map: its size, the terrain type of each chunk, and
+    the positions of the resource pools.
+
+    The terrain is run-length encoded in the same order that the chunks would
+    be visited by iterating over groundTypes[x][y] (x outer, y inner). Maps
+    tend to have large uniform regions, so this is usually much smaller than
+    one entry per chunk.
+    """
+
+    def __init__(self, mapSize, groundTypes, resourcePools):
+        super(MapContents, self).__init__()
+        self.mapSize       = tuple(mapSize)
+        self.groundTypes   = groundTypes
+        # List of Coords.
+        self.resourcePools = resourcePools
+
+    @classmethod
+    def fromGameState(cls, gameState):
+        return cls(gameState.sizeInChunks, gameState.groundTypes,
+                   list(gameState.resourcePools))
+
+    def applyTo(self, gameState):
+        """
+        Load this map into a GameState that has not yet been given a size.
+        """
+
+        gameState.setSize(self.mapSize)
+        for x, column in enumerate(self.groundTypes):
+            for y, terrainType in enumerate(column):
+                gameState.setGroundType((x, y), terrainType)
+        for pos in self.resourcePools:
+            gameState.addResourcePool(pos)
+
+    def serialize(self):
+        width, height = self.mapSize
+        sizeDesc = "{}{}{}".format(width, FIELD_SEP, height)
+
+        runs = []
+        currType  = None
+        currCount = 0
+        for column in self.groundTypes:
+            for terrainType in column:
+                if terrainType == currType:
+                    currCount += 1
+                else:
+                    if currCount > 0:
+                        runs.append((currType, currCount))
+                    currType  = terrainType
+                    currCount = 1
+        if currCount > 0:
+            runs.append((currType, currCount))
+        terrainDesc = ITEM_SEP.join("{}{}{:x}".format(terrainType, RUN_SEP,
+                                                      count)
+                                    for terrainType, count in runs)
+
+        poolDesc = ITEM_SEP.join(FIELD_SEP.join(pos.serialize())
+                                 for pos in self.resourcePools)
+
+        return SECTION_SEP.join([sizeDesc, terrainDesc or EMPTY_TABLE,
+                                 poolDesc or EMPTY_TABLE])
+
+    @classmethod
+    def deserialize(cls, desc):
+        sections = desc.split(SECTION_SEP)
+        if len(sections) != 3:
+            raise InvalidMessageError(desc, "Malformed map snapshot.")
+        sizeDesc, terrainDesc, poolsDesc = sections
+
+        width, height = map(int, sizeDesc.split(FIELD_SEP))
+        if width < 0 or height < 0:
+            raise InvalidMessageError(desc, "Negative map size.")
+
+        flatTypes = []
+        for runDesc in _splitTable(terrainDesc):
+            typeDesc, _, countDesc = runDesc.partition(RUN_SEP)
+            terrainType = int(typeDesc)
+            count       = int(countDesc, 16)
+            if count <= 0 or len(flatTypes) + count > width * height:
+                raise InvalidMessageError(desc, "Bad terrain run length.")
+            flatTypes.extend([terrainType] * count)
+        if len(flatTypes) != width * height:
+            raise InvalidMessageError(desc, "Terrain doesn't fill the map.")
+        groundTypes = [flatTypes[x * height : (x + 1) * height]
+                       for x in range(width)]
+
+        pools = [Coord.deserialize(poolDesc.split(FIELD_SEP))
+                 for poolDesc in _splitTable(poolsDesc)]
+
+        return cls((width, height), groundTypes, pools)
+
+
+class UnitTable(object):
+    """
+    The id and position of every unit in the game.
+    """
+
+    def __init__(self, units):
+        super(UnitTable, self).__init__()
+        # List of (unitId, pos) pairs.
+        self.units = units
+
+    @classmethod
+    def fromGameState(cls, gameState):
+        return cls([(unitId, gameState.getPos(unitId))
+                    for unitId in sorted(gameState.positions)])
+
+    def __iter__(self):
+        return iter(self.units)
+
+    def __len__(self):
+        return len(self.units)
+
+    def serialize(self):
+        parts = []
+        for unitId, pos in self.units:
+            fields = [str(unitToPlayer(unitId)), str(getUnitSubId(unitId))]
+            fields.extend(pos.serialize())
+            parts.append(FIELD_SEP.join(fields))
+        return ITEM_SEP.join(parts) or EMPTY_TABLE
+
+    @classmethod
+    def deserialize(cls, desc):
+        units = []
+        for unitDesc in _splitTable(desc):
+            fields = unitDesc.split(FIELD_SEP)
+            if len(fields) != 4:
+                raise InvalidMessageError(desc, "Malformed unit entry.")
+            playerId, subId = map(int, fields[:2])
+            units.append((UnitId(playerId, subId),
+                          Coord.deserialize(fields[2:])))
+        return cls(units)
+
+
+class SimulationState(object):
+    """
+    Everything about a game that isn't part of the map, but that a client
+    running the simulation in lockstep needs in order to stay in sync with
+    everyone else: the number of ticks so far, each unit's type, position and
+    queued orders, and each player's resources.
+    """
+
+    def __init__(self, elapsedTicks, units, resources):
+        super(SimulationState, self).__init__()
+        self.elapsedTicks = elapsedTicks
+        # List of (unitId, unitType, pos, orders) tuples.
+        self.units        = units
+        # Mapping from player ids to resource amounts.
+        self.resources    = resources
+
+    @classmethod
+    def fromSimulation(cls, gameState, unitOrders, elapsedTicks):
+        units = []
+        for unitId in sorted(gameState.positions):
+            orders = unitOrders.orders.get(unitId, [])
+            units.append((unitId, gameState.unitTypes[unitId],
+                          gameState.getPos(unitId), list(orders)))
+        return cls(elapsedTicks, units, dict(gameState.resources))
+
+    def applyTo(self, gameState, unitOrders):
+        """
+        Load this state into a GameState with no units and an empty
+        UnitOrders.
+        """
+
+        for unitId, unitType, pos, orders in self.units:
+            gameState.insertUnit(unitId, unitType, pos)
+            if orders:
+                unitOrders.giveOrders(unitId, orders)
+        for playerId, amount in self.resources.iteritems():
+            gameState.setResources(playerId, amount)
+
+    def serialize(self):
+        unitParts = []
+        for unitId, unitType, pos, orders in self.units:
+            fields = [str(unitToPlayer(unitId)), str(getUnitSubId(unitId)),
+                      str(unitType)]
+            fields.extend(pos.serialize())
+            fields.append(ORDER_SEP.join(_serializeOrder(order)
+                                         for order in orders))
+            unitParts.append(FIELD_SEP.join(fields))
+
+        resourceParts = ["{}{}{}".format(playerId, FIELD_SEP, amount)
+                         for playerId, amount
+                         in sorted(self.resources.items())]
+
+        return SECTION_SEP.join([str(self.elapsedTicks),
+                                 ITEM_SEP.join(unitParts) or EMPTY_TABLE,
+                                 ITEM_SEP.join(resourceParts) or EMPTY_TABLE])
+
+    @classmethod
+    def deserialize(cls, desc):
+        sections = desc.split(SECTION_SEP)
+        if len(sections) != 3:
+            raise InvalidMessageError(desc, "Malformed simulation state.")
+        ticksDesc, unitsDesc, resourcesDesc = sections
+
+        units = []
+        for unitDesc in _splitTable(unitsDesc):
+            fields = unitDesc.split(FIELD_SEP)
+            if len(fields) != 6:
+                raise InvalidMessageError(desc, "Malformed unit entry.")
+            playerId, subId, unitType = map(int, fields[:3])
+            pos = Coord.deserialize(fields[3:5])
+            orders = [_deserializeOrder(orderDesc)
+                      for orderDesc in fields[5].split(ORDER_SEP)
+                      if orderDesc]
+            units.append((UnitId(playerId, subId), unitType, pos, orders))
+
+        resources = {}
+        for resourceDesc in _splitTable(resourcesDesc):
+            playerId, amount = map(int, resourceDesc.split(FIELD_SEP))
+            resources[playerId] = amount
+
+        return cls(int(ticksDesc), units, resources)
+
+
+def _serializeOrder(order):
+    if isinstance(order, DelUnitOrder):
+        return DEL_ORDER
+    return COORD_SEP.join(order.dest.serialize())
+
+def _deserializeOrder(desc):
+    if desc == DEL_ORDER:
+        return DelUnitOrder()
+    return MoveUnitOrder(Coord.deserialize(desc.split(COORD_SEP)))
+
+
+def _splitTable(desc):
+    if desc == EMPTY_TABLE:
+        return []
+    return desc.split(ITEM_SEP)
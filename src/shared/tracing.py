@@ -0,0 +1,223 @@
+"""
+Opt-in tracing of how long orders take to have a visible effect.
+
+A client started with --trace gives each OrderMove and OrderNew it sends a
+trace id. The server carries the id along with the order (through
+UnitOrders), and attaches it to the first SetPos or NewObelisk that results
+from it. Along the way, each side records when the order reached each stage
+of its trip:
+
+    client: click -> send -> receive -> render
+    server: received -> sent
+
+Comparing the two shows where the time goes: the client's send -> receive
+span is the network round trip plus the server's received -> sent span,
+which is mostly waiting for the next tick.
+
+Each finished trace is written to the trace file as a line of JSON, and the
+time between consecutive stages is added to a histogram per pair of stages.
+"""
+
+from collections import OrderedDict
+import json
+import time
+
+from src.shared.logconfig import newLogger
+
+log = newLogger(__name__)
+
+# Upper bounds of the histogram buckets, in milliseconds. There's also an
+# overflow bucket for anything slower.
+BUCKET_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Traces that haven't finished after this many seconds are forgotten; the
+# order probably had no effect (say, the destination was unreachable).
+TRACE_TIMEOUT = 30.0
+
+# Stages recorded by each side.
+CLIENT_STAGES = ("click", "send", "receive", "render")
+SERVER_STAGES = ("received", "sent")
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        super(LatencyHistogram, self).__init__()
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total  = 0.0
+        self.count  = 0
+        self.max    = 0.0
+
+    def add(self, seconds):
+        millis = seconds * 1000
+        index = 0
+        while index < len(BUCKET_BOUNDS) and millis > BUCKET_BOUNDS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """
+        Add the samples from another histogram into this one.
+        """
+
+        self.counts = [mine + theirs
+                       for mine, theirs in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def toDict(self):
+        return {"counts": self.counts, "total": self.total,
+                "count": self.count, "max": self.max}
+
+    @classmethod
+    def fromDict(cls, desc):
+        histogram = cls()
+        histogram.counts = list(desc["counts"])
+        histogram.total  = desc["total"]
+        histogram.count  = desc["count"]
+        histogram.max    = desc["max"]
+        return histogram
+
+    def percentile(self, percent):
+        """
+        Return the upper bound, in milliseconds, of the bucket containing the
+        given percentile, or None if it's in the overflow bucket or there are
+        no samples.
+        """
+
+        if self.count == 0:
+            return None
+        needed = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.counts):
+            seen += count
+            if seen >= needed:
+                return bound
+        return None
+
+
+class Tracer(object):
+    """
+    Records when each trace reaches each of the given stages, in order. A
+    trace is started by marking its first stage, and finished by marking
+    its last one; marks for traces that haven't been started (or have
+    already finished) are ignored. Trace keys can be anything hashable that
+    json can encode.
+    """
+
+    def __init__(self, stages, outFile=None, clock=time.time,
+                 timeout=TRACE_TIMEOUT):
+        super(Tracer, self).__init__()
+
+        self.stages  = stages
+        self.outFile = outFile
+        self.clock   = clock
+        self.timeout = timeout
+
+        # Mapping from trace key to a dict mapping stage to the time it was
+        # reached, for traces in progress, oldest first.
+        self.active = OrderedDict()
+        # Mapping from "<stage>-><stage>" (and "total") to LatencyHistogram.
+        self.histograms = OrderedDict()
+        for start, end in zip(stages, stages[1:]):
+            self.histograms["{}->{}".format(start, end)] = LatencyHistogram()
+        self.histograms["total"] = LatencyHistogram()
+        self.finished = 0
+        self.expired  = 0
+
+    def mark(self, key, stage, when=None):
+        # when is the time the stage was reached, if it was earlier than now
+        # (as for an input event that waited to be handled).
+        now = self.clock() if when is None else when
+        if stage == self.stages[0]:
+            self.expireOld(now)
+            self.active[key] = {stage: now}
+            return
+
+        times = self.active.get(key)
+        if times is None or stage in times:
+            return
+        times[stage] = now
+        if stage == self.stages[-1]:
+            del self.active[key]
+            self.finish(key, times)
+
+    def finish(self, key, times):
+        self.finished += 1
+        reached = [stage for stage in self.stages if stage in times]
+        for start, end in zip(reached, reached[1:]):
+            name = "{}->{}".format(start, end)
+            if name in self.histograms:
+                self.histograms[name].add(times[end] - times[start])
+        self.histograms["total"].add(times[reached[-1]] - times[reached[0]])
+
+        if self.outFile is not None:
+            record = OrderedDict([("trace", key)])
+            record.update((stage, times[stage]) for stage in reached)
+            self.outFile.write(json.dumps(record) + "\n")
+
+    def expireOld(self, now):
+        while self.active:
+            key, times = next(self.active.iteritems())
+            if now - times[self.stages[0]] < self.timeout:
+                break
+            del self.active[key]
+            self.expired += 1
+
+    def reportLines(self):
+        lines = ["{} traces finished, {} in progress, {} expired.".format(
+            self.finished, len(self.active), self.expired
+        )]
+        return lines + histogramReportLines(self.histograms)
+
+    def logReport(self):
+        log.info("Order latency:")
+        for line in self.reportLines():
+            log.info("%s", line)
+
+    def close(self):
+        """
+        Log a final report and close the trace file.
+        """
+
+        self.logReport()
+        if self.outFile is not None:
+            self.outFile.close()
+            self.outFile = None
+
+
+def histogramReportLines(histograms):
+    """
+    Return a list of lines summarizing each of the given histograms (a dict
+    mapping names to LatencyHistograms).
+    """
+
+    lines = []
+    for name, histogram in histograms.iteritems():
+        if histogram.count == 0:
+            continue
+        percentiles = ", ".join(
+            "p{} {}".format(percent, formatBound(
+                histogram.percentile(percent)
+            )) for percent in (50, 95, 99)
+        )
+        lines.append("    {:<18} mean {:7.1f} ms, max {:7.1f} ms; {}".format(
+            name, 1000 * histogram.total / histogram.count,
+            1000 * histogram.max, percentiles
+        ))
+        buckets = " ".join(
+            "{}:{}".format(formatBound(bound), count)
+            for bound, count in zip(BUCKET_BOUNDS + (None,), histogram.counts)
+            if count
+        )
+        lines.append("        {}".format(buckets))
+    return lines
+
+
+def formatBound(bound):
+    if bound is None:
+        return ">{}ms".format(BUCKET_BOUNDS[-1])
+    return "<={}ms".format(bound)
@@ -1,11 +1,16 @@
 class UnitOrders(object):
     def __init__(self):
         self.orders = {}
-        # List of units to create at next tick.
+        # List of units to create at next tick, as (playerId, unitType, pos,
+        # traceId) tuples.
         self.pendingNewUnits = []
+        # Mapping from unit ids to the trace ids (see src.shared.tracing) of
+        # their current orders, for units whose orders are being traced and
+        # haven't had any effect yet.
+        self.traceIds = {}
 
-    def createNewUnit(self, playerId, unitType, pos):
-        self.pendingNewUnits.append((playerId, unitType, pos))
+    def createNewUnit(self, playerId, unitType, pos, traceId=None):
+        self.pendingNewUnits.append((playerId, unitType, pos, traceId))
 
     def getPendingNewUnits(self):
         for x in self.pendingNewUnits:
@@ -18,14 +23,28 @@ class UnitOrders(object):
     def clearPendingNewUnits(self):
         self.pendingNewUnits = []
 
-    def giveOrders(self, unit, orders):
+    def giveOrders(self, unit, orders, traceId=None):
         assert isinstance(orders, list)
         for order in orders:
             assert isinstance(order, Order)
         self.orders[unit] = orders
+        if traceId is not None:
+            self.traceIds[unit] = traceId
+        else:
+            self.traceIds.pop(unit, None)
 
     def clearOrders(self, unit):
         del self.orders[unit]
+        self.traceIds.pop(unit, None)
+
+    def popTraceId(self, unit):
+        """
+        Return the trace id of the unit's current orders (or None if they're
+        not being traced), and stop tracing them. Called when the orders
+        first have an effect.
+        """
+
+        return self.traceIds.pop(unit, None)
 
     def hasNextOrder(self, unit):
         return unit in self.orders and len(self.orders[unit]) > 0
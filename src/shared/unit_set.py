@@ -1,132 +1,330 @@
-from collections import defaultdict
+import binascii
 
 from src.shared.ident import UnitId, unitToPlayer, getUnitSubId
 from src.shared.logconfig import newLogger
 
 log = newLogger(__name__)
 
+# Marks a serialized set of subIds that's run-length encoded rather than a
+# hex bitmap; see _serializeSubIds.
+RLE_PREFIX = "r"
+
+# Largest subId we'll accept in a run-length encoded set. A hex bitmap can't
+# describe anything much bigger than the message it arrives in, but a few
+# characters of runs could otherwise describe an enormous one.
+MAX_SUB_ID = 2**20
+
+# Number of bits handled at a time when scanning a bitmap for set bits.
+WORD_BITS = 64
+
 
 class UnitSet(object):
+    """
+    A set of UnitIds. For each player, the subIds of their units are stored
+    as the bits of a single (arbitrary-precision) integer, so that a set of
+    thousands of units takes a few hundred bytes, and set operations work a
+    machine word at a time rather than a unit at a time.
+    """
+
     def __init__(self, units=None):
         super(UnitSet, self).__init__()
-        if units is None:
-            units = []
-        self.units = defaultdict(set)
-        self.addMany(units)
+        # Mapping from playerId to a bitmap of that player's subIds. Players
+        # with no units in the set are left out, rather than mapped to 0.
+        self.units = {}
+        if units is not None:
+            self.addMany(units)
 
     def serialize(self):
         if not self.units:
             return "0:0"
 
-        desc = ""
-        isFirst = True
-        for playerId in sorted(self.units.keys()):
-            part = ""
-            if not isFirst:
-                part += ","
-            isFirst = False
-            part += str(playerId)
-            part += ":"
-            part += _serializeSubIds(self.units[playerId])
-            desc += part
-        return desc
+        return ",".join("{}:{}".format(playerId,
+                                       _serializeSubIds(self.units[playerId]))
+                        for playerId in sorted(self.units))
 
     @classmethod
     def deserialize(cls, desc):
         ret = cls()
         for part in desc.split(","):
             playerId, _, subIdDesc = part.partition(":")
-            subIds = _deserializeSubIds(subIdDesc)
-            # pylint doesn't recognize that _addManyHomogeneous is a protected
-            # member of this same class, so complains. I think this is just a
+            # pylint doesn't recognize that _addBitmap is a protected member
+            # of this same class, so complains. I think this is just a
             # limitation of the tool; see:
             #     https://stackoverflow.com/q/38035158
-            ret._addManyHomogeneous(  # pylint: disable=protected-access
-                int(playerId), subIds
+            ret._addBitmap(  # pylint: disable=protected-access
+                int(playerId), _deserializeSubIds(subIdDesc)
             )
         return ret
 
-    # TODO: Optimize better. Make use of _addManyHomogeneous if there's a lot
-    # of units? Or just expose that one as a public method....
     def addMany(self, units):
+        # Group the units by player, then build each player's bitmap in one
+        # go, rather than setting one bit at a time (which would copy the
+        # whole bitmap each time).
+        subIdsByPlayer = {}
         for unit in units:
-            self.add(unit)
+            assert isinstance(unit, UnitId)
+            subIdsByPlayer.setdefault(unitToPlayer(unit), []) \
+                .append(getUnitSubId(unit))
+        for playerId, subIds in subIdsByPlayer.iteritems():
+            self._addBitmap(playerId, _bitmapFromSubIds(subIds))
 
-    def _addManyHomogeneous(self, playerId, subIds):
-        self.units[playerId].update(subIds)
+    def _addBitmap(self, playerId, bitmap):
+        if bitmap:
+            self.units[playerId] = self.units.get(playerId, 0) | bitmap
 
     def add(self, unit):
         assert isinstance(unit, UnitId)
-        playerId = unitToPlayer(unit)
-        subId    = getUnitSubId(unit)
-        self.units[playerId].add(subId)
+        self._addBitmap(unitToPlayer(unit), 1 << getUnitSubId(unit))
 
     def remove(self, unit):
         assert isinstance(unit, UnitId)
         playerId = unitToPlayer(unit)
-        subId    = getUnitSubId(unit)
-        try:
-            self.units[playerId].remove(subId)
-        except KeyError:
+        bit      = 1 << getUnitSubId(unit)
+        bitmap   = self.units.get(playerId, 0)
+        if not bitmap & bit:
             log.warn("Can't remove unit %s: No such unit in set.", unit)
-        if not self.units[playerId]:
+            return
+        bitmap ^= bit
+        if bitmap:
+            self.units[playerId] = bitmap
+        else:
             del self.units[playerId]
 
+    def forPlayer(self, playerId):
+        """
+        Return a UnitSet of just the given player's units in this set.
+        """
+
+        ret = UnitSet()
+        ret._addBitmap(  # pylint: disable=protected-access
+            playerId, self.units.get(playerId, 0)
+        )
+        return ret
+
+    @property
+    def playerIds(self):
+        """
+        Return a sorted list of the players with units in this set.
+        """
+
+        return sorted(self.units)
+
+    # Set algebra. Each of these works on whole bitmaps, so costs time
+    # proportional to the number of words in them, not the number of units.
+
+    def union(self, other):
+        ret = UnitSet()
+        ret.units = dict(self.units)
+        for playerId, bitmap in other.units.iteritems():
+            ret._addBitmap(  # pylint: disable=protected-access
+                playerId, bitmap
+            )
+        return ret
+
+    def intersection(self, other):
+        ret = UnitSet()
+        for playerId, bitmap in self.units.iteritems():
+            ret._addBitmap(  # pylint: disable=protected-access
+                playerId, bitmap & other.units.get(playerId, 0)
+            )
+        return ret
+
+    def difference(self, other):
+        ret = UnitSet()
+        for playerId, bitmap in self.units.iteritems():
+            ret._addBitmap(  # pylint: disable=protected-access
+                playerId, bitmap & ~other.units.get(playerId, 0)
+            )
+        return ret
+
+    __or__  = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __eq__(self, other):
+        if not isinstance(other, UnitSet):
+            return NotImplemented
+        return self.units == other.units
+
+    def __ne__(self, other):
+        if not isinstance(other, UnitSet):
+            return NotImplemented
+        return self.units != other.units
+
+    # Mutable, so not hashable (like set).
+    __hash__ = None
+
     def __len__(self):
-        count = 0
-        for units in self.units.values():
-            count += len(units)
-        return count
+        return sum(_popcount(bitmap) for bitmap in self.units.itervalues())
+
+    def __nonzero__(self):
+        return bool(self.units)
 
     def __contains__(self, unit):
         assert isinstance(unit, UnitId)
-        playerId = unitToPlayer(unit)
-        subId    = getUnitSubId(unit)
-        return subId in self.units[playerId]
+        bitmap = self.units.get(unitToPlayer(unit), 0)
+        return bool((bitmap >> getUnitSubId(unit)) & 1)
 
     def __iter__(self):
-        for playerId in sorted(self.units.keys()):
-            for subId in sorted(self.units[playerId]):
+        for playerId in sorted(self.units):
+            for subId in _iterSubIds(self.units[playerId]):
                 yield UnitId(playerId, subId)
 
     def __repr__(self):
-        s = "{"
-        isFirst = True
-        for playerId in sorted(self.units.keys()):
-            part = ""
-            if not isFirst:
-                part += ", "
-            isFirst = False
-            part += repr(playerId) + ": " + repr(sorted(self.units[playerId]))
-            s += part
-        s += "}"
-        return s
-
-
-def _serializeSubIds(subIds):
+        return "{" + ", ".join(
+            "{!r}: {!r}".format(playerId,
+                                list(_iterSubIds(self.units[playerId])))
+            for playerId in sorted(self.units)
+        ) + "}"
+
+
+def _popcount(bitmap):
+    return bin(bitmap).count("1")
+
+
+def _bitmapFromSubIds(subIds):
+    """
+    Return the bitmap with the bits for the given subIds set.
+    """
+
+    if not subIds:
+        return 0
+    # Set the bits in a bytearray, then convert the whole thing to an int at
+    # once.
+    data = bytearray((max(subIds) >> 3) + 1)
+    for subId in subIds:
+        assert subId >= 0
+        data[subId >> 3] |= 1 << (subId & 7)
+    return _bitmapFromBytes(data)
+
+
+def _bitmapFromBytes(data):
     """
-    Serialize a set of unit subIds, without regard for the playerId.
+    Convert a bytearray holding a bitmap, least significant byte first, to
+    an int. Reverses data in place.
     """
 
-    val = 0
-    for i in subIds:
-        val |= (1 << i)
-    return "{:x}".format(val)
+    # Most significant byte first, for hexlify.
+    data.reverse()
+    return int(binascii.hexlify(data), 16)
+
+
+def _setBitRange(data, start, end):
+    """
+    Set bits [start, end) of a bytearray holding a bitmap, least significant
+    byte first. Whole bytes are set at once, so this takes time proportional
+    to the number of bytes, not bits.
+    """
+
+    if start >= end:
+        return
+    firstByte = start >> 3
+    lastByte  = (end - 1) >> 3
+    # Mask of the bits from start's bit to the top of the first byte, and
+    # from the bottom of the last byte to end's bit.
+    lowMask  = (0xff << (start & 7)) & 0xff
+    highMask = (1 << (((end - 1) & 7) + 1)) - 1
+    if firstByte == lastByte:
+        data[firstByte] |= lowMask & highMask
+        return
+    data[firstByte] |= lowMask
+    data[firstByte + 1 : lastByte] = "\xff" * (lastByte - firstByte - 1)
+    data[lastByte] |= highMask
+
+
+def _iterSubIds(bitmap):
+    """
+    Generate the subIds whose bits are set in bitmap, in increasing order.
+    """
+
+    # Split the bitmap into words via its hex representation, which takes
+    # time proportional to its length; shifting it right a word at a time
+    # would copy the rest of it each time.
+    hexDigits = WORD_BITS // 4
+    desc = "{:x}".format(bitmap)
+    base = 0
+    for end in xrange(len(desc), 0, -hexDigits):
+        word = int(desc[max(0, end - hexDigits) : end], 16)
+        while word:
+            lowest = word & -word
+            yield base + lowest.bit_length() - 1
+            word ^= lowest
+        base += WORD_BITS
+
+
+def _serializeSubIds(bitmap):
+    """
+    Serialize a set of unit subIds (as a bitmap), without regard for the
+    playerId.
+
+    Normally this is just the bitmap in hex. But a few units with large
+    subIds, or long runs of consecutive ones, are shorter as a list of runs:
+    RLE_PREFIX followed by dot-separated hex numbers, alternating between
+    the number of subIds skipped and the number included.
+    """
+
+    bitmapDesc = "{:x}".format(bitmap)
+    # Each run takes at least a few characters, so don't bother working out
+    # the runs unless there are few enough units for that to win.
+    if 4 * _popcount(bitmap) >= len(bitmapDesc) and \
+            not _hasLongRuns(bitmap):
+        return bitmapDesc
+
+    # Find the runs, as [start, end) pairs.
+    runs = []
+    for subId in _iterSubIds(bitmap):
+        if runs and runs[-1][1] == subId:
+            runs[-1][1] += 1
+        else:
+            runs.append([subId, subId + 1])
+    parts = []
+    prevEnd = 0
+    for start, end in runs:
+        parts.append("{:x}.{:x}".format(start - prevEnd, end - start))
+        prevEnd = end
+    rleDesc = RLE_PREFIX + ".".join(parts)
+
+    if len(rleDesc) < len(bitmapDesc):
+        return rleDesc
+    return bitmapDesc
+
+
+def _hasLongRuns(bitmap):
+    # Cheap check for whether the bitmap has any runs of at least a word's
+    # worth of set bits, in which case it might be shorter as runs even
+    # though it has lots of units.
+    return "f" * (WORD_BITS // 4) in "{:x}".format(bitmap)
 
 
 def _deserializeSubIds(desc):
     """
-    Serialize a set of unit subIds, without regard for the playerId.
+    Deserialize a set of unit subIds, without regard for the playerId, into
+    a bitmap. See _serializeSubIds.
     """
 
-    val = int(desc, 16)
-    ret = []
-    subId = 0
-    bit   = 1
-    while bit <= val:
-        if val & bit:
-            ret.append(subId)
-        bit   <<= 1
-        subId  += 1
-    return ret
+    if not desc.startswith(RLE_PREFIX):
+        bitmap = int(desc, 16)
+        if bitmap < 0:
+            raise ValueError("Negative unit set {!r}".format(desc))
+        return bitmap
 
+    words = [int(word, 16) for word in desc[len(RLE_PREFIX):].split(".")]
+    if len(words) % 2 != 0 or any(word < 0 for word in words):
+        raise ValueError("Bad run-length encoded unit set {!r}".format(desc))
+    # Work out where the runs are, and check the total size, before setting
+    # any bits. Then set them all in a bytearray and convert that once, so
+    # that decoding takes time proportional to the size of the bitmap; or-ing
+    # each run into an int would copy the whole bitmap once per run.
+    runs  = []
+    subId = 0
+    for index in range(0, len(words), 2):
+        gap, length = words[index], words[index + 1]
+        subId += gap
+        if subId + length > MAX_SUB_ID:
+            raise ValueError("Unit set {!r} is too large".format(desc))
+        runs.append((subId, subId + length))
+        subId += length
+    data = bytearray((subId >> 3) + 1)
+    for start, end in runs:
+        _setBitRange(data, start, end)
+    return _bitmapFromBytes(data)
@@ -5,6 +5,34 @@ def minmax(a, b):
     else:
         return (b, a)
 
+def integerSqrt(n):
+    """
+    Return the largest integer whose square is at most n, using only integer
+    arithmetic (so that the result is the same on every machine).
+    """
+
+    if n < 0:
+        raise ValueError("Square root of negative number {}.".format(n))
+    if n == 0:
+        return 0
+    # Newton's method, starting from a power of 2 that's at least sqrt(n).
+    x = 1 << ((n.bit_length() + 1) // 2)
+    while True:
+        y = (x + n // x) // 2
+        if y >= x:
+            return x
+        x = y
+
+def divideAndRound(numerator, denominator):
+    """
+    Divide integers, rounding halves away from zero like round() does, but
+    without going through floating point. denominator must be positive.
+    """
+
+    if numerator < 0:
+        return -((-2 * numerator + denominator) // (2 * denominator))
+    return (2 * numerator + denominator) // (2 * denominator)
+
 def thisShouldNeverHappen(reason=None):
     if reason is None:
         reason = "This should never happen"
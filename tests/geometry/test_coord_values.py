@@ -0,0 +1,56 @@
+import copy
+import pickle
+
+import pytest
+
+from src.shared.geometry import Coord, Distance
+
+
+class TestCoordValues:
+    """
+    Make sure Coords and Distances behave as immutable values.
+    """
+
+    def test_immutable(self):
+        pos = Coord((1, 2))
+        with pytest.raises(AttributeError):
+            pos.x = 3
+        with pytest.raises(AttributeError):
+            pos.extra = 3
+        with pytest.raises(AttributeError):
+            del pos.y
+        assert pos.unit == (1, 2)
+
+    def test_hashing(self):
+        table = {Coord((1, 2)): "a", Distance((3, 4)): "b"}
+        assert table[Coord((1, 2))] == "a"
+        assert table[Coord((0, 1)) + Distance((1, 1))] == "a"
+        assert table[Distance((3, 4))] == "b"
+        assert Coord((1, 2)) not in set([Coord((2, 1))])
+
+    def test_equality(self):
+        assert Coord((1, 2)) == Coord((1, 2))
+        assert Coord((1, 2)) != Coord((1, 3))
+        # Other types are just unequal, so that lookups in mixed containers
+        # work.
+        assert Coord((1, 2)) != Distance((1, 2))
+        assert not Coord((1, 2)) == (1, 2)
+        assert Coord((1, 2)) != None
+        assert {Coord((1, 2)): 1}.get((1, 2)) is None
+        assert Distance((3, 4)) not in set([Coord((3, 4))])
+
+    def test_copying(self):
+        pos = Coord((1, 2))
+        assert copy.copy(pos) is pos
+        assert copy.deepcopy({"pos": pos})["pos"] is pos
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copied = pickle.loads(pickle.dumps(Distance((3, 4)), protocol))
+            assert type(copied) is Distance and copied == Distance((3, 4))
+
+    def test_cachedProperties(self):
+        pos = Coord.fromCBU(chunk=(2, 3), build=(1, 0), unit=(5, 6))
+        # Twice, to get the cached values.
+        for _ in range(2):
+            assert pos.chunk == (2, 3)
+            assert pos.build == Coord.fromCBU(chunk=(2, 3), build=(1, 0)) \
+                .build
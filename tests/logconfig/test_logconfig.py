@@ -0,0 +1,186 @@
+import logging
+import Queue
+
+from src.main import parseArguments
+from src.server.headless import HeadlessSimulation
+from src.shared.geometry import Coord
+from src.shared.ident import unitToPlayer
+from src.shared.logconfig import QueueHandler, QueueListener, \
+    ThrottledLogger, loggerName, parseLevelSpec
+from src.shared import messages
+from src.shared.unit_set import UnitSet
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def newTestLogger(name):
+    logger = logging.getLogger("test_logconfig." + name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+
+class TestAsyncLogging:
+    """
+    Make sure records logged through a QueueHandler get to the real handler,
+    formatted as they were when they were logged.
+    """
+
+    def test_listener(self):
+        queue = Queue.Queue()
+        handler = ListHandler()
+        listener = QueueListener(queue, handler)
+        listener.start()
+
+        logger = logging.getLogger("test_logconfig.async")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        queueHandler = QueueHandler(queue)
+        logger.addHandler(queueHandler)
+
+        units = set([1, 2])
+        logger.info("Moving %s to %s", units, (3, 4))
+        units.add(5)
+        logger.debug("Not logged")
+        logger.info("Done with %d", 2)
+        listener.stop()
+        logger.removeHandler(queueHandler)
+
+        assert handler.messages == ["Moving set([1, 2]) to (3, 4)",
+                                    "Done with 2"]
+
+    def test_full_queue(self):
+        queue = Queue.Queue(1)
+        handler = ListHandler()
+        queueHandler = QueueHandler(queue)
+        listener = QueueListener(queue, handler, queueHandler)
+
+        for index in range(3):
+            queueHandler.handle(logging.LogRecord("test", logging.INFO, "", 0,
+                                                  "%d", (index,), None))
+        assert queueHandler.dropped == 2
+
+        listener.start()
+        listener.stop()
+        assert handler.messages == ["Logging fell behind; dropped 2 "
+                                    "messages.", "0"]
+
+
+class TestLimitedLogging:
+    """
+    Make sure throttled and sampled loggers let through the right messages.
+    """
+
+    def test_throttled(self):
+        logger, handler = newTestLogger("throttled")
+        now = [0.0]
+        throttled = ThrottledLogger(logger, rate=2, burst=3,
+                                    clock=lambda: now[0])
+
+        for index in range(10):
+            throttled.info("Message %d", index)
+        throttled.debug("Below the logger's level")
+        # Each key has its own allowance.
+        throttled.info("Other %d", 0, key="other")
+        now[0] = 1.0
+        for index in range(10, 20):
+            throttled.info("Message %d", index)
+
+        assert handler.messages == [
+            "Message 0", "Message 1", "Message 2", "Other 0",
+            "Message 10 (suppressed 7 similar messages)", "Message 11",
+        ]
+
+
+class TestLevels:
+    """
+    Make sure --log-level arguments are understood.
+    """
+
+    def test_parse(self):
+        assert parseLevelSpec("networking=warning") == \
+            ("networking", logging.WARNING)
+        assert parseLevelSpec("src.server.networking=DEBUG") == \
+            ("networking", logging.DEBUG)
+        assert parseLevelSpec("src.server.game_state_manager=INFO") == \
+            (loggerName("game_state_manager"), logging.INFO)
+        for spec in ("networking", "=DEBUG", "networking=LOUD"):
+            try:
+                parseLevelSpec(spec)
+            except ValueError:
+                pass
+            else:
+                assert False, spec
+
+    def test_arguments(self):
+        # The logging options work on either side of the subcommand.
+        for argv in (["--log-async", "--log-level", "networking=DEBUG",
+                      "replay", "f"],
+                     ["replay", "f", "--log-async", "--log-level",
+                      "networking=DEBUG"]):
+            args = parseArguments(argv)
+            assert args.command == "replay"
+            assert args.log_async
+            assert not args.log_debug
+            assert args.log_level == ["networking=DEBUG"]
+
+        args = parseArguments(["--log-debug", "simulate", "--log-async"])
+        assert args.log_debug and args.log_async
+        assert args.log_level is None
+
+        args = parseArguments(["server"])
+        assert not args.log_debug and not args.log_async
+        assert args.log_level is None
+
+
+class TestFloodProtection:
+    """
+    Make sure a client sending a flood of bad messages only gets a few
+    warnings logged about it, followed by a summary.
+    """
+
+    def test_bad_orders(self):
+        simulation = HeadlessSimulation(numPlayers=2, unitsPerPlayer=2,
+                                        seed=0)
+        simulation.run(3)
+        interfacer = simulation.clientInterfacer
+        logger, handler = newTestLogger("flood")
+        logger.setLevel(logging.WARNING)
+        now = [0.0]
+        interfacer.warningLog = ThrottledLogger(logger, 1, 2,
+                                                clock=lambda: now[0],
+                                                summaryInterval=10.0)
+
+        cheater, victim = simulation.clients
+        gameState = simulation.gameStateManager.gameState
+        victimUnits = UnitSet(unitId for unitId in gameState.positions
+                              if unitToPlayer(unitId) == victim.playerId)
+        assert len(victimUnits) == 2
+        order = messages.OrderMove(victimUnits, Coord.fromUnit((5, 5)))
+        for _ in range(100):
+            interfacer.stringReceived(cheater.playerId, order.serialize())
+            interfacer.stringReceived(cheater.playerId, "garbage")
+            interfacer.tick()
+        # Warnings about the other client are kept separately.
+        interfacer.stringReceived(victim.playerId, "garbage")
+
+        # One warning per message (not per unit), and only the first couple
+        # for each reason.
+        assert len(handler.messages) == 5
+        assert sum("garbage" in line for line in handler.messages) == 3
+
+        now[0] = 11.0
+        interfacer.tick()
+        summaries = handler.messages[5:]
+        assert len(summaries) == 2
+        assert all(line.startswith("Suppressed 98 similar warnings like: ")
+                   for line in summaries)
@@ -0,0 +1,60 @@
+from src.shared.message_dispatch import MessageHandlers
+from src.shared import messages
+
+
+handlers = MessageHandlers()  # pylint: disable=invalid-name
+
+
+class Component(object):
+    def __init__(self):
+        self.handled   = []
+        self.unhandled = []
+        self.dispatcher = handlers.bind(self, self.unhandledMessage)
+
+    def unhandledMessage(self, message, extra):
+        self.unhandled.append((message, extra))
+        return "unhandled"
+
+    @handlers.handles(messages.Tick)
+    def handleTick(self, message, extra):
+        self.handled.append(("tick", extra))
+        return "tick"
+
+    @handlers.handles(messages.OrderNew, messages.OrderDel)
+    def handleOrder(self, message, extra):
+        self.handled.append(("order", extra))
+        return "order"
+
+
+class TestDispatch:
+    """
+    Make sure messages get to the right handlers, and that the calls are
+    counted.
+    """
+
+    def test_dispatch(self):
+        component = Component()
+        dispatcher = component.dispatcher
+        assert dispatcher.dispatch(messages.Tick(), 1) == "tick"
+        assert dispatcher.dispatch(messages.OrderDel(()), 2) == "order"
+        assert dispatcher.dispatch(messages.Tick(), 3) == "tick"
+        assert dispatcher.dispatch(messages.YourIdIs(0), 4) == "unhandled"
+
+        assert component.handled == [("tick", 1), ("order", 2), ("tick", 3)]
+        assert component.unhandled == [(messages.YourIdIs(0), 4)]
+        assert dispatcher.calls == {messages.Tick.command: 2,
+                                    messages.OrderDel.command: 1}
+        assert len(dispatcher.reportLines()) == 3
+
+        # Each component has its own counts.
+        assert not Component().dispatcher.calls
+
+    def test_duplicate(self):
+        try:
+            @handlers.handles(messages.Tick)
+            def handleTickAgain(self, message, extra):
+                pass
+        except AssertionError:
+            pass
+        else:
+            assert False, "Registered two handlers for the same message"
@@ -0,0 +1,74 @@
+import pytest
+
+from src.server.game_state_manager import getDefaultGameState
+from src.shared.game_state import GameState
+from src.shared.geometry import Coord
+from src.shared.ident import UnitId
+from src.shared.message_infrastructure import deserializeMessage, \
+    InvalidMessageError
+from src.shared import messages
+from src.shared.snapshot import MapContents, UnitTable
+
+
+class TestSnapshot:
+    """
+    Make sure map and unit snapshots survive a round trip through a message.
+    """
+
+    def test_mapRoundTrip(self):
+        gameState = GameState()
+        gameState.setSize((7, 4))
+        for chunk in [(0, 0), (0, 1), (3, 2), (6, 3)]:
+            gameState.setGroundType(chunk, 1)
+        gameState.addResourcePool(Coord.fromCBU(chunk=(2, 2), build=(1, 4)))
+
+        msg = messages.MapSnapshot(MapContents.fromGameState(gameState))
+        data = msg.serialize()
+        newMsg = deserializeMessage(data)
+        assert isinstance(newMsg, messages.MapSnapshot)
+
+        newState = GameState()
+        newMsg.contents.applyTo(newState)
+        assert newState.sizeInChunks  == (7, 4)
+        assert newState.groundTypes   == gameState.groundTypes
+        assert newState.resourcePools == gameState.resourcePools
+
+    def test_resourcePools(self):
+        # Pools are Coords everywhere, so the server's default map loads
+        # into a client's GameState unchanged.
+        gameState = getDefaultGameState()
+        newState = GameState()
+        MapContents.fromGameState(gameState).applyTo(newState)
+        assert newState.resourcePools == gameState.resourcePools
+
+        with pytest.raises(TypeError):
+            gameState.addResourcePool((1, 2))
+
+    def test_mapIsCompact(self):
+        gameState = GameState()
+        gameState.setSize((512, 512))
+        data = messages.MapSnapshot(MapContents.fromGameState(gameState)) \
+            .serialize()
+        assert len(data) < 100
+
+    def test_mapVersion(self):
+        gameState = GameState()
+        gameState.setSize((2, 2))
+        version = gameState.mapVersion
+        gameState.setGroundType((1, 1), 1)
+        assert gameState.mapVersion != version
+
+    def test_badTerrainLength(self):
+        with pytest.raises(InvalidMessageError):
+            deserializeMessage("map_snapshot 2:2/0*3/-")
+
+    def test_unitRoundTrip(self):
+        units = [(UnitId(0, 3), Coord.fromUnit((10, -4))),
+                 (UnitId(2, 0), Coord.fromUnit((0, 99)))]
+        data = messages.UnitSnapshot(UnitTable(units)).serialize()
+        newMsg = deserializeMessage(data)
+        assert list(newMsg.units) == units
+
+        empty = deserializeMessage(messages.UnitSnapshot(UnitTable([]))
+                                   .serialize())
+        assert len(empty.units) == 0
@@ -0,0 +1,84 @@
+import pytest
+
+from src.shared.ident import UnitId
+from src.shared.unit_set import UnitSet, MAX_SUB_ID, RLE_PREFIX
+
+
+def units(playerId, subIds):
+    return [UnitId(playerId, subId) for subId in subIds]
+
+
+class TestUnitSet:
+    """
+    Make sure UnitSets behave like sets of UnitIds, and survive being
+    serialized and deserialized.
+    """
+
+    def test_roundTrip(self):
+        cases = [
+            [],
+            units(0, [0]),
+            units(1, [3, 5, 8]) + units(2, [0, 1]),
+            # Few, far apart: run-length encoded.
+            units(0, [3, 100000]),
+            # One long run: run-length encoded.
+            units(3, range(1000)),
+            # Dense but irregular: a plain bitmap.
+            units(0, range(0, 200, 3)),
+        ]
+        for unitIds in cases:
+            unitSet = UnitSet(unitIds)
+            desc = unitSet.serialize()
+            copy = UnitSet.deserialize(desc)
+            assert copy == unitSet
+            assert list(copy) == sorted(unitIds)
+            assert len(copy) == len(unitIds)
+
+    def test_encodings(self):
+        assert UnitSet(units(0, [3, 100000])).serialize() \
+            .startswith("0:" + RLE_PREFIX)
+        assert UnitSet(units(0, range(1000))).serialize() \
+            .startswith("0:" + RLE_PREFIX)
+        # The old form, a hex bitmap, is still used when it's shortest.
+        assert UnitSet(units(0, [0, 2, 5])).serialize() == "0:25"
+        assert UnitSet.deserialize("1:25") == UnitSet(units(1, [0, 2, 5]))
+
+    def test_runs(self):
+        # Runs starting and ending inside bytes, within one byte, and
+        # spanning several.
+        desc = "0:{}3.2.1.1.2.1b.64.0".format(RLE_PREFIX)
+        expected = [3, 4, 6] + list(range(9, 9 + 0x1b))
+        assert list(UnitSet.deserialize(desc)) == units(0, expected)
+        assert len(UnitSet.deserialize("0:{}0.{:x}".format(RLE_PREFIX,
+                                                            MAX_SUB_ID))) \
+            == MAX_SUB_ID
+
+    def test_badInput(self):
+        tooBig = "0:{}{:x}.1".format(RLE_PREFIX, MAX_SUB_ID)
+        with pytest.raises(ValueError):
+            UnitSet.deserialize(tooBig)
+        with pytest.raises(ValueError):
+            UnitSet.deserialize("0:" + RLE_PREFIX + "1")
+        with pytest.raises(ValueError):
+            UnitSet.deserialize("0:-5")
+
+    def test_algebra(self):
+        first  = UnitSet(units(0, [1, 2, 3]) + units(1, [7]))
+        second = UnitSet(units(0, [3, 4]) + units(2, [9]))
+        assert list(first | second) == \
+            units(0, [1, 2, 3, 4]) + units(1, [7]) + units(2, [9])
+        assert list(first & second) == units(0, [3])
+        assert list(first - second) == units(0, [1, 2]) + units(1, [7])
+        assert (first & UnitSet(units(1, [8]))).playerIds == []
+        assert list(first.forPlayer(0)) == units(0, [1, 2, 3])
+        assert first.playerIds == [0, 1]
+
+    def test_addRemove(self):
+        unitSet = UnitSet()
+        assert not unitSet
+        unitSet.add(UnitId(2, 70))
+        assert UnitId(2, 70) in unitSet
+        assert UnitId(2, 71) not in unitSet
+        unitSet.remove(UnitId(2, 70))
+        assert not unitSet
+        assert unitSet.serialize() == "0:0"
@@ -0,0 +1,420 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from src.server.networking import ConnectionManager, frameString, \
+    KEYFRAME_INTERVAL
+from src.shared.game_state import GameState
+from src.shared.geometry import Coord, Distance, Rect
+from src.shared.ident import UnitId
+from src.shared.message_infrastructure import deserializeMessage
+from src.shared import messages
+
+
+class TestBroadcast:
+    """
+    Make sure broadcasts reach every client, in order, and that each client
+    gets exactly the bytes that a plain sendString would have written.
+    """
+
+    def test_framing(self):
+        connections, transports = makeConnections(1)
+        message = messages.YourIdIs(7)
+        connections.broadcastMessage(message)
+
+        expected = StringTransport()
+        connections.connections[0].transport = expected
+        connections.connections[0].sendMessage(message)
+        assert transports[0].value() == expected.value()
+        assert frameString(message.serialize()) == expected.value()
+
+    def test_batching(self):
+        connections, transports = makeConnections(3)
+
+        connections.startBatch()
+        connections.broadcastMessage(messages.YourIdIs(1))
+        connections.broadcastMessage(messages.Tick())
+        for transport in transports:
+            assert transport.value() == ""
+
+        connections.flushBatch()
+        expected = frameString(messages.YourIdIs(1).serialize()) + \
+            frameString(messages.Tick().serialize())
+        for transport in transports:
+            assert transport.value() == expected
+
+    def test_unicastInBatch(self):
+        connections, transports = makeConnections(2)
+        for connection in connections:
+            connection.transport = CountingTransport()
+        transports = [connection.transport for connection in connections]
+
+        connections.startBatch()
+        connections.broadcastMessage(messages.Tick())
+        connections.sendMessage(1, messages.ResourceAmt(5))
+        connections.broadcastMessage(messages.Tick())
+        connections.sendMessage(1, messages.ResourceAmt(6))
+        connections.flushBatch()
+
+        # Messages to one player are sent in order with the broadcasts, but
+        # still as part of the one write per batch.
+        tick = frameString(messages.Tick().serialize())
+        amount5 = frameString(messages.ResourceAmt(5).serialize())
+        amount6 = frameString(messages.ResourceAmt(6).serialize())
+        assert transports[0].value() == tick + tick
+        assert transports[1].value() == tick + amount5 + tick + amount6
+        assert [transport.writes for transport in transports] == [1, 1]
+
+        # Even with nothing else in the batch.
+        connections.startBatch()
+        connections.sendMessage(0, messages.ResourceAmt(5))
+        connections.flushBatch()
+        assert transports[0].value() == tick + tick + amount5
+        assert transports[0].writes == 2
+
+    def test_sortedRegistry(self):
+        connections, _ = makeConnections(4)
+        ids = [connection.playerId for connection in connections]
+        assert ids == [0, 1, 2, 3]
+
+        connections.removeConnection(connections.connections[2])
+        ids = [connection.playerId for connection in connections]
+        assert ids == [0, 1, 3]
+
+        connections.newConnection()
+        ids = [connection.playerId for connection in connections]
+        assert ids == [0, 1, 3, 4]
+
+
+def makeConnections(count):
+    connections = ConnectionManager()
+    connections.setGameStateManager(DummyGameStateManager())
+    transports = []
+    for _ in range(count):
+        connection = connections.newConnection()
+        connection.transport = StringTransport()
+        transports.append(connection.transport)
+    return (connections, transports)
+
+class CountingTransport(StringTransport):
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+class DummyGameStateManager(object):
+    def __init__(self):
+        self.gameState = GameState()
+
+    def removePlayer(self, playerId):
+        pass
+
+
+class TestUnitUpdates:
+    """
+    Make sure small moves are sent as deltas against what each client was
+    last sent, and everything else as absolute positions.
+    """
+
+    def test_deltas(self):
+        connections, transports = makeConnections(2)
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((100, 100)))
+        connections.unitCreated(unitId)
+
+        # A client that joins now has never been sent the unit's position.
+        newConnection = connections.newConnection()
+        newConnection.transport = StringTransport()
+        transports.append(newConnection.transport)
+        for transport in transports:
+            transport.clear()
+
+        connections.unitBatchCount = firstNonKeyframe(unitId)
+        dest = Coord.fromUnit((103, 98))
+        gameState.moveUnitTo(unitId, dest)
+        connections.unitMoved(unitId)
+
+        delta = frameString(messages.PosDeltas(
+            [(unitId, Distance.fromUnit((3, -2)))]
+        ).serialize())
+        absolute = frameString(messages.NewObelisk(unitId, dest).serialize())
+        assert transports[0].value() == delta
+        assert transports[1].value() == delta
+        assert transports[2].value() == absolute
+
+    def test_bigMove(self):
+        connections, transports = makeConnections(1)
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        transports[0].clear()
+
+        connections.unitBatchCount = firstNonKeyframe(unitId)
+        dest = Coord.fromUnit((messages.MAX_POS_DELTA + 1, 0))
+        gameState.moveUnitTo(unitId, dest)
+        connections.unitMoved(unitId)
+        assert transports[0].value() == \
+            frameString(messages.SetPos(unitId, dest).serialize())
+
+    def test_unicastAmongUpdates(self):
+        connections, transports = makeConnections(2)
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        for transport in transports:
+            transport.clear()
+
+        connections.unitBatchCount = firstNonKeyframe(unitId)
+        connections.startBatch()
+        connections.broadcastMessage(messages.Tick())
+        gameState.moveUnitTo(unitId, Coord.fromUnit((1, 0)))
+        connections.unitMoved(unitId)
+        connections.sendMessage(0, messages.ResourceAmt(5))
+        connections.flushBatch()
+
+        tick = frameString(messages.Tick().serialize())
+        delta = frameString(messages.PosDeltas(
+            [(unitId, Distance.fromUnit((1, 0)))]
+        ).serialize())
+        amount = frameString(messages.ResourceAmt(5).serialize())
+        assert transports[0].value() == tick + delta + amount
+        assert transports[1].value() == tick + delta
+
+    def test_deleted(self):
+        connections, transports = makeConnections(1)
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        transports[0].clear()
+
+        # Moving and then deleting a unit in the same batch should only send
+        # the deletion.
+        connections.startBatch()
+        gameState.moveUnitTo(unitId, Coord.fromUnit((1, 1)))
+        connections.unitMoved(unitId)
+        gameState.removeUnit(unitId)
+        connections.unitDeleted(unitId)
+        connections.flushBatch()
+        assert transports[0].value() == \
+            frameString(messages.DeleteObelisk(unitId).serialize())
+        assert unitId not in connections.connections[0].knownPositions
+
+    def test_interest(self):
+        connections, transports = makeConnections(2)
+        gameState = connections.gameStateManager.gameState
+        farAway = Coord.fromCBU(chunk=(50, 50))
+        unitId  = gameState.addUnit(0, 0, farAway)
+        connections.unitCreated(unitId)
+        for transport in transports:
+            transport.clear()
+
+        # Player 1 looks at the origin, so the unit leaves their view.
+        viewport = Rect(Coord.fromUnit((0, 0)),
+                        Distance.fromCBU(chunk=(2, 2)))
+        connections.setViewport(1, viewport)
+        connections.startBatch()
+        connections.flushBatch()
+        assert transports[0].value() == ""
+        assert transports[1].value() == \
+            frameString(messages.DeleteObelisk(unitId).serialize())
+
+        # Moves outside the viewport aren't sent to player 1, but the owner
+        # always hears about their own units.
+        for transport in transports:
+            transport.clear()
+        gameState.moveUnitTo(unitId, farAway + Distance.fromUnit((1, 0)))
+        connections.unitMoved(unitId)
+        assert transports[0].value() != ""
+        assert transports[1].value() == ""
+
+        # Once the unit moves into view, player 1 is told about it again.
+        gameState.moveUnitTo(unitId, Coord.fromUnit((5, 5)))
+        connections.unitMoved(unitId)
+        assert transports[1].value() == frameString(
+            messages.NewObelisk(unitId, Coord.fromUnit((5, 5))).serialize()
+        )
+
+    def test_vision(self):
+        connections, transports = makeConnections(2)
+        gameState = connections.gameStateManager.gameState
+        viewport = Rect(Coord.fromUnit((0, 0)),
+                        Distance.fromCBU(chunk=(2, 2)))
+        connections.setViewport(1, viewport)
+
+        # Player 1's own unit, and player 0's unit next to it, both far from
+        # player 1's viewport.
+        ownUnit   = gameState.addUnit(1, 0, Coord.fromCBU(chunk=(50, 50)))
+        connections.unitCreated(ownUnit)
+        otherUnit = gameState.addUnit(0, 0, Coord.fromCBU(chunk=(51, 50)))
+        connections.unitCreated(otherUnit)
+        # And one that has nothing to do with any of this.
+        bystander = gameState.addUnit(0, 0, Coord.fromCBU(chunk=(20, 20)))
+        connections.unitCreated(bystander)
+        assert set(connections.connections[1].knownPositions) == \
+            set([ownUnit, otherUnit])
+        transports[1].clear()
+
+        # Once player 1's unit moves away, the other one is out of sight.
+        # Only the units in the chunks that entered or left sight are looked
+        # at.
+        checked = []
+        unitsInChunks = connections.interest.unitsInChunks
+        def spy(chunks):
+            units = unitsInChunks(chunks)
+            checked.extend(units)
+            return units
+        connections.interest.unitsInChunks = spy
+        gameState.moveUnitTo(ownUnit, Coord.fromCBU(chunk=(48, 50)))
+        connections.unitMoved(ownUnit)
+        assert bystander not in checked
+        assert otherUnit in checked
+        assert connections.connections[1].knownPositions.keys() == \
+            [ownUnit]
+        assert frameString(messages.DeleteObelisk(otherUnit).serialize()) \
+            in transports[1].value()
+
+    def test_deltaRoundTrip(self):
+        deltas = [(UnitId(0, 17), Distance.fromUnit((-7, 7))),
+                  (UnitId(3, 0), Distance.fromUnit((0, -1)))]
+        data = messages.PosDeltas(deltas).serialize()
+        newMsg = deserializeMessage(data)
+        assert [(uid, delta.unit) for uid, delta in newMsg.deltas] == \
+            [(uid, delta.unit) for uid, delta in deltas]
+
+
+def firstNonKeyframe(unitId):
+    """
+    Return a positionBatchCount such that the next batch won't send a
+    keyframe for unitId.
+    """
+
+    count = 0
+    while (count + 1 + hash(unitId)) % KEYFRAME_INTERVAL == 0:
+        count += 1
+    return count
+
+
+class TestBackpressure:
+    """
+    Make sure a connection whose transport is full has its messages held
+    back and its unit updates coalesced, and is resynced if it falls too far
+    behind.
+    """
+
+    def test_queued(self):
+        connections, transports = makeConnections(1)
+        connection = connections.connections[0]
+        connection.pauseProducing()
+
+        connections.broadcastMessage(messages.Tick(), supersedable=True)
+        connections.sendMessage(0, messages.YourIdIs(0))
+        assert transports[0].value() == ""
+
+        connection.resumeProducing()
+        assert transports[0].value() == \
+            frameString(messages.Tick().serialize()) + \
+            frameString(messages.YourIdIs(0).serialize())
+
+    def test_coalesced(self):
+        connections, transports = makeConnections(1)
+        connection = connections.connections[0]
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        transports[0].clear()
+
+        connection.pauseProducing()
+        for x in range(1, 4):
+            gameState.moveUnitTo(unitId, Coord.fromUnit((x, 0)))
+            connections.unitMoved(unitId)
+        assert transports[0].value() == ""
+
+        # Only the latest position should be sent.
+        connections.unitBatchCount = firstNonKeyframe(unitId)
+        connection.resumeProducing()
+        assert transports[0].value() == frameString(messages.PosDeltas(
+            [(unitId, Distance.fromUnit((3, 0)))]
+        ).serialize())
+
+    def test_resync(self):
+        connections, transports = makeConnections(1)
+        connections.clock = Clock()
+        connection = connections.connections[0]
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        transports[0].clear()
+
+        connection.pauseProducing()
+        connections.sendMessage(0, messages.YourIdIs(0))
+        connections.broadcastMessage(messages.Tick(), supersedable=True)
+        connections.clock.advance(connections.maxLag + 1)
+        connections.broadcastMessage(messages.Tick(), supersedable=True)
+        gameState.resources[0] = 5
+
+        # The ticks are dropped, but not the message that wasn't
+        # supersedable, and the client is sent its current state instead.
+        connection.resumeProducing()
+        assert transports[0].value() == \
+            frameString(messages.YourIdIs(0).serialize()) + \
+            frameString(messages.ResourceAmt(5).serialize()) + \
+            frameString(messages.SetPos(unitId,
+                                        Coord.fromUnit((0, 0))).serialize())
+        assert not connection.needsResync
+
+    def test_catchUpBeforeTicks(self):
+        connections, transports = makeConnections(1)
+        connection = connections.connections[0]
+        gameState = connections.gameStateManager.gameState
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        transports[0].clear()
+
+        # Two ticks, in each of which the unit moves.
+        connection.pauseProducing()
+        for x in range(1, 3):
+            connections.startBatch()
+            gameState.moveUnitTo(unitId, Coord.fromUnit((x, 0)))
+            connections.unitMoved(unitId)
+            connections.broadcastMessage(messages.Tick(), supersedable=True)
+            connections.flushBatch()
+
+        # The moves go where the first of them would have.
+        connections.unitBatchCount = firstNonKeyframe(unitId)
+        connection.resumeProducing()
+        tick = frameString(messages.Tick().serialize())
+        assert transports[0].value() == frameString(messages.PosDeltas(
+            [(unitId, Distance.fromUnit((2, 0)))]
+        ).serialize()) + tick + tick
+
+    def test_abandoned(self):
+        connections, transports = makeConnections(1)
+        connections.clock = Clock()
+        connection = connections.connections[0]
+
+        # Messages that a resync doesn't cover (like lockstep ticks) keep
+        # being queued, but only up to a point.
+        connection.pauseProducing()
+        for _ in range(connections.maxQueued):
+            connections.broadcastMessage(messages.Tick())
+        assert not connection.abandoned
+        connections.broadcastMessage(messages.Tick())
+        assert connection.needsResync
+        assert connection.abandoned
+        assert transports[0].disconnecting
+        assert len(connection.outboundQueue) == 0
+
+        connections.broadcastMessage(messages.Tick())
+        assert len(connection.outboundQueue) == 0
+
+        # Likewise for one that's been stalled too long.
+        connection = connections.newConnection()
+        connection.transport = StringTransport()
+        connection.pauseProducing()
+        connections.sendMessage(connection.playerId, messages.Tick())
+        connections.clock.advance(connections.maxStall + 1)
+        assert not connection.abandoned
+        connections.sendMessage(connection.playerId, messages.Tick())
+        assert connection.abandoned
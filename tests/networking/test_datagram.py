@@ -0,0 +1,319 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from src.client.backend import Backend
+from src.client.bot import Bot, NoStdio
+from src.client.networking import DatagramNetworkConnection
+
+from src.server.networking import ConnectionManager, DatagramConnection, \
+    DatagramServer, frameString, COOKIE_LIFETIME
+from src.shared.datagram import ReliableChannel, encodePacket, \
+    decodePacket, frameData, splitFrames, KIND_HELLO, KIND_RELIABLE, \
+    KIND_UNRELIABLE, KIND_ACK, KIND_UNRELIABLE_ACK, KIND_CHALLENGE, \
+    COOKIE_SIZE, MAX_PAYLOAD_SIZE, RESEND_INTERVAL
+from src.shared.game_state import GameState
+from src.shared.geometry import Coord
+from src.shared import messages
+
+
+class TestReliableChannel:
+    """
+    Make sure the reliable channel delivers everything exactly once and in
+    order, despite loss and reordering.
+    """
+
+    def test_reordering(self):
+        clock = Clock()
+        sent = []
+        delivered = []
+        sender = ReliableChannel(
+            lambda kind, seq, payload: sent.append((seq, payload)),
+            None, clock
+        )
+        acks = []
+        receiver = ReliableChannel(
+            lambda kind, seq, payload: acks.append(seq),
+            delivered.append, clock
+        )
+
+        for data in ["a", "b", "c"]:
+            sender.send(frameData(data))
+        for seq, payload in reversed(sent):
+            receiver.packetReceived(seq, payload)
+        # A duplicate should be acked but not delivered again.
+        receiver.packetReceived(*sent[0])
+
+        assert delivered == ["a", "b", "c"]
+        assert acks == [0, 0, 3, 3]
+
+        sender.handleAck(3)
+        assert sender.unacked == {}
+        assert sender.unackedBytes == 0
+
+    def test_fragmentation(self):
+        clock = Clock()
+        sent = []
+        delivered = []
+        sender = ReliableChannel(
+            lambda kind, seq, payload: sent.append((seq, payload)),
+            None, clock
+        )
+        receiver = ReliableChannel(lambda kind, seq, payload: None,
+                                   delivered.append, clock)
+
+        # Bigger than fits in a datagram, let alone a payload.
+        big = "".join(chr(i % 256) for i in xrange(2**16 - 1))
+        sender.send(frameData(big) + frameData("a"))
+        sender.send(frameData("b"))
+        assert all(len(payload) <= MAX_PAYLOAD_SIZE for _, payload in sent)
+
+        for seq, payload in sent[:-2]:
+            receiver.packetReceived(seq, payload)
+        assert delivered == []
+        for seq, payload in sent[-2:]:
+            receiver.packetReceived(seq, payload)
+        assert delivered == [big, "a", "b"]
+
+    def test_resend(self):
+        clock = Clock()
+        sent = []
+        sender = ReliableChannel(
+            lambda kind, seq, payload: sent.append((kind, seq, payload)),
+            None, clock
+        )
+
+        sender.send("a")
+        sender.resendDue()
+        assert len(sent) == 1
+
+        clock.advance(RESEND_INTERVAL)
+        sender.resendDue()
+        assert sent == [(KIND_RELIABLE, 0, "a")] * 2
+
+        sender.handleAck(1)
+        clock.advance(RESEND_INTERVAL)
+        sender.resendDue()
+        assert len(sent) == 2
+
+
+class TestDatagramConnection:
+    """
+    Make sure a DatagramConnection sends unit creation reliably and positions
+    unreliably, resending positions until they're acknowledged.
+    """
+
+    def test_positions(self):
+        connections, connection, server = makeDatagramConnection()
+        gameState = connections.gameStateManager.gameState
+
+        start = Coord.fromUnit((0, 0))
+        unitId = gameState.addUnit(0, 0, start)
+        connections.unitCreated(unitId)
+        # The new unit's position is also sent unreliably, so that it's
+        # newer than any sent before (had the unit been seen before).
+        assert server.take() == [
+            (KIND_RELIABLE, 0,
+             [messages.NewObelisk(unitId, start).serialize()]),
+            (KIND_UNRELIABLE, 0, [messages.SetPos(unitId, start).serialize()]),
+        ]
+
+        dest = Coord.fromUnit((2, 0))
+        gameState.moveUnitTo(unitId, dest)
+        connections.unitMoved(unitId)
+        setPos = [messages.SetPos(unitId, dest).serialize()]
+        assert server.take() == [(KIND_UNRELIABLE, 1, setPos)]
+
+        # If the client doesn't ack it, it's sent again.
+        clock = connections.clock
+        clock.advance(RESEND_INTERVAL)
+        packets = server.take()
+        assert (KIND_UNRELIABLE, 2, setPos) in packets
+
+        # Once the client acks it, it isn't.
+        connection.packetReceived(KIND_ACK, 1, "")
+        connection.packetReceived(KIND_UNRELIABLE_ACK, 2, "")
+        clock.advance(RESEND_INTERVAL)
+        assert server.take() == []
+
+    def test_recreated(self):
+        # A unit leaves the client's view and comes back, and an old
+        # position from before it left turns up late. The client should still
+        # end up with its current position.
+        connections, connection, server = makeDatagramConnection()
+        gameState = connections.gameStateManager.gameState
+        client, backend = makeDatagramClient(connection)
+
+        unitId = gameState.addUnit(1, 0, Coord.fromUnit((0, 0)))
+        connections.unitCreated(unitId)
+        deliver(client, server.packets)
+
+        # This position is held up on the way.
+        gameState.moveUnitTo(unitId, Coord.fromUnit((2, 0)))
+        connections.unitMoved(unitId)
+        [stale] = server.packets
+        server.packets = []
+
+        gameState.removeUnit(unitId)
+        connections.unitDeleted(unitId)
+        deliver(client, server.packets)
+        assert unitId not in backend.gameState.positions
+        assert unitId not in client.positionSeqs
+
+        pos = Coord.fromUnit((5, 0))
+        gameState.insertUnit(unitId, 0, pos)
+        connections.unitCreated(unitId)
+        [reliable] = [packet for packet in server.packets
+                      if packet[0] == KIND_RELIABLE]
+        server.packets = []
+        deliver(client, [reliable, stale])
+        # The late position was applied, but the server is still waiting for
+        # the client to ack the current one, and resends it until it does.
+        assert backend.gameState.positions[unitId] != pos
+        connections.clock.advance(RESEND_INTERVAL)
+        deliver(client, server.packets)
+        assert backend.gameState.positions[unitId] == pos
+        assert connection.pendingPositions == {}
+
+        # If the current one arrives first, the old one is ignored.
+        gameState.removeUnit(unitId)
+        connections.unitDeleted(unitId)
+        gameState.insertUnit(unitId, 0, Coord.fromUnit((6, 0)))
+        connections.unitCreated(unitId)
+        deliver(client, server.packets)
+        deliver(client, [stale])
+        assert backend.gameState.positions[unitId] == \
+            Coord.fromUnit((6, 0))
+
+    def test_received(self):
+        connections, connection, _ = makeDatagramConnection()
+        received = connections.clientInterfacer.received
+
+        connection.packetReceived(KIND_RELIABLE, 1, frameString("b"))
+        assert received == []
+        connection.packetReceived(KIND_RELIABLE, 0, frameString("a"))
+        assert received == ["a", "b"]
+
+
+class TestDatagramServer:
+    """
+    Make sure the server doesn't set up a connection (or send more than it
+    received) for a HELLO until the client has echoed its cookie.
+    """
+
+    def test_cookie(self):
+        connections = ConnectionManager(clock=Clock())
+        connections.setGameStateManager(DummyGameStateManager())
+        connections.setClientInterfacer(DummyClientInterfacer())
+        server = DatagramServer(connections)
+        server.transport = DummyUDPTransport()
+        address = ("127.0.0.1", 1234)
+
+        # Too short to answer.
+        server.datagramReceived(encodePacket(KIND_HELLO, 0, ""), address)
+        assert server.transport.take() == []
+
+        hello = encodePacket(KIND_HELLO, 0, "\0" * COOKIE_SIZE)
+        server.datagramReceived(hello, address)
+        [(packet, to)] = server.transport.take()
+        assert to == address
+        assert len(packet) <= len(hello)
+        kind, _, cookie = decodePacket(packet)
+        assert kind == KIND_CHALLENGE
+        assert server.connectionsByAddress == {}
+
+        # The cookie is no good from another address.
+        otherAddress = ("127.0.0.1", 1235)
+        server.datagramReceived(encodePacket(KIND_HELLO, 0, cookie),
+                                otherAddress)
+        assert server.connectionsByAddress == {}
+
+        # It is from the right one, a while later.
+        connections.clock.advance(COOKIE_LIFETIME)
+        server.datagramReceived(encodePacket(KIND_HELLO, 0, cookie), address)
+        assert server.connectionsByAddress.keys() == [address]
+
+
+def makeDatagramConnection():
+    connections = ConnectionManager(clock=Clock())
+    connections.setGameStateManager(DummyGameStateManager())
+    connections.setClientInterfacer(DummyClientInterfacer())
+    server = DummyDatagramServer()
+    connection = connections.newConnection(DatagramConnection, server,
+                                           ("127.0.0.1", 1234))
+    connection.scheduleTimer()
+    return (connections, connection, server)
+
+def makeDatagramClient(connection):
+    # Return a client-side DatagramNetworkConnection, with a backend, whose
+    # packets go straight to connection.
+    backend = Backend(Deferred())
+    NoStdio(backend)
+    Bot(backend, seed=0)
+    client = DatagramNetworkConnection(backend, "127.0.0.1", 1234, Clock())
+    client.transport = ClientUDPTransport(connection)
+    return (client, backend)
+
+def deliver(client, packets):
+    # Pass packets the server sent, as recorded by a DummyDatagramServer, to
+    # the client.
+    for kind, seq, payload in packets:
+        if kind != KIND_ACK:
+            client.datagramReceived(encodePacket(kind, seq, payload),
+                                    ("127.0.0.1", 16097))
+    del packets[:]
+
+class ClientUDPTransport(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, packet):
+        self.connection.packetReceived(*decodePacket(packet))
+
+class DummyGameStateManager(object):
+    def __init__(self):
+        self.gameState = GameState()
+
+    def removePlayer(self, playerId):
+        pass
+
+class DummyClientInterfacer(object):
+    def __init__(self):
+        self.received = []
+
+    def stringReceived(self, playerId, data):
+        self.received.append(data)
+
+    def handshake(self, playerId):
+        pass
+
+class DummyDatagramServer(object):
+    def __init__(self):
+        self.packets = []
+
+    def sendPacket(self, address, kind, seq, payload):
+        # Check that the packet survives encoding.
+        self.packets.append(decodePacket(encodePacket(kind, seq, payload)))
+
+    def take(self):
+        # Return the packets sent since the last call (other than acks), with
+        # their payloads split into messages.
+        packets = [(kind, seq, splitFrames(payload))
+                   for kind, seq, payload in self.packets
+                   if kind != KIND_ACK]
+        self.packets = []
+        return packets
+
+    def forgetConnection(self, connection):
+        pass
+
+class DummyUDPTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, packet, address):
+        self.written.append((packet, address))
+
+    def take(self):
+        written = self.written
+        self.written = []
+        return written
@@ -0,0 +1,81 @@
+from collections import Counter as TypeCounter
+
+from src.server.headless import HeadlessSimulation, MemoryConnection
+from src.server.metrics import Counter, MetricsRegistry, \
+    registerServerMetrics
+from src.server.tick_scheduler import TickScheduler
+from src.shared.datagram import splitFrames
+from src.shared.message_infrastructure import TOKEN_DELIM
+
+
+class TestMetrics:
+    """
+    Make sure the metrics are rendered in the Prometheus text format, and
+    that the server actually counts things.
+    """
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        plain = registry.register(Counter("plain_total", "A\ncounter."))
+        plain.inc(3)
+        labelled = registry.register(Counter("labelled_total", "Another.",
+                                             labelName="type"))
+        labelled.inc(label="b")
+        labelled.inc(2, label='a"')
+
+        assert registry.render() == (
+            "# HELP plain_total A\\ncounter.\n"
+            "# TYPE plain_total counter\n"
+            "plain_total 3\n"
+            "# HELP labelled_total Another.\n"
+            "# TYPE labelled_total counter\n"
+            'labelled_total{type="a\\""} 2\n'
+            'labelled_total{type="b"} 1\n'
+        )
+
+    def test_server(self):
+        simulation = HeadlessSimulation(numPlayers=2, unitsPerPlayer=5,
+                                        seed=0)
+        simulation.run(10)
+
+        registry = MetricsRegistry()
+        scheduler = TickScheduler(simulation.backend.tick, 0.1,
+                                  clock=simulation.clock)
+        registerServerMetrics(registry, simulation.gameStateManager,
+                              simulation.connections,
+                              simulation.clientInterfacer, scheduler)
+        lines = registry.render().splitlines()
+
+        assert "warts_connected_players 2" in lines
+        assert "warts_units 10" in lines
+        assert 'warts_messages_received_total{type="order_new"} 10' in lines
+        assert any(line.startswith('warts_messages_sent_total{type="tick"}')
+                   for line in lines)
+        sent = sum(int(line.split()[-1]) for line in lines
+                   if line.startswith("warts_bytes_sent_total{"))
+        assert sent == simulation.bytesSent
+        assert 'warts_tick_duration_seconds_count 10' in lines
+
+    def test_messageTypes(self, monkeypatch):
+        # Count the messages actually written, by type, to check the counts
+        # made as they're framed.
+        written = TypeCounter()
+        def writeToTransport(connection, data):
+            for message in splitFrames(data):
+                written[message.split(TOKEN_DELIM, 1)[0]] += 1
+        monkeypatch.setattr(MemoryConnection, "writeToTransport",
+                            writeToTransport)
+
+        simulation = HeadlessSimulation(numPlayers=3, unitsPerPlayer=5,
+                                        seed=0)
+        simulation.run(10)
+        # Let the maps finish streaming, since those are counted up front.
+        for _ in range(1000):
+            if all(connection.stream is None
+                   for connection in simulation.connections):
+                break
+            simulation.tick()
+
+        counted = simulation.connections.messagesSent.values
+        assert dict((command, count) for command, count in counted.items()
+                    if count) == dict(written)
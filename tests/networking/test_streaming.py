@@ -0,0 +1,69 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from src.server.networking import ConnectionManager, NetworkConnection, \
+    StreamingProducer, MAX_MESSAGES_PER_BURST, frameString
+
+
+class TestStreaming:
+    """
+    Make sure a StreamingProducer sends everything, in order, a burst at a
+    time, and respects pauses from the transport.
+    """
+
+    def test_allSent(self):
+        connection, transport = makeConnection()
+        clock = Clock()
+        dataList = ["part{}".format(i) for i in range(10)]
+        finished = []
+
+        producer = StreamingProducer(connection, dataList, clock=clock,
+                                     onDone=lambda: finished.append(True))
+        producer.start()
+        assert connection.stream is producer
+        assert transport.value() == ""
+
+        # Each burst should send at most MAX_MESSAGES_PER_BURST messages, and
+        # schedule the next one for a later reactor iteration.
+        assert len(clock.getDelayedCalls()) == 1
+        producer.cancelBurst()
+        producer.produceBurst()
+        assert transport.value() == \
+            "".join(map(frameString, dataList[:MAX_MESSAGES_PER_BURST]))
+        assert len(clock.getDelayedCalls()) == 1
+
+        clock.advance(0)
+        assert finished
+        assert transport.value() == "".join(map(frameString, dataList))
+        assert connection.stream is None
+
+    def test_pause(self):
+        connection, transport = makeConnection()
+        clock = Clock()
+        dataList = ["part{}".format(i) for i in range(10)]
+
+        producer = StreamingProducer(connection, dataList, clock=clock)
+        producer.start()
+        producer.pauseProducing()
+        clock.advance(0)
+        assert transport.value() == ""
+
+        producer.resumeProducing()
+        clock.advance(0)
+        assert transport.value() != ""
+
+    def test_stop(self):
+        connection, transport = makeConnection()
+        clock = Clock()
+
+        producer = StreamingProducer(connection, ["a", "b"], clock=clock)
+        producer.start()
+        producer.stopProducing()
+        clock.advance(0)
+        assert transport.value() == ""
+
+
+def makeConnection():
+    connection = NetworkConnection(0, None, ConnectionManager())
+    connection.transport = StringTransport()
+    return (connection, connection.transport)
@@ -0,0 +1,91 @@
+from src.server import client_interfacer
+from src.server.headless import HeadlessSimulation
+from src.shared.geometry import Coord
+from src.shared import messages
+from src.shared.unit_set import UnitSet
+
+
+class TestAdmission:
+    """
+    Make sure clients are charged for the work their messages cause, and
+    that messages over a client's share are delayed rather than dropped.
+    """
+
+    def test_expensive_orders(self):
+        simulation = HeadlessSimulation(numPlayers=2, unitsPerPlayer=10,
+                                        seed=0)
+        simulation.run(2)
+        interfacer = simulation.clientInterfacer
+        gameState = simulation.gameStateManager.gameState
+        greedy, modest = simulation.clients
+
+        greedyUnits = UnitSet(gameState.getAllUnitsForPlayer(greedy.playerId))
+        modestUnits = UnitSet(gameState.getAllUnitsForPlayer(modest.playerId))
+        assert len(greedyUnits) == 10
+
+        # Enough path searches across the map to use up several ticks' worth
+        # of the greedy player's share.
+        for _ in range(40):
+            dest = simulation.randomPassablePos()
+            greedy.sendToServer(messages.OrderMove(greedyUnits, dest))
+        assert interfacer.workAllowances[greedy.playerId] <= 0
+        queued = len(interfacer.queuedMessages[greedy.playerId])
+        assert queued > 0
+        assert interfacer.rateLimited.values[None] == 0
+
+        # The other player isn't held up.
+        modest.sendToServer(messages.OrderMove(modestUnits,
+                                               Coord.fromUnit((0, 0))))
+        assert modest.playerId not in interfacer.queuedMessages
+
+        # The greedy player's orders are all handled eventually.
+        for _ in range(100):
+            simulation.tick()
+            if greedy.playerId not in interfacer.queuedMessages:
+                break
+        assert greedy.playerId not in interfacer.queuedMessages
+        assert interfacer.messagesDelayed.values[None] >= queued
+        # Once they've gone quiet, they stop counting towards the shares.
+        for _ in range(client_interfacer.BURST_TICKS + 1):
+            simulation.tick()
+        assert not interfacer.workAllowances
+
+    def test_split_orders(self, monkeypatch):
+        simulation = HeadlessSimulation(numPlayers=1, unitsPerPlayer=10,
+                                        seed=0)
+        simulation.run(2)
+        # Make each unit cost more than a tick's worth, so that an order for
+        # all of a player's units has to be spread over several ticks.
+        monkeypatch.setattr(client_interfacer, "WORK_PER_UNIT",
+                            client_interfacer.TICK_WORK_BUDGET)
+        interfacer = simulation.clientInterfacer
+        manager = simulation.gameStateManager
+        client, = simulation.clients
+        units = UnitSet(manager.gameState.getAllUnitsForPlayer(
+            client.playerId
+        ))
+
+        dest = Coord.fromUnit((0, 0))
+        ordered = []
+        orderReceived = manager.orderReceived
+        def spy(playerId, message):
+            if isinstance(message, messages.OrderMove) and \
+                    message.dest == dest:
+                ordered.append(message.unitSet)
+            return orderReceived(playerId, message)
+        monkeypatch.setattr(manager, "orderReceived", spy)
+
+        # At most part of the order is applied right away.
+        client.sendToServer(messages.OrderMove(units, dest))
+        assert sum(len(part) for part in ordered) < len(units)
+        assert client.playerId in interfacer.queuedMessages
+
+        # The rest is applied over the next few ticks, a part at a time.
+        for _ in range(100):
+            simulation.tick()
+            if client.playerId not in interfacer.queuedMessages:
+                break
+        assert client.playerId not in interfacer.queuedMessages
+        assert len(ordered) > 2
+        assert reduce(UnitSet.union, ordered) == units
+        assert sum(len(part) for part in ordered) == len(units)
@@ -0,0 +1,56 @@
+from twisted.internet.defer import Deferred
+
+from src.client.backend import Backend
+from src.client.bot import Bot, NoStdio, TARGET_UNITS
+from src.server.headless import HeadlessSimulation, MemoryConnection
+from src.shared.datagram import splitFrames
+
+
+class LinkedNetwork(object):
+    """
+    Stands in for a client's connection to the server, passing everything
+    straight to a MemoryConnection on a headless server.
+    """
+
+    def __init__(self, backend, connection):
+        self.backend    = backend
+        self.connection = connection
+
+    def backendMessage(self, data, traceId=None):
+        self.connection.messageReceived(data)
+        self.backend.traceReached(traceId, "send")
+
+    def cleanup(self):
+        pass
+
+
+class TestBot:
+    """
+    Make sure a bot can play a game without any graphics.
+    """
+
+    def test_play(self):
+        simulation = HeadlessSimulation(numPlayers=0)
+        backend = Backend(Deferred())
+        NoStdio(backend)
+        bot = Bot(backend, seed=0)
+
+        connection = simulation.connections.newConnection(MemoryConnection)
+        def deliver(data):
+            for message in splitFrames(data):
+                backend.networkMessage(message)
+        connection.writeToTransport = deliver
+        backend.networkReady(LinkedNetwork(backend, connection))
+        connection.connectionMade()
+
+        for _ in range(200):
+            bot.act()
+            simulation.tick()
+
+        assert bot.ready
+        assert len(bot.myUnits()) >= TARGET_UNITS - 1
+        assert bot.actionCounts["move"] > 0
+        assert bot.ticksSeen > 0
+        # Every spawn gets a response, and so do most moves.
+        assert bot.tracer.finished >= bot.actionCounts["spawn"]
+        assert bot.tracer.histograms["send->receive"].count > 0
@@ -0,0 +1,34 @@
+from src.server.headless import HeadlessSimulation
+
+from tests.simulation.test_replay import recordGame
+
+
+class TestHeadless:
+    """
+    Make sure the headless harness runs a whole server with simulated
+    clients.
+    """
+
+    def test_random(self):
+        simulation = HeadlessSimulation(numPlayers=3, unitsPerPlayer=12,
+                                        seed=0)
+        simulation.run(20)
+
+        gameState = simulation.gameStateManager.gameState
+        assert len(gameState.positions) == 3 * 12
+        assert all(client.bytesSent > 0 for client in simulation.clients)
+
+        phases = dict(simulation.phaseAverages())
+        assert "tick.orders" in phases
+        assert "clientOrders" in phases
+
+    def test_script(self):
+        # Orders sent by the simulated clients from a replay log have the
+        # same effect as the originals.
+        original, replay = recordGame(lockstep=False)
+        simulation = HeadlessSimulation(script=replay)
+        simulation.run(replay.totalTicks)
+
+        gameState = simulation.gameStateManager.gameState
+        assert gameState.positions == original.gameState.positions
+        assert gameState.stateHash == replay.endHash
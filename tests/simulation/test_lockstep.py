@@ -0,0 +1,190 @@
+from twisted.internet.defer import Deferred
+
+from src.client.backend import Backend
+from src.client.bot import Bot, NoStdio
+from tests.simulation.test_bot import LinkedNetwork
+from src.server.game_state_manager import GameStateManager
+from src.server.headless import HeadlessSimulation, MemoryConnection
+from src.server.client_interfacer import MAX_SNAPSHOT_LENGTH
+from src.shared.game_state import GameState
+from src.shared.datagram import splitFrames
+from src.shared.geometry import Coord
+from src.shared.ident import UnitId
+from src.shared.message_infrastructure import deserializeMessage
+from src.shared import messages
+from src.shared.simulation import Simulation
+from src.shared.snapshot import MapContents, SimulationState
+from src.shared.unit_orders import MoveUnitOrder
+from src.shared.unit_set import UnitSet
+from src.shared.utils import integerSqrt, divideAndRound
+
+
+class TestLockstep:
+    """
+    Make sure a client running the simulation from the orders the server
+    relays ends up in exactly the same state as the server.
+    """
+
+    def test_clientsAgree(self):
+        server = GameStateManager(None, RecordingConnections(), lockstep=True)
+        server.orderReceived(0, messages.OrderNew(0, Coord.fromUnit((10, 0))))
+        server.orderReceived(1, messages.OrderNew(0, Coord.fromUnit((0, 10))))
+        server.tick()
+        server.orderReceived(0, messages.OrderMove(
+            UnitSet([UnitId(0, 0)]), Coord.fromCBU(chunk=(8, 4))
+        ))
+        server.tick()
+        server.tick()
+
+        # Join partway through, while a unit is following a path.
+        client = joinGame(server)
+        assert client.gameState.positions == server.gameState.positions
+
+        server.orderReceived(1, messages.OrderMove(
+            UnitSet([UnitId(1, 0)]), Coord.fromCBU(chunk=(6, 0))
+        ))
+        server.orderReceived(0, messages.OrderNew(0, Coord.fromUnit((5, 5))))
+        for _ in range(300):
+            server.tick()
+            relay(server, client)
+            assert client.gameState.positions == server.gameState.positions
+            assert client.gameState.resources == server.gameState.resources
+
+        # Both units should have gotten where they were going.
+        assert server.gameState.getPos(UnitId(0, 0)) == \
+            Coord.fromCBU(chunk=(8, 4))
+        assert server.gameState.getPos(UnitId(1, 0)) == \
+            Coord.fromCBU(chunk=(6, 0))
+
+    def test_removePlayer(self):
+        server = GameStateManager(None, RecordingConnections(), lockstep=True)
+        server.orderReceived(0, messages.OrderNew(0, Coord.fromUnit((10, 0))))
+        server.tick()
+        client = joinGame(server)
+
+        # The units of a player who leaves are deleted by a relayed order,
+        # not behind the other clients' backs.
+        server.removePlayer(0)
+        assert server.gameState.isUnitIdValid(UnitId(0, 0))
+        server.tick()
+        relay(server, client)
+        assert not server.gameState.isUnitIdValid(UnitId(0, 0))
+        assert not client.gameState.isUnitIdValid(UnitId(0, 0))
+
+    def test_largeSnapshot(self):
+        # Join a game with far too much going on (for some other player) to
+        # describe in a single message; the client should still end up with
+        # exactly the server's state.
+        simulation = HeadlessSimulation(lockstep=True, seed=0)
+        manager = simulation.gameStateManager
+        for subId in range(1500):
+            unitId = UnitId(5, subId)
+            pos = simulation.randomPassablePos()
+            manager.gameState.insertUnit(unitId, 0, pos)
+            orders = [MoveUnitOrder(simulation.randomPassablePos())
+                      for _ in range(3)]
+            manager.unitOrders.giveOrders(unitId,
+                                          orders + [MoveUnitOrder(pos)])
+            simulation.connections.unitCreated(unitId)
+        simulation.tick()
+        state = SimulationState.fromSimulation(manager.gameState,
+                                               manager.unitOrders,
+                                               manager.elapsedTicks)
+        assert len(state.serialize()) > MAX_SNAPSHOT_LENGTH
+
+        backend = Backend(Deferred())
+        NoStdio(backend)
+        bot = Bot(backend, seed=0)
+        connection = simulation.connections.newConnection(MemoryConnection)
+        def deliver(data):
+            for message in splitFrames(data):
+                backend.networkMessage(message)
+        connection.writeToTransport = deliver
+        backend.networkReady(LinkedNetwork(backend, connection))
+        connection.connectionMade()
+        assert backend.lockstep
+        assert backend.simulation is None
+
+        # Ticks keep happening while the snapshot is still on its way.
+        for _ in range(10):
+            simulation.tick()
+        assert backend.simulation is not None
+        assert backend.gameState.hasSize
+        assert not backend.lockstepBacklog
+        clientState = SimulationState.fromSimulation(
+            backend.gameState, backend.simulation.unitOrders,
+            backend.simulation.elapsedTicks
+        )
+        serverState = SimulationState.fromSimulation(manager.gameState,
+                                                     manager.unitOrders,
+                                                     manager.elapsedTicks)
+        assert clientState.serialize() == serverState.serialize()
+        assert not backend.desynced
+        assert bot.ticksSeen > 0
+
+    def test_integerMath(self):
+        for n in range(1000):
+            root = integerSqrt(n)
+            assert root**2 <= n < (root + 1)**2
+        assert divideAndRound(5, 2) == 3
+        assert divideAndRound(-5, 2) == -3
+        assert divideAndRound(7, 3) == 2
+
+
+def joinGame(server):
+    # Set up a client simulation the same way a newly-joined client would.
+    state = SimulationState.fromSimulation(server.gameState,
+                                           server.unitOrders,
+                                           server.elapsedTicks)
+    state = SimulationState.deserialize(state.serialize())
+
+    gameState = GameState()
+    MapContents.fromGameState(server.gameState).applyTo(gameState)
+    client = Simulation(RecordingConnections(), gameState)
+    state.applyTo(gameState, client.unitOrders)
+    client.elapsedTicks = state.elapsedTicks
+
+    server.connectionManager.broadcasts = []
+    return client
+
+def relay(server, client):
+    # Pass everything the server broadcast on to the client, the way the
+    # client backend would.
+    orderPlayer = None
+    orders = []
+    for data in server.connectionManager.broadcasts:
+        message = deserializeMessage(data)
+        if isinstance(message, messages.OrderFrom):
+            orderPlayer = message.playerId
+        elif isinstance(message, messages.Tick):
+            client.step(orders)
+            orders = []
+            assert message.stateHash == client.gameState.stateHash
+        else:
+            orders.append((orderPlayer, message))
+    server.connectionManager.broadcasts = []
+
+class RecordingConnections(object):
+    def __init__(self):
+        self.broadcasts = []
+
+    def startBatch(self):
+        pass
+
+    def flushBatch(self):
+        pass
+
+    def broadcastMessage(self, message, supersedable=False):
+        self.broadcasts.append(message.serialize())
+
+    def unitCreated(self, unitId, traceId=None):
+        pass
+
+    def unitDeleted(self, unitId):
+        pass
+
+    def unitMoved(self, unitId, traceId=None):
+        pass
+
+    def resourcesChanged(self, playerId, amount):
+        pass
@@ -0,0 +1,74 @@
+from StringIO import StringIO
+
+from src.server.game_state_manager import GameStateManager
+from src.server.replay import ReplayRecorder, Replay, HeadlessConnections
+from src.shared.geometry import Coord
+from src.shared.ident import UnitId
+from src.shared import messages
+from src.shared.unit_set import UnitSet
+
+
+class TestReplay:
+    """
+    Make sure replaying a recorded game ends up in exactly the same state as
+    the original.
+    """
+
+    def test_roundTrip(self):
+        for lockstep in [False, True]:
+            original, replay = recordGame(lockstep)
+            assert replay.totalTicks == original.elapsedTicks
+            assert replay.endHash == original.gameState.stateHash
+
+            result = replay.run()
+            assert result.elapsedTicks == original.elapsedTicks
+            assert result.gameState.positions == \
+                original.gameState.positions
+            assert result.gameState.resources == \
+                original.gameState.resources
+            assert result.gameState.stateHash == replay.endHash
+
+    def test_unfinished(self):
+        # A log that was cut off (say, because the server crashed) still
+        # replays up to the last order.
+        outFile = UnclosableStringIO()
+        server = GameStateManager(None, HeadlessConnections())
+        server.setRecorder(ReplayRecorder(outFile))
+        server.tick()
+        server.orderReceived(0, messages.OrderNew(0, Coord.fromUnit((5, 5))))
+        server.tick()
+
+        replay = Replay.load(StringIO(outFile.getvalue()))
+        assert replay.endHash is None
+        assert replay.totalTicks == 2
+        assert replay.run().gameState.positions == server.gameState.positions
+
+
+def recordGame(lockstep):
+    outFile = UnclosableStringIO()
+    server = GameStateManager(None, HeadlessConnections(), lockstep=lockstep)
+    server.setRecorder(ReplayRecorder(outFile))
+
+    server.orderReceived(0, messages.OrderNew(0, Coord.fromUnit((10, 0))))
+    server.orderReceived(1, messages.OrderNew(0, Coord.fromUnit((0, 10))))
+    server.tick()
+    server.orderReceived(0, messages.OrderMove(
+        UnitSet([UnitId(0, 0)]), Coord.fromCBU(chunk=(2, 2), build=(1, 4))
+    ))
+    server.orderReceived(1, messages.OrderMove(
+        UnitSet([UnitId(1, 0)]), Coord.fromCBU(chunk=(6, 0))
+    ))
+    for _ in range(50):
+        server.tick()
+    server.removePlayer(1)
+    for _ in range(100):
+        server.tick()
+    server.stopRecording()
+
+    replay = Replay.load(StringIO(outFile.getvalue()))
+    return (server, replay)
+
+class UnclosableStringIO(StringIO):
+    # Keep the contents around after the recorder closes it.
+    def close(self):
+        pass
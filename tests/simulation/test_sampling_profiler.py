@@ -0,0 +1,57 @@
+from StringIO import StringIO
+import sys
+import time
+
+from src.server.headless import HeadlessSimulation
+from src.shared.sampling_profiler import SamplingProfiler
+
+
+def innerFunction(profiler):
+    profiler.sample(None, sys._getframe())
+
+
+def outerFunction(profiler):
+    innerFunction(profiler)
+
+
+class TestSamplingProfiler:
+    """
+    Make sure the sampling profiler records stacks and writes them out in
+    collapsed stack format.
+    """
+
+    def test_collapsed(self):
+        profiler = SamplingProfiler()
+        outerFunction(profiler)
+        outerFunction(profiler)
+        innerFunction(profiler)
+
+        outFile = StringIO()
+        profiler.write(outFile)
+        lines = outFile.getvalue().splitlines()
+        assert len(lines) == 2
+        counts = {}
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            frames = stack.split(";")
+            assert frames[-1].startswith("innerFunction (")
+            counts[frames[-2].split()[0]] = int(count)
+        assert counts == {"outerFunction": 2, "test_collapsed": 1}
+
+    def test_timer(self):
+        # Sample a headless game for real.
+        simulation = HeadlessSimulation(numPlayers=2, unitsPerPlayer=10,
+                                        seed=0)
+        profiler = SamplingProfiler()
+        profiler.start(rate=1000)
+        try:
+            deadline = time.time() + 5
+            while profiler.sampleCount < 10 and time.time() < deadline:
+                simulation.run(10)
+        finally:
+            profiler.stop()
+        assert profiler.sampleCount >= 10
+        assert not profiler.running
+
+        lines = profiler.collapsedLines()
+        assert any("tick (src/server/headless.py:" in line for line in lines)
@@ -0,0 +1,54 @@
+from src.shared.game_state import GameState
+from src.shared.game_state_change import ResourceChange
+from src.shared.geometry import Coord
+from src.shared.message_infrastructure import deserializeMessage
+from src.shared import messages
+
+
+class TestStateHash:
+    """
+    Make sure the incrementally updated state hash always matches the hash
+    of the current state, regardless of how it got there.
+    """
+
+    def test_incremental(self):
+        gameState = GameState()
+        assert gameState.stateHash == 0
+
+        unit1 = gameState.addUnit(0, 0, Coord.fromUnit((10, 10)))
+        unit2 = gameState.addUnit(1, 0, Coord.fromUnit((20, 10)))
+        gameState.moveUnitTo(unit1, Coord.fromUnit((12, 10)))
+        ResourceChange(1, 3).apply(gameState)
+        assert gameState.stateHash == gameState.computeStateHash()
+
+        # Getting to the same state a different way gives the same hash.
+        other = GameState()
+        ResourceChange(1, 1).apply(other)
+        other.addUnit(1, 0, Coord.fromUnit((20, 10)))
+        ResourceChange(1, 2).apply(other)
+        other.addUnit(0, 0, Coord.fromUnit((5, 5)))
+        other.moveUnitTo(unit1, Coord.fromUnit((12, 10)))
+        assert other.stateHash == gameState.stateHash
+
+        # Undoing everything gets back to the empty hash.
+        gameState.removeUnit(unit1)
+        gameState.removeUnit(unit2)
+        ResourceChange(1, -3).apply(gameState)
+        assert gameState.stateHash == 0
+
+    def test_sensitive(self):
+        gameState = GameState()
+        unitId = gameState.addUnit(0, 0, Coord.fromUnit((10, 10)))
+        hashes = set([gameState.stateHash])
+        gameState.moveUnitTo(unitId, Coord.fromUnit((10, 11)))
+        hashes.add(gameState.stateHash)
+        ResourceChange(0, 1).apply(gameState)
+        hashes.add(gameState.stateHash)
+        assert len(hashes) == 3
+
+    def test_tickMessage(self):
+        assert messages.Tick().serialize() == "tick"
+        assert deserializeMessage("tick") == messages.Tick(None)
+
+        tick = messages.Tick(2**64 - 1)
+        assert deserializeMessage(tick.serialize()) == tick
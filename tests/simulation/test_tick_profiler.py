@@ -0,0 +1,46 @@
+from src.server.headless import HeadlessSimulation
+from src.server.tick_profiler import RollingWindow, TickProfiler
+
+
+class TestTickProfiler:
+    """
+    Make sure the tick profiler keeps track of recent phase times and counts.
+    """
+
+    def test_percentiles(self):
+        window = RollingWindow(size=100)
+        assert window.percentiles([50]) is None
+        for sample in range(200, 0, -1):
+            window.add(sample)
+        # Only the last 100 samples are kept.
+        assert window.percentiles([0, 50, 95, 99, 100]) == [1, 50, 95, 99,
+                                                            100]
+
+    def test_ticks(self):
+        now = [0.0]
+        profiler = TickProfiler(clock=lambda: now[0])
+        for tick in range(3):
+            profiler.start()
+            now[0] += 0.25
+            profiler.phaseDone("a")
+            if tick == 0:
+                profiler.count("events", 2)
+            now[0] += 0.5
+            profiler.phaseDone("b")
+            profiler.endTick()
+
+        assert list(profiler.phaseWindows["a"].samples) == [0.25] * 3
+        assert list(profiler.phaseWindows["b"].samples) == [0.5] * 3
+        assert list(profiler.totalWindow.samples) == [0.75] * 3
+        # Ticks where nothing happened count as zero.
+        assert list(profiler.counterWindows["events"].samples) == [2, 0, 0]
+
+    def test_server(self):
+        simulation = HeadlessSimulation(numPlayers=2, unitsPerPlayer=5,
+                                        seed=0)
+        simulation.run(10)
+        profiler = simulation.gameStateManager.profiler
+        assert len(profiler.totalWindow) == 10
+        assert sum(profiler.counterWindows["unitsMoved"].samples) > 0
+        assert sum(profiler.counterWindows["bytesSent"].samples) == \
+            simulation.bytesSent
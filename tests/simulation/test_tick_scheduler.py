@@ -0,0 +1,76 @@
+from twisted.internet.task import Clock
+
+from src.server.tick_scheduler import TickScheduler
+
+
+class TestTickScheduler:
+    """
+    Make sure the tick scheduler keeps to a fixed schedule, catching up after
+    slow ticks and keeping track of what it couldn't catch up on.
+    """
+
+    def test_steady(self):
+        clock, ticks, scheduler = makeScheduler()
+        scheduler.start()
+        for _ in range(10):
+            clock.advance(1)
+        assert ticks == range(11)
+        assert scheduler.lag == 0
+        assert scheduler.overruns == 0
+        assert scheduler.catchUpTicks == 0
+
+    def test_catchUp(self):
+        # A slow tick is made up for by running the next one early.
+        clock, ticks, scheduler = makeScheduler(durations={1: 1.5})
+        scheduler.start()
+        clock.advance(1)
+        assert ticks == [0, 1, 2.5]
+        assert scheduler.overruns == 1
+        clock.advance(0.5)
+        assert ticks == [0, 1, 2.5, 3]
+
+        # If the reactor is held up for a few ticks, the missed ticks are run
+        # right away.
+        clock.advance(3.5)
+        assert ticks == [0, 1, 2.5, 3, 6.5, 6.5, 6.5]
+        assert scheduler.catchUpTicks == 3
+        assert scheduler.droppedTicks == 0
+        assert scheduler.lag == 0.5
+
+    def test_dropped(self):
+        clock, ticks, scheduler = makeScheduler(maxCatchUp=2)
+        scheduler.start()
+        clock.advance(10)
+        assert ticks == [0, 10, 10]
+        assert scheduler.droppedTicks == 8
+        assert scheduler.lag == 8
+
+    def test_error(self):
+        clock = Clock()
+        errors = []
+
+        def tick():
+            raise ValueError("Oops.")
+
+        scheduler = TickScheduler(tick, 1, clock=clock)
+        scheduler.start().addErrback(errors.append)
+        assert len(errors) == 1
+        assert clock.getDelayedCalls() == []
+
+
+def makeScheduler(durations=None, maxCatchUp=5):
+    # Return a Clock, a list of the times at which ticks started, and a
+    # TickScheduler for 1-second ticks. The ticks with the indices in
+    # durations take that long.
+    clock = Clock()
+    ticks = []
+    if durations is None:
+        durations = {}
+
+    def tick():
+        duration = durations.get(len(ticks), 0)
+        ticks.append(clock.seconds())
+        clock.advance(duration)
+
+    scheduler = TickScheduler(tick, 1, clock=clock, maxCatchUp=maxCatchUp)
+    return clock, ticks, scheduler
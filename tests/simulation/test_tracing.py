@@ -0,0 +1,127 @@
+import json
+from StringIO import StringIO
+
+from twisted.internet.defer import Deferred
+
+from src.client.backend import Backend
+from src.client import messages as cmessages
+from src.server.headless import HeadlessSimulation
+from src.shared.datagram import splitFrames
+from src.shared.geometry import Coord
+from src.shared.message_infrastructure import deserializeMessage
+from src.shared import messages
+from src.shared.tracing import Tracer, CLIENT_STAGES, SERVER_STAGES
+from src.shared.unit_set import UnitSet
+
+
+class TestTracing:
+    """
+    Make sure traced orders are timed, and that their trace ids make it to
+    the resulting unit updates.
+    """
+
+    def test_tracer(self):
+        now = [0.0]
+        outFile = StringIO()
+        tracer = Tracer(CLIENT_STAGES, outFile, clock=lambda: now[0],
+                        timeout=10.0)
+
+        tracer.mark(1, "click")
+        now[0] = 0.001
+        tracer.mark(1, "send")
+        # Never started, so ignored.
+        tracer.mark(2, "send")
+        now[0] = 0.101
+        tracer.mark(1, "receive")
+        now[0] = 0.121
+        tracer.mark(1, "render")
+        # Already finished.
+        tracer.mark(1, "render")
+
+        assert tracer.finished == 1
+        assert not tracer.active
+        assert tracer.histograms["send->receive"].count == 1
+        assert tracer.histograms["send->receive"].percentile(50) == 100
+        assert tracer.histograms["total"].percentile(99) == 200
+        record = json.loads(outFile.getvalue())
+        assert record["trace"] == 1
+        assert record["render"] == 0.121
+
+        # Traces that never finish are eventually forgotten.
+        tracer.mark(3, "click")
+        now[0] = 20.0
+        tracer.mark(4, "click")
+        assert tracer.expired == 1
+        assert list(tracer.active) == [4]
+
+    def test_server(self):
+        simulation = HeadlessSimulation(numPlayers=2, seed=0)
+        tracer = Tracer(SERVER_STAGES)
+        simulation.gameStateManager.setTracer(tracer)
+        client = simulation.clients[0]
+        playerId = client.playerId
+
+        sent = []
+        for connection in simulation.clients:
+            connection.writeToTransport = sent.append
+
+        pos = Coord.fromUnit((100, 100))
+        client.sendToServer(messages.OrderNew(0, pos, 5))
+        simulation.run(1)
+        created = [message for message in receivedMessages(sent)
+                   if isinstance(message, messages.NewObelisk)]
+        # Every client is told about the unit, with the trace id.
+        assert len(created) == 2
+        assert all(message.traceId == 5 for message in created)
+        assert tracer.finished == 1
+
+        del sent[:]
+        unitId = created[0].unitId
+        dest = Coord.fromUnit((102, 100))
+        client.sendToServer(messages.OrderMove(UnitSet([unitId]), dest, 6))
+        simulation.run(3)
+        moved = [message for message in receivedMessages(sent)
+                 if isinstance(message, messages.SetPos)]
+        # Only the first update after the order is traced; the rest go out
+        # as deltas as usual.
+        assert len(moved) == 2
+        assert all(message.traceId == 6 for message in moved)
+        assert tracer.finished == 2
+        assert (playerId, 6) not in tracer.active
+
+    def test_client(self):
+        now = [10.0]
+        backend = Backend(Deferred())
+        tracer = Tracer(CLIENT_STAGES, clock=lambda: now[0])
+        backend.setTracer(tracer)
+        network = TimedNetwork(backend, now)
+        backend.network = network
+
+        # The click happened a while before the backend got to it, and the
+        # order takes a while to write.
+        backend.graphicsMessage(cmessages.ShiftRClick((1.0, 1.0), 9.5))
+        [(data, traceId)] = network.sent
+        assert deserializeMessage(data).traceId == traceId
+        times = tracer.active[traceId]
+        assert times == {"click": 9.5, "send": 10.25}
+
+
+def receivedMessages(sent):
+    return [deserializeMessage(data)
+            for chunk in sent for data in splitFrames(chunk)]
+
+class TimedNetwork(object):
+    """
+    Stands in for the network component, taking a quarter of a second to
+    write each message.
+    """
+
+    def __init__(self, backend, now):
+        self.backend = backend
+        self.now     = now
+        self.sent    = []
+
+    def backendMessage(self, data, traceId=None):
+        self.sent.append((data, traceId))
+        self.now[0] += 0.25
+        self.backend.traceReached(traceId, "send")
@@ -7,7 +7,6 @@ from twisted.internet import reactor, task
 from twisted.internet.defer import Deferred
 
 from src.client.backend import Backend as ClientBackend
-from src.shared.message_infrastructure import deserializeMessage
 from src.shared.messages import YourIdIs
 from src.client.messages import RequestQuit
 
@@ -30,14 +29,14 @@ def test_backend_components():
 
     def sendMessages():
         network_dummy.sendMessage(YourIdIs(42).serialize())
-        graphics_dummy.sendMessage(RequestQuit().serialize())
+        graphics_dummy.sendMessage(RequestQuit())
 
     def finalChecks(x):
         # Check that the YourIdIs(42) was successfully forwarded to the
-        # graphics interface.
+        # graphics interface (as an object; it's only serialized to go over
+        # the network).
         gotId = False
-        for msgData in graphics_dummy.messageLog:
-            msg = deserializeMessage(msgData)
+        for msg in graphics_dummy.messageLog:
             if isinstance(msg, YourIdIs):
                 assert msg.playerId == 42
                 gotId = True